@@ -1,17 +1,644 @@
 import os
-from flask import Flask, request, abort, jsonify
+import base64
+import json
+import re
+from flask import Flask, Response, current_app, request, abort, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from models import setup_db, Actor, Movie, db, add_actor_data, add_movie_data
-from auth.auth import AuthError, requires_auth
+from sqlalchemy.orm import selectinload
+from werkzeug.routing import IntegerConverter
+from models import setup_db, Actor, Movie, Casting, db, delete_castings, add_actor_data, add_movie_data, BULK_BATCH_SIZE
+from auth.auth import AuthError, make_auth_settings, requires_auth
+from caching import conditional, make_response_cache
+from compression import make_compression
+from group_commit import make_write_queue
+from metrics import make_metrics, timed
+from profiler import make_query_profiler, query_budget
+from ratelimit import make_rate_limiter
+from serialization import column_names, dumps, ndjson, record, records
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+MAX_BULK_ROWS = 10000
+EXPORT_BATCH_SIZE = 1000
+
+# one executemany per batch, then max(id) and the table_stats update
+BULK_QUERY_BUDGET = -(-MAX_BULK_ROWS // BULK_BATCH_SIZE) + 2
+
+
+def json_response(data, status=200):
+    with timed('serialize'):
+        body = dumps(data)
+    return Response(body, status=status, mimetype='application/json')
+
+
+'''
+Keyset pagination
+List endpoints return at most `limit` rows in `sort` order (id by default),
+plus an opaque `next_cursor` holding the sort key of the last row. Passing
+it back as `after` returns the rows that follow, so every page is an index
+range scan no matter how deep the client pages.
+'''
+
+
+def encode_cursor(values):
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    if not isinstance(values, list):
+        raise ValueError('Malformed cursor')
+    return values
+
+
+# the range of an SQLite INTEGER, beyond which a parameter cannot be bound
+MIN_INTEGER = -2 ** 63
+MAX_INTEGER = 2 ** 63 - 1
+
+
+def in_integer_range(value):
+    return MIN_INTEGER <= value <= MAX_INTEGER
+
+
+class IdConverter(IntegerConverter):
+    '''
+    <int:...> in the routes, up to the largest id an INTEGER column holds, so a
+    longer one is a 404 rather than an OverflowError from the driver.
+    '''
+
+    def __init__(self, map, *args, **kwargs):
+        kwargs.setdefault('max', MAX_INTEGER)
+        super().__init__(map, *args, **kwargs)
+
+
+def page_args(args, key_count):
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+        after = args.get('after')
+        after = decode_cursor(after) if after else None
+    except (ValueError, TypeError):
+        abort(400)
+
+    if limit < 1:
+        abort(400)
+    if after is not None:
+        # the sort value (if any) followed by the id of the last row
+        if len(after) != key_count or type(after[-1]) is not int or \
+                not all(value is None or type(value) in (int, float, str) for value in after) or \
+                not all(in_integer_range(value) for value in after if type(value) is int):
+            abort(400)
+
+    return min(limit, MAX_PAGE_SIZE), after
+
+
+def sort_args(args, model, sortable):
+    # sort=<column> or sort=-<column>, only on indexed columns
+    sort = args.get('sort', 'id')
+    descending = sort.startswith('-')
+    name = sort[1:] if descending else sort
+    if name not in sortable:
+        abort(400)
+
+    if name == 'id':
+        return [model.id], descending
+    return [getattr(model, name), model.id], descending
+
+
+def after_clause(keys, values, descending):
+    # rows that come after `values` in `keys` order; SQLite sorts NULL first
+    id_column, last_id = keys[-1], values[-1]
+    id_after = id_column < last_id if descending else id_column > last_id
+    if len(keys) == 1:
+        return id_after
+
+    column, value = keys[0], values[0]
+    if value is None:
+        if descending:
+            return db.and_(column.is_(None), id_after)
+        return db.or_(column.isnot(None), db.and_(column.is_(None), id_after))
+
+    beyond = column < value if descending else column > value
+    clause = db.or_(beyond, db.and_(column == value, id_after))
+    if descending:
+        clause = db.or_(clause, column.is_(None))
+    return clause
+
+
+def page_query(query, model, sortable, args):
+    # works on a Query as well as a select(), so the async app can share it
+    keys, descending = sort_args(args, model, sortable)
+    limit, after = page_args(args, len(keys))
+
+    if after is not None:
+        query = query.filter(after_clause(keys, after, descending))
+    query = query.order_by(*[key.desc() if descending else key for key in keys])
+
+    # one extra row tells us whether there is a next page
+    return query.limit(limit + 1), keys, limit
+
+
+def page_rows(rows, keys, limit):
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([getattr(rows[-1], key.key) for key in keys])
+    return rows, next_cursor
+
+
+def paginate(query, model, sortable=('id',)):
+    query, keys, limit = page_query(query, model, sortable, request.args)
+    return page_rows(query.all(), keys, limit)
+
+
+'''
+Filters
+Pushed down into SQL, each one backed by an index (see migrations/).
+    /actors: gender=<value>, min_age=<int>, max_age=<int>, name_prefix=<text>
+    /movies: min_release_date=<year>, max_release_date=<year>
+name_prefix is case sensitive and written as a range so it can use the index.
+'''
+
+ACTOR_SORTS = ('id', 'name', 'age')
+MOVIE_SORTS = ('id', 'release_date')
+
+
+def integer_arg(value):
+    value = int(value)
+    if not in_integer_range(value):
+        raise ValueError('{} is outside the INTEGER range'.format(value))
+    return value
+
+
+def filter_actors(query, args):
+    try:
+        if 'gender' in args:
+            query = query.filter(Actor.gender == args['gender'])
+        if 'min_age' in args:
+            query = query.filter(Actor.age >= integer_arg(args['min_age']))
+        if 'max_age' in args:
+            query = query.filter(Actor.age <= integer_arg(args['max_age']))
+    except ValueError:
+        abort(400)
+
+    if args.get('name_prefix'):
+        prefix = args['name_prefix']
+        query = query.filter(Actor.name >= prefix, Actor.name < prefix + '\U0010ffff')
+    return query
+
+
+def filter_movies(query, args):
+    try:
+        if 'min_release_date' in args:
+            query = query.filter(Movie.release_date >= integer_arg(args['min_release_date']))
+        if 'max_release_date' in args:
+            query = query.filter(Movie.release_date <= integer_arg(args['max_release_date']))
+    except ValueError:
+        abort(400)
+    return query
+
+
+'''
+Casting
+GET /movies/<id>/actors and GET /actors/<id>/movies list one side of the
+castings table along with the role. With ?include=cast the list endpoints
+nest the same lists in every row of the page; they are loaded for the whole
+page by one selectinload query, so a page takes the same number of queries
+however many rows it has.
+'''
+
+
+def include_cast(args):
+    include = args.get('include')
+    if include not in (None, 'cast'):
+        abort(400)
+    return include == 'cast'
+
+
+def movie_cast_select(movie_id):
+    return (db.select(*Actor.columns(), Casting.role)
+            .join(Casting, Casting.actor_id == Actor.id)
+            .where(Casting.movie_id == movie_id)
+            .order_by(Actor.id))
+
+
+def actor_movies_select(actor_id):
+    return (db.select(*Movie.columns(), Casting.role)
+            .join(Casting, Casting.movie_id == Movie.id)
+            .where(Casting.actor_id == actor_id)
+            .order_by(Movie.id))
+
+
+# ORM loader options for ?include=cast, one extra query per page
+MOVIE_CAST = selectinload(Movie.castings).joinedload(Casting.actor)
+ACTOR_MOVIES = selectinload(Actor.castings).joinedload(Casting.movie)
+
+
+def movie_with_actors(movie):
+    return dict(movie.format(), actors=[dict(casting.actor.format(), role=casting.role)
+                                        for casting in movie.castings])
+
+
+def actor_with_movies(actor):
+    return dict(actor.format(), movies=[dict(casting.movie.format(), role=casting.role)
+                                        for casting in actor.castings])
+
+
+'''
+Search
+GET /search?q=<words> looks the words up in the FTS5 indexes of actor names
+and movie titles (see models.py). A result has to contain every word, and
+words of SEARCH_PREFIX_LENGTH or more characters also match as prefixes, so
+"leo capr" finds "Leonardo DiCaprio". Results are ranked by bm25, best first,
+and paged with the same limit / after / next_cursor as the lists. The cursor
+holds the score of the last result, so a write between two pages can move a
+row across the page boundary. type=actors or type=movies searches one table.
+
+A page takes one query to rank the matches and one per table to read the
+rows on it. Each table's matches are ranked inside FTS5, past the cursor,
+and only its best limit + 1 are kept, so every match can be found. bm25
+still scores every match of a word, so a word found in most of a million
+rows takes about a second; more words narrow the search.
+'''
+
+SEARCH_TYPES = {'actors': Actor, 'movies': Movie}
+SEARCH_PREFIX_LENGTH = 3
+MAX_SEARCH_WORDS = 10
+
+
+def search_match(q):
+    # only the words of q reach FTS5, so quotes and operators in q are not syntax
+    words = re.findall(r'[^\W_]+', q or '')[:MAX_SEARCH_WORDS]
+    return ' '.join('"{}"{}'.format(word, '*' if len(word) >= SEARCH_PREFIX_LENGTH else '') for word in words)
+
+
+def search_query(args):
+    match = search_match(args.get('q'))
+    types = [args['type']] if 'type' in args else list(SEARCH_TYPES)
+    if not match or not all(name in SEARCH_TYPES for name in types):
+        abort(400)
+
+    # the cursor is the (score, type, id) of the last result
+    limit, after = page_args(args, 3)
+    if after is not None and (type(after[0]) not in (int, float) or after[1] not in types):
+        abort(400)
+
+    # the best limit + 1 of each table past the cursor hold the best of all
+    params = {'match': match, 'limit': limit + 1}
+    past_cursor = ''
+    if after is not None:
+        past_cursor = " AND (bm25({0}_fts), '{0}', rowid) > (:score, :type, :id)"
+        params.update(score=after[0], type=after[1], id=after[2])
+    ranked = ' UNION ALL '.join(
+        ("SELECT * FROM (SELECT bm25({0}_fts) AS score, '{0}' AS type, rowid AS id FROM {0}_fts "
+         "WHERE {0}_fts MATCH :match" + past_cursor + " ORDER BY score, id LIMIT :limit)").format(name)
+        for name in types)
+    sql = 'SELECT score, type, id FROM ({})'.format(ranked)
+    return db.text(sql + ' ORDER BY score, type, id LIMIT :limit').bindparams(**params), limit
+
+
+def search_page(rows, limit):
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(list(rows[-1]))
+
+    # type -> select of the rows on the page
+    selects = {}
+    for name in {row.type for row in rows}:
+        model = SEARCH_TYPES[name]
+        selects[name] = db.select(*model.columns()).where(model.id.in_([row.id for row in rows if row.type == name]))
+    return rows, selects, next_cursor
+
+
+def search_results(rows, found):
+    '''found: type -> rows read by the selects from search_page'''
+    by_id = {}
+    for name, matches in found.items():
+        names = column_names(SEARCH_TYPES[name].columns())
+        by_id[name] = {match.id: record(names, match) for match in matches}
+    # a row deleted since it was ranked is left out
+    return [dict(by_id[row.type][row.id], type=row.type) for row in rows if row.id in by_id[row.type]]
+
+
+'''
+Validation
+Each validator takes one record from a request body and returns the column
+values to store and a dict of field errors (empty when the record is valid).
+'''
+
+
+def _optional_int(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise ValueError
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    if not isinstance(value, int) or value < 0:
+        raise ValueError
+    return value
+
+
+def _required_string(value, max_length):
+    if not isinstance(value, str) or not value.strip():
+        return 'is required'
+    if len(value) > max_length:
+        return 'must be at most {} characters'.format(max_length)
+    return None
+
+
+def validate_actor(data):
+    if not isinstance(data, dict):
+        return None, {'actor': 'must be an object'}
+
+    errors = {}
+    values = {'name': data.get('name'), 'age': None, 'gender': data.get('gender')}
+
+    error = _required_string(values['name'], 80)
+    if error:
+        errors['name'] = error
+    try:
+        values['age'] = _optional_int(data.get('age'))
+    except ValueError:
+        errors['age'] = 'must be a positive integer'
+    if values['gender'] is not None and not isinstance(values['gender'], str):
+        errors['gender'] = 'must be a string'
+
+    return values, errors
+
+
+def validate_movie(data):
+    if not isinstance(data, dict):
+        return None, {'movie': 'must be an object'}
+
+    errors = {}
+    values = {'title': data.get('title'), 'release_date': None}
+
+    error = _required_string(values['title'], 80)
+    if error:
+        errors['title'] = error
+    try:
+        values['release_date'] = _optional_int(data.get('release_date'))
+    except ValueError:
+        errors['release_date'] = 'must be a year'
+
+    return values, errors
+
+
+def validate_casting(data):
+    if not isinstance(data, dict):
+        return None, {'casting': 'must be an object'}
+
+    errors = {}
+    values = {'actor_id': data.get('actor_id'), 'role': data.get('role')}
+
+    if isinstance(values['actor_id'], bool) or not isinstance(values['actor_id'], int):
+        errors['actor_id'] = 'must be the id of an actor'
+    if values['role'] is not None:
+        if not isinstance(values['role'], str):
+            errors['role'] = 'must be a string'
+        elif len(values['role']) > 80:
+            errors['role'] = 'must be at most 80 characters'
+
+    return values, errors
+
+
+def retry_after(error):
+    # the Retry-After the rate limiter set on a 429 or 503, if any
+    return {name: value for name, value in error.get_headers() if name == 'Retry-After'}
+
+
+def create_row(model, values):
+    # a commit of its own, or a share of a group commit, see group_commit.py
+    write_queue = current_app.extensions.get('write_queue')
+    if write_queue is not None:
+        return write_queue.insert(model, values)
+    row = model(**values)
+    row.insert()
+    return row.id
+
+
+def bulk_create(model, key, validate):
+    '''
+    Body: {"<key>": [...], "mode": "atomic" | "partial"}
+    atomic (default) - nothing is inserted if any record is invalid
+    partial - the valid records are inserted and the invalid ones reported
+    Either way the valid records go in with one transaction.
+    '''
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get(key), list):
+        abort(400)
+
+    submitted = body[key]
+    mode = body.get('mode', 'atomic')
+    if mode not in ('atomic', 'partial') or not submitted or len(submitted) > MAX_BULK_ROWS:
+        abort(400)
+
+    rows = []
+    failed = []
+    for index, item in enumerate(submitted):
+        values, errors = validate(item)
+        if errors:
+            failed.append({'index': index, 'errors': errors})
+        else:
+            rows.append(values)
+
+    if failed and mode == 'atomic':
+        return json_response({
+          "success": False,
+          "error": 422,
+          "message": "unprocessable",
+          "failed": failed
+        }, 422)
+
+    created = []
+    if rows:
+        try:
+            created = model.insert_many(rows)
+        except Exception as e:
+            current_app.logger.warning('Bulk insert into %s failed: %s', model.__tablename__, e)
+            db.session.rollback()
+            abort(422)
+
+    return json_response({
+      "success": True,
+      "created": created,
+      "failed": failed
+    })
+
+
+'''
+Bulk changes
+PATCH and DELETE on /actors/bulk and /movies/bulk change every row the body
+picks with one set-based UPDATE or DELETE, in one transaction:
+    {"ids": [1, 2, 3]}                       at most MAX_BULK_ROWS ids
+    {"filter": {"gender": "male", ...}}      the filters of the list endpoint
+PATCH also takes "changes", holding fields the single-row PATCH can change,
+each checked by the rule the validator applies to it.
+'''
+
+ACTOR_FILTERS = ('gender', 'min_age', 'max_age', 'name_prefix')
+MOVIE_FILTERS = ('min_release_date', 'max_release_date')
+
+
+def bulk_scope(body, model, filters, filter_names):
+    # the where clause picking the rows to change
+    ids, where = body.get('ids'), body.get('filter')
+    if (ids is None) == (where is None):
+        abort(400)
+
+    if ids is not None:
+        if not isinstance(ids, list) or not ids or len(ids) > MAX_BULK_ROWS or \
+                not all(type(row_id) is int for row_id in ids):
+            abort(400)
+        return model.id.in_(ids)
+
+    # an empty filter would pick every row, which has to be asked for by ids
+    if not isinstance(where, dict) or not where or not set(where) <= set(filter_names) or \
+            not all(type(value) in (int, str) for value in where.values()):
+        abort(400)
+    # a select() rather than model.query, so the async app can share it
+    clause = filters(db.select(model), {name: str(value) for name, value in where.items()}).whereclause
+    if clause is None:
+        # e.g. an empty name_prefix, which filters nothing out
+        abort(400)
+    return clause
+
+
+def validate_changes(changes, fields, validate):
+    if not isinstance(changes, dict) or not changes:
+        return None, {'changes': 'must be a non-empty object'}
+
+    values, errors = validate(changes)
+    errors = {field: error for field, error in errors.items() if field in changes}
+    errors.update({field: 'cannot be changed' for field in changes if field not in fields})
+    return {field: values[field] for field in changes if field in fields}, errors
+
+
+def bulk_update(model, fields, validate, filters, filter_names):
+    '''Body: {"ids": [...] | "filter": {...}, "changes": {...}}'''
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400)
+
+    clause = bulk_scope(body, model, filters, filter_names)
+    values, errors = validate_changes(body.get('changes'), fields, validate)
+    if errors:
+        return json_response({
+          "success": False,
+          "error": 422,
+          "message": "unprocessable",
+          "errors": errors
+        }, 422)
+
+    try:
+        updated = model.update_many(clause, values)
+    except Exception as e:
+        current_app.logger.warning('Bulk update of %s failed: %s', model.__tablename__, e)
+        db.session.rollback()
+        abort(422)
+
+    return json_response({
+      "success": True,
+      "updated": updated
+    })
+
+
+def bulk_delete(model, total_key, filters, filter_names):
+    '''Body: {"ids": [...] | "filter": {...}}'''
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400)
+
+    clause = bulk_scope(body, model, filters, filter_names)
+    try:
+        deleted = model.delete_many(clause)
+    except Exception as e:
+        current_app.logger.warning('Bulk delete from %s failed: %s', model.__tablename__, e)
+        db.session.rollback()
+        abort(422)
+
+    return json_response({
+      "success": True,
+      "deleted": deleted,
+      total_key: model.count()
+    })
+
+
+def export_ndjson(*columns):
+    '''
+    Streams every row as one JSON object per line. Rows are fetched
+    EXPORT_BATCH_SIZE at a time and written out batch by batch, so memory
+    use does not depend on the size of the table.
+    '''
+    names = column_names(columns)
+
+    def generate():
+        query = db.session.query(*columns).order_by(columns[0]).yield_per(EXPORT_BATCH_SIZE)
+        batch = []
+        for row in query:
+            batch.append(row)
+            if len(batch) == EXPORT_BATCH_SIZE:
+                yield ndjson(names, batch)
+                batch = []
+        if batch:
+            yield ndjson(names, batch)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    app.url_map.converters['int'] = IdConverter
+    if test_config is not None:
+        app.config.update(test_config)
     setup_db(app)
     CORS(app)
 
+    # issuer, audience and signing keys of the tokens, see auth/auth.py
+    make_auth_settings(app.config).init_app(app)
+
+    # per-client rate limits and a cap on concurrent requests, see ratelimit.py
+    rate_limiter = make_rate_limiter(app.config)
+    if rate_limiter is not None:
+        rate_limiter.init_app(app)
+
+    # read-through cache in front of the GET routes, see caching.py
+    response_cache = make_response_cache(app.config)
+    if response_cache is not None:
+        response_cache.init_app(app)
+
+    # per-route latency, auth/db/serialize split and query counts at /metrics
+    metrics = make_metrics(app.config)
+    if metrics is not None:
+        metrics.init_app(app)
+        if metrics.public:
+            app.add_url_rule('/metrics', 'metrics', metrics.endpoint)
+        else:
+            @app.route('/metrics', endpoint='metrics')
+            @requires_auth('get:metrics')
+            def get_metrics(payload):
+                return metrics.endpoint()
+
+    # POST /actors and /movies committed in groups, off unless GROUP_COMMIT is set
+    write_queue = make_write_queue(app.config)
+    if write_queue is not None:
+        write_queue.init_app(app)
+
+    # slow-query log, N+1 detection and the @query_budget checks
+    query_profiler = make_query_profiler(app.config)
+    if query_profiler is not None:
+        query_profiler.init_app(app)
+
+    # gzip/brotli for clients that accept it, compressed once per ETag
+    compression = make_compression(app.config)
+    if compression is not None:
+        compression.init_app(app)
+
     @app.after_request
     def after_request(response):
         response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,true')
@@ -25,42 +652,105 @@ def create_app(test_config=None):
     # Actors
 
     @app.route('/actors')
+    @query_budget(3)
     @requires_auth('get:actors')
+    @conditional('actors', includes={'cast': ('castings', 'movies')})
     def get_actors(payload):
+        if include_cast(request.args):
+            query = filter_actors(Actor.query.options(ACTOR_MOVIES), request.args)
+            actors, next_cursor = paginate(query, Actor, ACTOR_SORTS)
+            return json_response({
+              "success": True,
+              "actors": [actor_with_movies(actor) for actor in actors],
+              "next_cursor": next_cursor
+            })
 
-        actors = Actor.query.all()
-        data = []
-        for actor in actors:
-            actor_data = {'id': actor.id, 'name': actor.name, 'age': actor.age, 'gender': actor.gender}
-            data.append(actor_data)
+        columns = Actor.columns()
+        actors, next_cursor = paginate(filter_actors(db.session.query(*columns), request.args), Actor, ACTOR_SORTS)
 
-        return jsonify({
+        return json_response({
           "success": True,
-          "actors": data
+          "actors": records(column_names(columns), actors),
+          "next_cursor": next_cursor
         })
 
     @app.route('/actors', methods=['POST'])
+    @query_budget(3)
     @requires_auth('post:actors')
     def create_actor(payload):
         body = request.get_json()
         try:
-            actor = Actor(
-              name=body.get('name'),
-              age=body.get('age'),
-              gender=body.get('gender'),
-            )
-            actor.insert()
-
-            return jsonify({
+            actor_id = create_row(Actor, {
+              'name': body.get('name'),
+              'age': body.get('age'),
+              'gender': body.get('gender'),
+            })
+
+            return json_response({
               "success": True,
-              "created": actor.id
+              "created": actor_id
             })
 
         except Exception as e:
             print(e)
             abort(422)
 
+    @app.route('/actors/<int:actor_id>')
+    @query_budget(2)
+    @requires_auth('get:actors')
+    @conditional('actors')
+    def get_actor(payload, actor_id):
+        columns = Actor.columns()
+        actor = db.session.query(*columns).filter(Actor.id == actor_id).one_or_none()
+        if actor is None:
+            abort(404)
+
+        return json_response({
+          "success": True,
+          "actor": record(column_names(columns), actor)
+        })
+
+    @app.route('/actors/export')
+    @requires_auth('get:actors')
+    def export_actors(payload):
+        return export_ndjson(Actor.id, Actor.name, Actor.age, Actor.gender)
+
+    @app.route('/actors/<int:actor_id>/movies')
+    @query_budget(3)
+    @requires_auth('get:actors')
+    @conditional('actors', 'castings', 'movies')
+    def get_actor_movies(payload, actor_id):
+        movies = db.session.execute(actor_movies_select(actor_id)).all()
+        # no castings could also mean no such actor
+        if not movies and db.session.get(Actor, actor_id) is None:
+            abort(404)
+
+        return json_response({
+          "success": True,
+          "actor": actor_id,
+          "movies": records(column_names(Movie.columns() + (Casting.role,)), movies)
+        })
+
+    @app.route('/actors/bulk', methods=['POST'])
+    @query_budget(BULK_QUERY_BUDGET)
+    @requires_auth('post:actors')
+    def create_actors(payload):
+        return bulk_create(Actor, 'actors', validate_actor)
+
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @query_budget(2)
+    @requires_auth('patch:actors')
+    def modify_actors(payload):
+        return bulk_update(Actor, ('name', 'gender'), validate_actor, filter_actors, ACTOR_FILTERS)
+
+    @app.route('/actors/bulk', methods=['DELETE'])
+    @query_budget(5)
+    @requires_auth('delete:actors')
+    def delete_actors(payload):
+        return bulk_delete(Actor, 'total_actors', filter_actors, ACTOR_FILTERS)
+
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
+    @query_budget(6)
     @requires_auth('delete:actors')
     def delete_actor(payload, actor_id):
         try:
@@ -71,10 +761,10 @@ def create_app(test_config=None):
 
             actor.delete()
 
-            return jsonify({
+            return json_response({
               'success': True,
               "deleted": actor.id,
-              'total_actors': len(Actor.query.all())
+              'total_actors': Actor.count()
             })
 
         except Exception as e:
@@ -82,6 +772,7 @@ def create_app(test_config=None):
             abort(422)
 
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
+    @query_budget(4)
     @requires_auth('patch:actors')
     def modify_actor(payload, actor_id):
 
@@ -99,7 +790,7 @@ def create_app(test_config=None):
 
             actor.update()
 
-            return jsonify({
+            return json_response({
               "success": True,
               "actor": {
                 "name": actor.name,
@@ -115,40 +806,149 @@ def create_app(test_config=None):
     # Movies
 
     @app.route('/movies')
+    @query_budget(3)
     @requires_auth('get:movies')
+    @conditional('movies', includes={'cast': ('castings', 'actors')})
     def get_movies(payload):
-        movies = Movie.query.all()
-        data = []
-        for movie in movies:
-            movie_data = {'id': movie.id, 'title': movie.title, 'release_date': movie.release_date}
-            data.append(movie_data)
+        if include_cast(request.args):
+            query = filter_movies(Movie.query.options(MOVIE_CAST), request.args)
+            movies, next_cursor = paginate(query, Movie, MOVIE_SORTS)
+            return json_response({
+                "success": True,
+                "movies": [movie_with_actors(movie) for movie in movies],
+                "next_cursor": next_cursor
+            })
+
+        columns = Movie.columns()
+        movies, next_cursor = paginate(filter_movies(db.session.query(*columns), request.args), Movie, MOVIE_SORTS)
 
-        return jsonify({
+        return json_response({
             "success": True,
-            "movies": data
+            "movies": records(column_names(columns), movies),
+            "next_cursor": next_cursor
         })
 
     @app.route('/movies', methods=['POST'])
+    @query_budget(3)
     @requires_auth('post:movies')
     def create_movie(payload):
         body = request.get_json()
         try:
-            movie = Movie(
-              title=body.get('title'),
-              release_date=body.get('release_date'),
-            )
-            movie.insert()
+            movie_id = create_row(Movie, {
+              'title': body.get('title'),
+              'release_date': body.get('release_date'),
+            })
 
-            return jsonify({
+            return json_response({
               "success": True,
-              "created": movie.id
+              "created": movie_id
             })
 
         except Exception as e:
             print(e)        
             abort(422)
 
+    @app.route('/movies/<int:movie_id>')
+    @query_budget(2)
+    @requires_auth('get:movies')
+    @conditional('movies')
+    def get_movie(payload, movie_id):
+        columns = Movie.columns()
+        movie = db.session.query(*columns).filter(Movie.id == movie_id).one_or_none()
+        if movie is None:
+            abort(404)
+
+        return json_response({
+            "success": True,
+            "movie": record(column_names(columns), movie)
+        })
+
+    @app.route('/movies/export')
+    @requires_auth('get:movies')
+    def export_movies(payload):
+        return export_ndjson(Movie.id, Movie.title, Movie.release_date)
+
+    @app.route('/movies/<int:movie_id>/actors')
+    @query_budget(3)
+    @requires_auth('get:movies')
+    @conditional('movies', 'castings', 'actors')
+    def get_movie_actors(payload, movie_id):
+        actors = db.session.execute(movie_cast_select(movie_id)).all()
+        if not actors and db.session.get(Movie, movie_id) is None:
+            abort(404)
+
+        return json_response({
+            "success": True,
+            "movie": movie_id,
+            "actors": records(column_names(Actor.columns() + (Casting.role,)), actors)
+        })
+
+    @app.route('/movies/<int:movie_id>/actors', methods=['POST'])
+    @query_budget(4)
+    @requires_auth('patch:movies')
+    def cast_actor(payload, movie_id):
+        values, errors = validate_casting(request.get_json(silent=True))
+        if errors:
+            return json_response({
+                "success": False,
+                "error": 422,
+                "message": "unprocessable",
+                "errors": errors
+            }, 422)
+
+        if db.session.get(Movie, movie_id) is None or db.session.get(Actor, values['actor_id']) is None:
+            abort(404)
+
+        try:
+            Casting(movie_id, values['actor_id'], values['role']).insert()
+        except Exception as e:
+            # most likely already cast in this movie
+            print(e)
+            db.session.rollback()
+            abort(422)
+
+        return json_response({
+            "success": True,
+            "movie": movie_id,
+            "actor": values['actor_id'],
+            "role": values['role']
+        })
+
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>', methods=['DELETE'])
+    @query_budget(2)
+    @requires_auth('patch:movies')
+    def uncast_actor(payload, movie_id, actor_id):
+        removed = delete_castings(db.and_(Casting.movie_id == movie_id, Casting.actor_id == actor_id))
+        db.session.commit()
+        if not removed:
+            abort(404)
+
+        return json_response({
+            "success": True,
+            "movie": movie_id,
+            "deleted": actor_id
+        })
+
+    @app.route('/movies/bulk', methods=['POST'])
+    @query_budget(BULK_QUERY_BUDGET)
+    @requires_auth('post:movies')
+    def create_movies(payload):
+        return bulk_create(Movie, 'movies', validate_movie)
+
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @query_budget(2)
+    @requires_auth('patch:movies')
+    def modify_movies(payload):
+        return bulk_update(Movie, ('title', 'release_date'), validate_movie, filter_movies, MOVIE_FILTERS)
+
+    @app.route('/movies/bulk', methods=['DELETE'])
+    @query_budget(5)
+    @requires_auth('delete:movies')
+    def delete_movies(payload):
+        return bulk_delete(Movie, 'total_movies', filter_movies, MOVIE_FILTERS)
+
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
+    @query_budget(6)
     @requires_auth('delete:movies')
     def delete_movie(payload, movie_id):
         try:
@@ -159,10 +959,10 @@ def create_app(test_config=None):
             
             movie.delete()
 
-            return jsonify({
+            return json_response({
               'success': True,
               "deleted": movie.id,
-              'total_movies': len(Movie.query.all())
+              'total_movies': Movie.count()
             })
 
         except Exception as e:    
@@ -170,6 +970,7 @@ def create_app(test_config=None):
             abort(422)
 
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
+    @query_budget(4)
     @requires_auth('patch:movies')
     def modify_movie(payload, movie_id):
 
@@ -187,7 +988,7 @@ def create_app(test_config=None):
 
             movie.update()
 
-            return jsonify({
+            return json_response({
               "success": True,
               "movie": {
                 "title": movie.title,
@@ -200,56 +1001,94 @@ def create_app(test_config=None):
             print(e)
             abort(400)
 
+    @app.route('/search')
+    @query_budget(4)
+    @requires_auth(('get:actors', 'get:movies'))
+    @conditional('actors', 'movies')
+    def search(payload):
+        query, limit = search_query(request.args)
+        rows, selects, next_cursor = search_page(db.session.execute(query).all(), limit)
+        found = {name: db.session.execute(select).all() for name, select in selects.items()}
+
+        return json_response({
+            "success": True,
+            "results": search_results(rows, found),
+            "next_cursor": next_cursor
+        })
+
     @app.errorhandler(404)
     def not_found(error):
-        return jsonify({
+        return json_response({
             "success": False,
             "error": 404,
             "message": "Not found"
-        }), 404
+        }, 404)
 
     @app.errorhandler(400)
     def bad_request(error):
-        return jsonify({
+        return json_response({
             "success": False, 
             "error": 400,
             "message": "bad request"
-            }), 400
+            }, 400)
 
     @app.errorhandler(403)
     def access_denied(error):
-        return jsonify({
+        return json_response({
             "success": False, 
             "error": 403,
             "message": "You don't have the permission to access the requested resource."
-            }), 403
+            }, 403)
 
     @app.errorhandler(422)
     def unprocessable(error):
-        return jsonify({
+        return json_response({
           "success": False, 
           "error": 422,
           "message": "unprocessable"
-          }), 422
+          }, 422)
 
     @app.errorhandler(405)
     def not_allowed(error):
-        return jsonify({
+        return json_response({
           "success": False, 
           "error": 405,
           "message": "method not allowed"
-          }), 405
+          }, 405)
+
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return json_response({
+          "success": False,
+          "error": 429,
+          "message": "too many requests"
+          }, 429), retry_after(error)
+
+    @app.errorhandler(503)
+    def unavailable(error):
+        return json_response({
+          "success": False,
+          "error": 503,
+          "message": "service unavailable"
+          }, 503), retry_after(error)
 
     @app.errorhandler(AuthError)
     def auth_error(ex):
-        response = jsonify(ex.error)
-        response.status_code = ex.status_code
-        return response
+        return json_response(ex.error, ex.status_code)
 
     return app
 
 
-APP = create_app()
+def __getattr__(name):
+    # APP is built the first time it is asked for (gunicorn app:APP, wsgi.py),
+    # not by every import of this module (asgi.py, the tests, flask db)
+    if name == 'APP':
+        app = globals()['APP'] = create_app()
+        return app
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
 
 if __name__ == '__main__':
-    APP.run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
+    # the development server, debugging only with FLASK_ENV=development;
+    # gunicorn_conf.py is how the app is served
+    create_app().run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
\ No newline at end of file
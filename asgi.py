@@ -0,0 +1,548 @@
+import asyncio
+import os
+from contextlib import nullcontext
+from functools import wraps
+
+from quart import Quart, Response, abort, current_app, request
+from sqlalchemy import and_, event, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from app import (ACTOR_SORTS, MOVIE_SORTS, EXPORT_BATCH_SIZE, MAX_BULK_ROWS,
+                 ACTOR_FILTERS, MOVIE_FILTERS, IdConverter, bulk_scope, validate_changes,
+                 ACTOR_MOVIES, MOVIE_CAST, actor_movies_select, actor_with_movies,
+                 filter_actors, filter_movies, include_cast, movie_cast_select, movie_with_actors,
+                 page_query, page_rows, retry_after,
+                 search_page, search_query, search_results,
+                 validate_actor, validate_casting, validate_movie)
+from auth.auth import (AuthError, check_permissions, default_settings, make_auth_settings,
+                       parse_auth_header, verify_decode_jwt)
+from caching import make_etag
+from ratelimit import make_rate_limiter
+from models import (Actor, Movie, Casting, TableStats, ENGINE_PROFILES, BULK_BATCH_SIZE,
+                    database_path, delete_castings_statement, record_write_statement)
+from serialization import column_names, dumps, ndjson, record, records
+
+
+'''
+Async serving mode
+The same routes and permissions as app.py, served by Quart on an ASGI server
+so that one process keeps serving other clients while a request waits on
+the database or on Auth0:
+
+    uvicorn asgi:APP
+
+    - the database is reached through an async SQLAlchemy engine (aiosqlite)
+    - token verification, which may have to fetch the JWKS and always does an
+      RSA check, runs in a worker thread unless the token is already cached
+    - the query, filter, pagination and validation helpers are shared with
+      app.py, so both modes answer the same requests the same way
+
+Needs the packages in requirements-async.txt.
+'''
+
+
+def async_database_url(url):
+    # sqlite:///film.db -> sqlite+aiosqlite:///<this directory>/film.db
+    if not url.startswith('sqlite:///'):
+        return url
+    path = url[len('sqlite:///'):]
+    if path and path != ':memory:' and not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    return 'sqlite+aiosqlite:///' + path
+
+
+def create_engine(url, profile='default'):
+    engine = create_async_engine(async_database_url(url))
+    pragmas = ENGINE_PROFILES[profile]['pragmas']
+
+    @event.listens_for(engine.sync_engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+        cursor.close()
+
+    return engine
+
+
+def requires_auth_async(permission=''):
+    '''requires_auth for coroutine views, see auth/auth.py'''
+    def requires_auth_decorator(f):
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            limiter = current_app.extensions.get('rate_limiter')
+            with limiter.admit() if limiter is not None else nullcontext():
+                settings = current_app.extensions.get('auth', default_settings)
+                token = parse_auth_header(request.headers.get('Authorization', None))
+                payload = settings.token_cache.get(token)
+                if payload is None:
+                    loop = asyncio.get_running_loop()
+                    payload = await loop.run_in_executor(None, verify_decode_jwt, token, settings)
+                    settings.token_cache.put(token, payload)
+                check_permissions(permission, payload)
+                if limiter is not None:
+                    limiter.check(permission, payload)
+                return await f(payload, *args, **kwargs)
+        return wrapper
+    return requires_auth_decorator
+
+
+def json_response(data, status=200):
+    return Response(dumps(data), status=status, mimetype='application/json')
+
+
+ERRORS = {
+    400: "bad request",
+    403: "You don't have the permission to access the requested resource.",
+    404: "Not found",
+    405: "method not allowed",
+    422: "unprocessable",
+    429: "too many requests",
+    503: "service unavailable"
+}
+
+
+def create_asgi_app(test_config=None):
+    app = Quart(__name__)
+    app.url_map.converters['int'] = IdConverter
+    if test_config is not None:
+        app.config.update(test_config)
+
+    engine = create_engine(app.config.get('SQLALCHEMY_DATABASE_URI', database_path),
+                           app.config.get('DATABASE_PROFILE') or os.environ.get('DATABASE_PROFILE', 'default'))
+    Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    app.extensions['async_engine'] = engine
+    make_auth_settings(app.config).init_app(app)
+
+    rate_limiter = make_rate_limiter(app.config)
+    if rate_limiter is not None:
+        rate_limiter.init_app(app)
+
+    @app.after_serving
+    async def dispose_engine():
+        await engine.dispose()
+
+    @app.after_request
+    async def after_request(response):
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,true')
+        response.headers.add('Access-Control-Allow-Methods', 'GET,PATCH,POST,DELETE,OPTIONS')
+        return response
+
+    async def etag_for(session, *tables):
+        rows = (await session.execute(
+            select(TableStats.table_name, TableStats.version).where(TableStats.table_name.in_(tables)))).all()
+        versions = dict(rows)
+        return make_etag(request.full_path, tables, [versions.get(table) for table in tables])
+
+    def not_modified(etag):
+        return etag is not None and request.if_none_match.contains_weak(etag)
+
+    def with_etag(response, etag):
+        if etag is not None:
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    async def list_rows(model, key, table, sortable, filters, cast):
+        # cast: (loader option, row formatter, tables it reads) for ?include=cast
+        with_cast = include_cast(request.args)
+        async with Session() as session:
+            etag = await etag_for(session, table, *(cast[2] if with_cast else ()))
+            if not_modified(etag):
+                return with_etag(Response('', 304), etag)
+
+            if with_cast:
+                query = filters(select(model).options(cast[0]), request.args)
+                query, keys, limit = page_query(query, model, sortable, request.args)
+                rows, next_cursor = page_rows((await session.execute(query)).scalars().all(), keys, limit)
+                data = [cast[1](row) for row in rows]
+            else:
+                columns = model.columns()
+                query, keys, limit = page_query(filters(select(*columns), request.args), model, sortable, request.args)
+                rows, next_cursor = page_rows((await session.execute(query)).all(), keys, limit)
+                data = records(column_names(columns), rows)
+
+        return with_etag(json_response({
+            "success": True,
+            key: data,
+            "next_cursor": next_cursor
+        }), etag)
+
+    async def cast_rows(model, row_id, key, other, other_key, cast_select, tables):
+        # one side of the castings table, as GET /movies/<id>/actors in app.py
+        async with Session() as session:
+            etag = await etag_for(session, *tables)
+            if not_modified(etag):
+                return with_etag(Response('', 304), etag)
+            rows = (await session.execute(cast_select(row_id))).all()
+            # no castings could also mean no such row
+            if not rows and await session.get(model, row_id) is None:
+                abort(404)
+
+        return with_etag(json_response({
+            "success": True,
+            key: row_id,
+            other_key: records(column_names(other.columns() + (Casting.role,)), rows)
+        }), etag)
+
+    async def get_row(model, key, table, row_id):
+        async with Session() as session:
+            etag = await etag_for(session, table)
+            if not_modified(etag):
+                return with_etag(Response('', 304), etag)
+            columns = model.columns()
+            row = (await session.execute(select(*columns).where(model.id == row_id))).one_or_none()
+
+        if row is None:
+            abort(404)
+        return with_etag(json_response({"success": True, key: record(column_names(columns), row)}), etag)
+
+    async def export_rows(*columns):
+        names = column_names(columns)
+
+        async def generate():
+            async with Session() as session:
+                result = await session.stream(select(*columns).order_by(columns[0]))
+                async for rows in result.partitions(EXPORT_BATCH_SIZE):
+                    yield ndjson(names, rows)
+
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    async def create_row(model, values):
+        try:
+            async with Session() as session:
+                async with session.begin():
+                    row = model(**values)
+                    session.add(row)
+                    await session.execute(record_write_statement(model.__tablename__, 1))
+            return json_response({"success": True, "created": row.id})
+        except Exception as e:
+            print(e)
+            abort(422)
+
+    async def bulk_create(model, key, validate):
+        body = await request.get_json(silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get(key), list):
+            abort(400)
+
+        submitted = body[key]
+        mode = body.get('mode', 'atomic')
+        if mode not in ('atomic', 'partial') or not submitted or len(submitted) > MAX_BULK_ROWS:
+            abort(400)
+
+        rows = []
+        failed = []
+        for index, item in enumerate(submitted):
+            values, errors = validate(item)
+            if errors:
+                failed.append({'index': index, 'errors': errors})
+            else:
+                rows.append(values)
+
+        if failed and mode == 'atomic':
+            return json_response({"success": False, "error": 422, "message": "unprocessable", "failed": failed}, 422)
+
+        created = []
+        table = model.__table__
+        try:
+            async with Session() as session:
+                async with session.begin():
+                    # same id bookkeeping as models.insert_rows
+                    if rows and engine.dialect.name != 'sqlite':
+                        for row in rows:
+                            created.append((await session.execute(table.insert(), row)).inserted_primary_key[0])
+                    elif rows:
+                        for start in range(0, len(rows), BULK_BATCH_SIZE):
+                            await session.execute(table.insert(), rows[start:start + BULK_BATCH_SIZE])
+                        last_id = (await session.execute(select(table.c.id).order_by(table.c.id.desc()).limit(1))).scalar()
+                        created = list(range(last_id - len(rows) + 1, last_id + 1))
+                    if rows:
+                        await session.execute(record_write_statement(table.name, len(rows)))
+        except Exception as e:
+            current_app.logger.warning('Bulk insert into %s failed: %s', model.__tablename__, e)
+            abort(422)
+
+        return json_response({"success": True, "created": created, "failed": failed})
+
+    async def bulk_update(model, fields, validate, filters, filter_names):
+        # see app.bulk_update
+        body = await request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(400)
+
+        clause = bulk_scope(body, model, filters, filter_names)
+        values, errors = validate_changes(body.get('changes'), fields, validate)
+        if errors:
+            return json_response({"success": False, "error": 422, "message": "unprocessable", "errors": errors}, 422)
+
+        try:
+            async with Session() as session:
+                async with session.begin():
+                    # same statements as models.update_rows
+                    updated = (await session.execute(model.__table__.update().where(clause).values(**values))).rowcount
+                    if updated:
+                        await session.execute(record_write_statement(model.__tablename__))
+        except Exception as e:
+            current_app.logger.warning('Bulk update of %s failed: %s', model.__tablename__, e)
+            abort(422)
+
+        return json_response({"success": True, "updated": updated})
+
+    async def bulk_delete(model, total_key, filters, filter_names, cast_column):
+        # see app.bulk_delete
+        body = await request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(400)
+
+        clause = bulk_scope(body, model, filters, filter_names)
+        try:
+            async with Session() as session:
+                async with session.begin():
+                    # same statements as models.delete_rows
+                    removed = (await session.execute(
+                        delete_castings_statement(cast_column.in_(select(model.id).where(clause))))).rowcount
+                    if removed:
+                        await session.execute(record_write_statement(Casting.__tablename__, -removed))
+                    deleted = (await session.execute(model.__table__.delete().where(clause))).rowcount
+                    if deleted:
+                        await session.execute(record_write_statement(model.__tablename__, -deleted))
+                    total = (await session.execute(
+                        select(TableStats.row_count).where(TableStats.table_name == model.__tablename__))).scalar()
+        except Exception as e:
+            current_app.logger.warning('Bulk delete from %s failed: %s', model.__tablename__, e)
+            abort(422)
+
+        return json_response({"success": True, "deleted": deleted, total_key: total})
+
+    async def delete_row(model, row_id, total_key, cast_column):
+        try:
+            async with Session() as session:
+                async with session.begin():
+                    row = await session.get(model, row_id)
+                    if row is None:
+                        abort(404)
+                    removed = (await session.execute(delete_castings_statement(cast_column == row_id))).rowcount
+                    if removed:
+                        await session.execute(record_write_statement(Casting.__tablename__, -removed))
+                    await session.delete(row)
+                    await session.execute(record_write_statement(model.__tablename__, -1))
+                    total = (await session.execute(
+                        select(TableStats.row_count).where(TableStats.table_name == model.__tablename__))).scalar()
+            return json_response({'success': True, "deleted": row_id, total_key: total})
+        except Exception as e:
+            print(e)
+            abort(422)
+
+    async def modify_row(model, row_id, fields, key):
+        body = await request.get_json(silent=True)
+        try:
+            async with Session() as session:
+                async with session.begin():
+                    row = await session.get(model, row_id)
+                    if row is None:
+                        abort(404)
+                    for field in fields:
+                        if field in body:
+                            setattr(row, field, body.get(field))
+                    await session.execute(record_write_statement(model.__tablename__))
+                    data = row.format()
+            del data['id']
+            return json_response({"success": True, key: data})
+        except Exception as e:
+            print(e)
+            abort(400)
+
+    @app.route('/')
+    async def index():
+        return 'Should probably have something here'
+
+    # Actors
+
+    @app.route('/actors')
+    @requires_auth_async('get:actors')
+    async def get_actors(payload):
+        return await list_rows(Actor, 'actors', 'actors', ACTOR_SORTS, filter_actors,
+                               (ACTOR_MOVIES, actor_with_movies, ('castings', 'movies')))
+
+    @app.route('/actors/<int:actor_id>')
+    @requires_auth_async('get:actors')
+    async def get_actor(payload, actor_id):
+        return await get_row(Actor, 'actor', 'actors', actor_id)
+
+    @app.route('/actors/export')
+    @requires_auth_async('get:actors')
+    async def export_actors(payload):
+        return await export_rows(Actor.id, Actor.name, Actor.age, Actor.gender)
+
+    @app.route('/actors/<int:actor_id>/movies')
+    @requires_auth_async('get:actors')
+    async def get_actor_movies(payload, actor_id):
+        return await cast_rows(Actor, actor_id, 'actor', Movie, 'movies', actor_movies_select,
+                               ('actors', 'castings', 'movies'))
+
+    @app.route('/actors', methods=['POST'])
+    @requires_auth_async('post:actors')
+    async def create_actor(payload):
+        body = await request.get_json(silent=True) or {}
+        return await create_row(Actor, {'name': body.get('name'), 'age': body.get('age'), 'gender': body.get('gender')})
+
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth_async('post:actors')
+    async def create_actors(payload):
+        return await bulk_create(Actor, 'actors', validate_actor)
+
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @requires_auth_async('patch:actors')
+    async def modify_actors(payload):
+        return await bulk_update(Actor, ('name', 'gender'), validate_actor, filter_actors, ACTOR_FILTERS)
+
+    @app.route('/actors/bulk', methods=['DELETE'])
+    @requires_auth_async('delete:actors')
+    async def delete_actors(payload):
+        return await bulk_delete(Actor, 'total_actors', filter_actors, ACTOR_FILTERS, Casting.actor_id)
+
+    @app.route('/actors/<int:actor_id>', methods=['DELETE'])
+    @requires_auth_async('delete:actors')
+    async def delete_actor(payload, actor_id):
+        return await delete_row(Actor, actor_id, 'total_actors', Casting.actor_id)
+
+    @app.route('/actors/<int:actor_id>', methods=['PATCH'])
+    @requires_auth_async('patch:actors')
+    async def modify_actor(payload, actor_id):
+        return await modify_row(Actor, actor_id, ('name', 'gender'), 'actor')
+
+    # Movies
+
+    @app.route('/movies')
+    @requires_auth_async('get:movies')
+    async def get_movies(payload):
+        return await list_rows(Movie, 'movies', 'movies', MOVIE_SORTS, filter_movies,
+                               (MOVIE_CAST, movie_with_actors, ('castings', 'actors')))
+
+    @app.route('/movies/<int:movie_id>')
+    @requires_auth_async('get:movies')
+    async def get_movie(payload, movie_id):
+        return await get_row(Movie, 'movie', 'movies', movie_id)
+
+    @app.route('/movies/export')
+    @requires_auth_async('get:movies')
+    async def export_movies(payload):
+        return await export_rows(Movie.id, Movie.title, Movie.release_date)
+
+    @app.route('/movies/<int:movie_id>/actors')
+    @requires_auth_async('get:movies')
+    async def get_movie_actors(payload, movie_id):
+        return await cast_rows(Movie, movie_id, 'movie', Actor, 'actors', movie_cast_select,
+                               ('movies', 'castings', 'actors'))
+
+    @app.route('/movies/<int:movie_id>/actors', methods=['POST'])
+    @requires_auth_async('patch:movies')
+    async def cast_actor(payload, movie_id):
+        values, errors = validate_casting(await request.get_json(silent=True))
+        if errors:
+            return json_response({"success": False, "error": 422, "message": "unprocessable", "errors": errors}, 422)
+
+        async with Session() as session:
+            async with session.begin():
+                if await session.get(Movie, movie_id) is None or await session.get(Actor, values['actor_id']) is None:
+                    abort(404)
+                session.add(Casting(movie_id, values['actor_id'], values['role']))
+                try:
+                    await session.flush()
+                except Exception as e:
+                    # most likely already cast in this movie
+                    print(e)
+                    abort(422)
+                await session.execute(record_write_statement(Casting.__tablename__, 1))
+
+        return json_response({"success": True, "movie": movie_id, "actor": values['actor_id'], "role": values['role']})
+
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>', methods=['DELETE'])
+    @requires_auth_async('patch:movies')
+    async def uncast_actor(payload, movie_id, actor_id):
+        async with Session() as session:
+            async with session.begin():
+                removed = (await session.execute(delete_castings_statement(
+                    and_(Casting.movie_id == movie_id, Casting.actor_id == actor_id)))).rowcount
+                if removed:
+                    await session.execute(record_write_statement(Casting.__tablename__, -removed))
+        if not removed:
+            abort(404)
+
+        return json_response({"success": True, "movie": movie_id, "deleted": actor_id})
+
+    @app.route('/movies', methods=['POST'])
+    @requires_auth_async('post:movies')
+    async def create_movie(payload):
+        body = await request.get_json(silent=True) or {}
+        return await create_row(Movie, {'title': body.get('title'), 'release_date': body.get('release_date')})
+
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth_async('post:movies')
+    async def create_movies(payload):
+        return await bulk_create(Movie, 'movies', validate_movie)
+
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @requires_auth_async('patch:movies')
+    async def modify_movies(payload):
+        return await bulk_update(Movie, ('title', 'release_date'), validate_movie, filter_movies, MOVIE_FILTERS)
+
+    @app.route('/movies/bulk', methods=['DELETE'])
+    @requires_auth_async('delete:movies')
+    async def delete_movies(payload):
+        return await bulk_delete(Movie, 'total_movies', filter_movies, MOVIE_FILTERS, Casting.movie_id)
+
+    @app.route('/movies/<int:movie_id>', methods=['DELETE'])
+    @requires_auth_async('delete:movies')
+    async def delete_movie(payload, movie_id):
+        return await delete_row(Movie, movie_id, 'total_movies', Casting.movie_id)
+
+    @app.route('/movies/<int:movie_id>', methods=['PATCH'])
+    @requires_auth_async('patch:movies')
+    async def modify_movie(payload, movie_id):
+        return await modify_row(Movie, movie_id, ('title', 'release_date'), 'movie')
+
+    # Search
+
+    @app.route('/search')
+    @requires_auth_async(('get:actors', 'get:movies'))
+    async def search(payload):
+        async with Session() as session:
+            etag = await etag_for(session, 'actors', 'movies')
+            if not_modified(etag):
+                return with_etag(Response('', 304), etag)
+            query, limit = search_query(request.args)
+            rows, selects, next_cursor = search_page((await session.execute(query)).all(), limit)
+            found = {name: (await session.execute(select)).all() for name, select in selects.items()}
+
+        return with_etag(json_response({
+            "success": True,
+            "results": search_results(rows, found),
+            "next_cursor": next_cursor
+        }), etag)
+
+    def error_handler(code):
+        async def handler(error):
+            response = json_response({"success": False, "error": code, "message": ERRORS[code]}, code)
+            response.headers.update(retry_after(error))
+            return response
+        return handler
+
+    for code in ERRORS:
+        app.register_error_handler(code, error_handler(code))
+
+    @app.errorhandler(AuthError)
+    async def auth_error(ex):
+        return json_response(ex.error, ex.status_code)
+
+    return app
+
+
+def __getattr__(name):
+    # built on first use by uvicorn asgi:APP, like app.APP
+    if name == 'APP':
+        app = globals()['APP'] = create_asgi_app()
+        return app
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
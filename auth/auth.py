@@ -1,14 +1,107 @@
-import json
-from flask import request, _request_ctx_stack, abort
+import os
+from contextlib import nullcontext
+from flask import request, _request_ctx_stack, abort, current_app, has_app_context
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+
+from auth.jwks import JWKSStore
+from auth.token_cache import TokenCache
+from metrics import timed
+from ratelimit import current_rate_limiter
+from settings import flag, setting
 
 
 AUTH0_DOMAIN = 'dev-snrmzjux.us.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'film'
 
+# the public keys are loaded once and refreshed in the background, see jwks.py
+# JWKS_URL points it somewhere else, e.g. a file:// document for load tests
+jwks_store = JWKSStore(os.environ.get('JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'))
+
+# payloads of tokens that have already been verified, until they expire
+token_cache = TokenCache(maxsize=4096)
+
+
+'''
+Auth settings
+Which tokens an app accepts and where their signing keys come from. Each app
+holds an AuthSettings in app.extensions['auth'], built by make_auth_settings
+from its config, with the environment variable of the same name as fallback:
+
+    AUTH0_DOMAIN   the issuer is https://<AUTH0_DOMAIN>/
+    API_AUDIENCE   the expected aud claim
+    ALGORITHMS     list, or comma separated string, of accepted algorithms
+    JWKS_FILE      a JWKS document or PEM public key on disk, loaded when the
+                   app is created; the app then never needs the network
+    JWKS_URL       where to fetch the JWKS from instead
+    JWKS_KID       kid of the key in a PEM file, None to accept any kid
+    JWKS_PRELOAD   load the keys when the app is created (always on for
+                   JWKS_FILE); set with JWKS_REFRESH, requests never fetch
+    JWKS_REFRESH   refresh the keys in a daemon thread every JWKS_TTL
+                   seconds (default on for JWKS_URL, off for JWKS_FILE)
+
+Apps that set none of them share the module defaults above: jwks_store and
+token_cache. Outside an app the defaults apply as well.
+'''
+
+AUTH_CONFIG = ('AUTH0_DOMAIN', 'API_AUDIENCE', 'ALGORITHMS', 'JWKS_FILE', 'JWKS_URL',
+               'JWKS_KID', 'JWKS_PRELOAD', 'JWKS_REFRESH', 'JWKS_TTL')
+
+
+class AuthSettings:
+    def __init__(self, domain=AUTH0_DOMAIN, audience=API_AUDIENCE, algorithms=ALGORITHMS,
+                 jwks_store=None, token_cache=token_cache):
+        self.domain = domain
+        self.audience = audience
+        self.algorithms = list(algorithms)
+        self.issuer = 'https://{}/'.format(domain)
+        # None: the module's jwks_store, looked up on every use
+        self._jwks_store = jwks_store
+        self.token_cache = token_cache
+
+    @property
+    def jwks_store(self):
+        return self._jwks_store if self._jwks_store is not None else jwks_store
+
+    def init_app(self, app):
+        app.extensions['auth'] = self
+
+
+default_settings = AuthSettings()
+
+
+def make_auth_settings(config):
+    settings = {name: setting(config, name) for name in AUTH_CONFIG}
+    if all(value is None for value in settings.values()):
+        return default_settings
+
+    domain = settings['AUTH0_DOMAIN'] or AUTH0_DOMAIN
+    algorithms = settings['ALGORITHMS'] or ALGORITHMS
+    if isinstance(algorithms, str):
+        algorithms = [name.strip() for name in algorithms.split(',')]
+
+    store = None
+    if settings['JWKS_FILE'] or settings['JWKS_URL']:
+        from_file = bool(settings['JWKS_FILE'])
+        url = 'file://' + os.path.abspath(settings['JWKS_FILE']) if from_file else settings['JWKS_URL']
+        refresh = flag(settings['JWKS_REFRESH']) if settings['JWKS_REFRESH'] is not None else not from_file
+        preload = from_file or flag(settings['JWKS_PRELOAD'])
+        store = JWKSStore(url, ttl=float(settings['JWKS_TTL'] or 3600), background_refresh=refresh,
+                          fetch_on_request=not (preload and refresh), algorithm=algorithms[0],
+                          pem_kid=settings['JWKS_KID'])
+        if preload:
+            store.load()
+
+    # a token verified for one issuer or audience must not pass for another
+    return AuthSettings(domain, settings['API_AUDIENCE'] or API_AUDIENCE, algorithms, store, TokenCache(maxsize=4096))
+
+
+def current_settings():
+    if has_app_context():
+        return current_app.extensions.get('auth', default_settings)
+    return default_settings
+
 # AuthError Exception
 '''
 AuthError Exception
@@ -35,7 +128,10 @@ class AuthError(Exception):
 
 
 def get_token_auth_header():
-    auth = request.headers.get('Authorization', None)
+    return parse_auth_header(request.headers.get('Authorization', None))
+
+
+def parse_auth_header(auth):
     if not auth:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -82,7 +178,9 @@ def get_token_auth_header():
 def check_permissions(permission, payload):
     if 'permissions' not in payload:
         abort(400)
-    if permission not in payload['permissions']:
+    # a tuple of permissions requires all of them
+    required = permission if isinstance(permission, tuple) else (permission,)
+    if not all(p in payload['permissions'] for p in required):
         abort(403)
 
     # raise Exception('Not Implemented')
@@ -95,7 +193,7 @@ def check_permissions(permission, payload):
         token: a json web token (string)
 
     it should be an Auth0 token with key id (kid)
-    it should verify the token using Auth0 /.well-known/jwks.json
+    it should verify the token using Auth0 /.well-known/jwks.json (cached by jwks_store)
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
@@ -104,31 +202,21 @@ def check_permissions(permission, payload):
 '''
 
 
-def verify_decode_jwt(token):
-    # GET THE PUBLIC KEY FROM AUTH0
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+def verify_decode_jwt(token, settings=None):
+    settings = settings or current_settings()
 
     # GET THE DATA IN THE HEADER
     unverified_header = jwt.get_unverified_header(token)
 
     # CHOOSE OUR KEY
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    # GET THE PUBLIC KEY FROM AUTH0 (or from the in-process copy of it)
+    rsa_key = settings.jwks_store.get_verification_key(unverified_header['kid'])
 
     # Finally, verify!!!
     if rsa_key:
@@ -137,9 +225,9 @@ def verify_decode_jwt(token):
             payload = jwt.decode(
                 token,
                 rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                algorithms=settings.algorithms,
+                audience=settings.audience,
+                issuer=settings.issuer
             )
 
             return payload
@@ -173,6 +261,7 @@ def verify_decode_jwt(token):
 
     it should use the get_token_auth_header method to get the token
     it should use the verify_decode_jwt method to decode the jwt
+        (unless the same token was verified before and has not expired, see token_cache)
     it should use the check_permissions method validate claims and check the requested permission
     return the decorator which passes the decoded payload to the decorated method
 '''
@@ -182,9 +271,20 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            # the concurrency cap and the rate limits turn requests away before
+            # the view touches the database, see ratelimit.py
+            limiter = current_rate_limiter()
+            with limiter.admit() if limiter is not None else nullcontext():
+                with timed('auth'):
+                    settings = current_settings()
+                    token = get_token_auth_header()
+                    payload = settings.token_cache.get(token)
+                    if payload is None:
+                        payload = verify_decode_jwt(token, settings)
+                        settings.token_cache.put(token, payload)
+                    check_permissions(permission, payload)
+                    if limiter is not None:
+                        limiter.check(permission, payload)
+                return f(payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
@@ -0,0 +1,175 @@
+import json
+import os
+import threading
+import time
+from urllib.request import urlopen
+
+from jose import jwk
+
+
+'''
+JWKSStore
+Keeps the signing keys published at a JWKS url in memory so that verifying
+a token does not need a round trip to Auth0.
+
+    - the keys are fetched once, on first use, and indexed by their kid
+    - a daemon thread refetches them every `ttl` seconds
+    - a token signed with an unknown kid triggers an immediate refetch, at
+      most once every `min_refetch_interval` seconds
+    - if a fetch fails the last keys that were loaded keep being served
+    - each key is turned into a verification key object when it is loaded,
+      so verifying a token does not rebuild it from the JWK every time
+
+The url can be a file:// url, which is how the store is exercised offline,
+and the document can be a PEM public key instead of a JWKS. A PEM key has no
+kid of its own, so it is filed under `pem_kid`; left as None it verifies
+tokens with any kid.
+
+With fetch_on_request=False get_key never fetches: the keys have to be
+loaded up front (load()) and are only refreshed by the background thread,
+so a request never waits on the network and a token with a new kid is only
+accepted after the next refresh.
+'''
+
+
+class JWKSStore:
+    def __init__(self, url, ttl=3600, min_refetch_interval=60, timeout=5,
+                 background_refresh=True, fetch_on_request=True, algorithm='RS256', pem_kid=None):
+        self.url = url
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self.background_refresh = background_refresh
+        self.fetch_on_request = fetch_on_request
+        self.algorithm = algorithm
+        self.pem_kid = pem_kid
+
+        self._keys = {}
+        self._loaded_at = None
+        self._last_fetch = None
+        self._fetch_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._refresher = None
+        self._refresher_pid = None
+
+    def fetch(self):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            data = response.read()
+        if data.lstrip().startswith(b'-----BEGIN'):
+            key = jwk.construct(data, self.algorithm).public_key().to_dict()
+            return {'keys': [dict(key, kid=self.pem_kid)]}
+        return json.loads(data)
+
+    @staticmethod
+    def parse(jwks):
+        keys = {}
+        for key in jwks.get('keys', []):
+            if key.get('kty') != 'RSA' or 'kid' not in key:
+                continue
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key.get('use', 'sig'),
+                'n': key['n'],
+                'e': key['e']
+            }
+            if 'alg' in key:
+                keys[key['kid']]['alg'] = key['alg']
+        return keys
+
+    def refresh(self):
+        # returns False, and keeps the previous keys, if the fetch fails
+        self._last_fetch = time.monotonic()
+        try:
+            # kid -> (JWK, verification key), swapped in as a whole
+            keys = {kid: (key, jwk.construct(key, key.get('alg', self.algorithm)))
+                    for kid, key in self.parse(self.fetch()).items()}
+        except Exception as e:
+            print('Unable to refresh JWKS from {}: {}'.format(self.url, e))
+            return False
+
+        self._keys = keys
+        self._loaded_at = time.monotonic()
+        return True
+
+    def load(self):
+        '''Loads the keys now, at startup, and raises if they cannot be loaded.'''
+        with self._fetch_lock:
+            if not self.refresh():
+                raise RuntimeError('Unable to load JWKS from {}'.format(self.url))
+        if self.background_refresh:
+            self.start()
+
+    @property
+    def kids(self):
+        return set(self._keys)
+
+    def get_key(self, kid):
+        '''The JWK for kid, or None'''
+        entry = self._entry(kid)
+        return entry[0] if entry is not None else None
+
+    def get_verification_key(self, kid):
+        '''The key object for kid that jwt.decode verifies with, or None'''
+        entry = self._entry(kid)
+        return entry[1] if entry is not None else None
+
+    def _entry(self, kid):
+        if self.fetch_on_request:
+            if self._loaded_at is None:
+                self._refetch(rate_limited=self._last_fetch is not None)
+            elif not self.background_refresh and self._is_stale():
+                self._refetch(rate_limited=False)
+
+        if self.background_refresh:
+            self.start()
+
+        entry = self._keys.get(kid)
+        if entry is None and self.fetch_on_request:
+            self._refetch(rate_limited=True)
+            entry = self._keys.get(kid)
+        if entry is None:
+            # a PEM key loaded without a kid
+            entry = self._keys.get(None)
+        return entry
+
+    def _is_stale(self):
+        return time.monotonic() - self._loaded_at >= self.ttl
+
+    def _refetch(self, rate_limited):
+        last_fetch = self._last_fetch
+        with self._fetch_lock:
+            # another thread fetched while we were waiting for the lock
+            if self._last_fetch != last_fetch:
+                return
+            if rate_limited and self._last_fetch is not None and \
+                    time.monotonic() - self._last_fetch < self.min_refetch_interval:
+                return
+            self.refresh()
+
+    def start(self):
+        # threads do not survive a fork, so a gunicorn worker forked from a
+        # preloaded master starts its own refresher here
+        if self._refresher is not None and self._refresher.is_alive() \
+                and self._refresher_pid == os.getpid():
+            return
+        with self._fetch_lock:
+            if self._refresher is not None and self._refresher.is_alive() \
+                    and self._refresher_pid == os.getpid():
+                return
+            self._stop.clear()
+            self._refresher = threading.Thread(
+                target=self._run, name='jwks-refresher', daemon=True)
+            self._refresher_pid = os.getpid()
+            self._refresher.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._refresher is not None and self._refresher.is_alive():
+            self._refresher.join(timeout=self.timeout)
+        self._refresher = None
+
+    def _run(self):
+        while not self._stop.wait(self.ttl):
+            with self._fetch_lock:
+                self.refresh()
@@ -0,0 +1,61 @@
+import base64
+import json
+import time
+
+import rsa
+from jose import jwt
+
+from auth.auth import AUTH0_DOMAIN, API_AUDIENCE
+
+
+'''
+Helpers to run the API without Auth0: generate an RSA key locally, publish
+it as a JWKS document and mint tokens signed with it.
+'''
+
+
+def _b64(number):
+    data = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def generate_key(kid='local-test-key', bits=1024):
+    public_key, private_key = rsa.newkeys(bits)
+    return {
+        'kid': kid,
+        'private_pem': private_key.save_pkcs1().decode('ascii'),
+        'public_pem': public_key.save_pkcs1().decode('ascii'),
+        'jwk': {
+            'kty': 'RSA',
+            'kid': kid,
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': _b64(public_key.n),
+            'e': _b64(public_key.e)
+        }
+    }
+
+
+def jwks_document(*keys):
+    return {'keys': [key['jwk'] for key in keys]}
+
+
+def write_jwks(path, *keys):
+    with open(path, 'w') as f:
+        json.dump(jwks_document(*keys), f)
+    return 'file://' + path
+
+
+def mint_token(key, permissions=(), expires_in=3600, **claims):
+    now = int(time.time())
+    payload = {
+        'iss': f'https://{AUTH0_DOMAIN}/',
+        'sub': 'auth0|local-test-user',
+        'aud': API_AUDIENCE,
+        'iat': now,
+        'exp': now + expires_in,
+        'permissions': list(permissions)
+    }
+    payload.update(claims)
+    return jwt.encode(payload, key['private_pem'], algorithm='RS256',
+                      headers={'kid': key['kid']})
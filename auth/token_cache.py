@@ -0,0 +1,75 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+'''
+TokenCache
+A bounded LRU of verified token payloads, so a bearer token that has already
+been verified is not put through the RS256 signature check again.
+
+    - entries are keyed by the sha256 of the token, the token itself is not kept
+    - an entry is only returned while the token's exp is in the future, and
+      an expired one is dropped by the lookup that finds it
+    - a put at capacity evicts the least recently used entry in O(1)
+    - all access goes through a lock, so it is safe under threaded workers
+'''
+
+
+class TokenCache:
+    def __init__(self, maxsize=1024, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                exp, payload = entry
+                if self.clock() < exp:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return payload
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, token, payload):
+        exp = payload.get('exp')
+        if not isinstance(exp, (int, float)) or exp <= self.clock():
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (exp, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                # expired entries are dropped when get finds them
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,84 @@
+import argparse
+import json
+import os
+import shutil
+
+from auth.testing import generate_key, mint_token, write_jwks
+from benchmarks.common import ALL_PERMISSIONS, make_app, make_tmpdir, seed, temp_database
+from benchmarks.load import SERVERS, drive, serve, server_env
+
+
+'''
+The sync app (gunicorn app:APP) against the async one (uvicorn asgi:APP)
+under the same concurrent load.
+
+Both servers run in subprocesses on the same seeded database with a single
+worker each, and DATABASE_URL / JWKS_URL point them at it and at a locally
+published key. Every client thread opens a connection per request and picks
+one of: a page of /actors with a random min_age, a random /actors/<id>, or a
+PATCH of a random actor, so most GETs miss the response cache.
+
+    python -m benchmarks.bench_async --concurrency 1 8 32 --requests 2000
+'''
+
+
+def next_request(rng, actors, write_ratio):
+    if rng.random() < write_ratio:
+        return 'PATCH', '/actors/{}'.format(rng.randint(1, actors)), json.dumps({'name': 'Renamed'})
+    if rng.random() < 0.5:
+        return 'GET', '/actors?limit=20&min_age={}'.format(rng.randint(20, 69)), None
+    return 'GET', '/actors/{}'.format(rng.randint(1, actors)), None
+
+
+def run(modes, concurrency_levels, requests, actors, workers, write_ratio):
+    tmpdir = make_tmpdir()
+    key = generate_key()
+    token = mint_token(key, ALL_PERMISSIONS)
+    jwks_url = write_jwks(os.path.join(tmpdir, 'jwks.json'), key)
+    results = []
+
+    try:
+        database_file = temp_database(tmpdir)
+        make_app(database_file)
+        seed(database_file, actors=actors)
+
+        env = server_env(database_file, jwks_url)
+        headers = {'Authorization': 'Bearer {}'.format(token), 'Content-Type': 'application/json'}
+        for mode in modes:
+            with serve(mode, env, workers) as port:
+                for concurrency in concurrency_levels:
+                    result = drive(port, concurrency, requests,
+                                   lambda rng: next_request(rng, actors, write_ratio), headers)
+                    results.append(dict(result, mode=mode, concurrency=concurrency))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--modes', nargs='+', choices=sorted(SERVERS), default=['sync', 'async'])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--write-ratio', type=float, default=0.1)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    results = run(args.modes, args.concurrency, args.requests, args.actors, args.workers, args.write_ratio)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print('{:>6} {:>11} {:>10} {:>10} {:>10} {:>10} {:>7}'.format(
+        'mode', 'concurrency', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+    for result in results:
+        print('{:>6} {:>11} {:>10.1f} {:>10.2f} {:>10.2f} {:>10.2f} {:>7}'.format(
+            result['mode'], result['concurrency'], result['requests_per_s'],
+            result['p50_ms'], result['p95_ms'], result['p99_ms'], result['errors']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import argparse
+import json
+import shutil
+import time
+
+from benchmarks.common import local_token, make_app, make_tmpdir, seed, temp_database
+
+
+'''
+Changing many rows one request at a time against one bulk request.
+
+For each count the app re-tags that many actors with PATCH /actors/<id>,
+one request and one commit per row, then with a single PATCH /actors/bulk,
+and deletes them the same two ways. Most of the difference is one commit
+per row; run with DATABASE_PROFILE=production to see it with WAL commits.
+
+    python -m benchmarks.bench_bulk_changes --counts 10 100 1000
+'''
+
+
+def timed_requests(client, requests, headers):
+    start = time.perf_counter()
+    for method, path, body in requests:
+        res = client.open(path, method=method, json=body, headers=headers)
+        assert res.status_code == 200, res.data
+    return (time.perf_counter() - start) * 1000
+
+
+def run(counts, actors):
+    tmpdir = make_tmpdir()
+    headers = {'Authorization': 'Bearer {}'.format(local_token(tmpdir))}
+    results = []
+
+    try:
+        for count in counts:
+            database_file = temp_database(tmpdir)
+            app = make_app(database_file)
+            seed(database_file, actors=max(actors, 4 * count))
+            client = app.test_client()
+
+            # single-row routes on the first count actors, bulk ones on the next count
+            single, bulk = list(range(1, count + 1)), list(range(count + 1, 2 * count + 1))
+            result = {
+                'rows': count,
+                'patch_single_ms': timed_requests(client, [
+                    ('PATCH', '/actors/{}'.format(actor_id), {'gender': 'other'}) for actor_id in single], headers),
+                'patch_bulk_ms': timed_requests(client, [
+                    ('PATCH', '/actors/bulk', {'ids': bulk, 'changes': {'gender': 'other'}})], headers),
+                'delete_single_ms': timed_requests(client, [
+                    ('DELETE', '/actors/{}'.format(actor_id), None) for actor_id in single], headers),
+                'delete_bulk_ms': timed_requests(client, [
+                    ('DELETE', '/actors/bulk', {'ids': bulk})], headers)
+            }
+            results.append(result)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--counts', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--actors', type=int, default=10000, help='rows in the table')
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    results = run(args.counts, args.actors)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print('{:>6} {:>16} {:>14} {:>17} {:>15}'.format(
+        'rows', 'PATCH x1 row ms', 'PATCH bulk ms', 'DELETE x1 row ms', 'DELETE bulk ms'))
+    for result in results:
+        print('{:>6} {:>16.1f} {:>14.1f} {:>17.1f} {:>15.1f}'.format(
+            result['rows'], result['patch_single_ms'], result['patch_bulk_ms'],
+            result['delete_single_ms'], result['delete_bulk_ms']))
+
+
+if __name__ == '__main__':
+    main()
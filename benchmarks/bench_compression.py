@@ -0,0 +1,128 @@
+import argparse
+import json
+import os
+import shutil
+import time
+
+from auth.testing import generate_key, mint_token, write_jwks
+from benchmarks.common import ALL_PERMISSIONS, make_app, make_tmpdir, seed, temp_database
+from benchmarks.load import drive, send, serve, server_env
+from compression import ENCODERS
+
+
+'''
+CPU spent compressing responses against the bytes it saves.
+
+First the codecs alone: the bodies of a few representative GETs, taken from
+the app, compressed with gzip at levels 1, 6 and 9 (and brotli at 1, 5 and 11
+when it is installed), best of --repeat runs each. Then one gunicorn worker
+serving GET /actors?limit=200 to clients that accept gzip, with compression
+off, with it on but COMPRESSION_CACHE_SIZE=0 (every response compressed
+anew) and with it on as by default, where an unchanged list is compressed
+once per ETag.
+
+    python -m benchmarks.bench_compression --actors 1000 --requests 2000
+'''
+
+PATHS = ('/actors?limit=20', '/actors?limit=200', '/movies?include=cast', '/search?q=actor')
+
+LEVELS = {'gzip': (1, 6, 9), 'br': (1, 5, 11)}
+
+MODES = {
+    'off': {'COMPRESSION': 'false'},
+    'uncached': {'COMPRESSION_CACHE_SIZE': '0'},
+    'cached': {}
+}
+
+
+def best_time(encode, body, level, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        encode(body, level)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_codecs(found, repeat):
+    results = []
+    for path, body in found.items():
+        for encoding, encode in ENCODERS.items():
+            for level in LEVELS[encoding]:
+                size = len(encode(body, level))
+                elapsed = best_time(encode, body, level, repeat)
+                results.append({'path': path, 'encoding': encoding, 'level': level, 'bytes': len(body),
+                                'compressed_bytes': size, 'ratio': len(body) / size, 'ms': elapsed * 1000,
+                                'mb_per_s': len(body) / elapsed / 10 ** 6})
+    return results
+
+
+def run_server(database_file, jwks_url, token, concurrency, requests):
+    headers = {'Authorization': 'Bearer {}'.format(token), 'Accept-Encoding': 'gzip'}
+    results = []
+    for mode, extra in MODES.items():
+        env = server_env(database_file, jwks_url, **extra)
+        with serve('sync', env) as port:
+            status, data = send(port, 'GET', '/actors?limit=200', headers=headers)
+            result = drive(port, concurrency, requests, lambda rng: ('GET', '/actors?limit=200', None), headers)
+        results.append(dict(result, mode=mode, bytes=len(data)))
+    return results
+
+
+def run(actors, movies, repeat, concurrency, requests):
+    tmpdir = make_tmpdir()
+    key = generate_key()
+    token = mint_token(key, ALL_PERMISSIONS)
+    jwks_url = write_jwks(os.path.join(tmpdir, 'jwks.json'), key)
+
+    try:
+        database_file = temp_database(tmpdir)
+        make_app(database_file)
+        seed(database_file, actors=actors, movies=movies)
+        # identity bodies, as the server sends them before compressing
+        with serve('sync', server_env(database_file, jwks_url, COMPRESSION='false')) as port:
+            found = {}
+            for path in PATHS:
+                status, data = send(port, 'GET', path, headers={'Authorization': 'Bearer {}'.format(token)})
+                if status == 200:
+                    found[path] = data
+        results = {'codecs': run_codecs(found, repeat),
+                   'server': run_server(database_file, jwks_url, token, concurrency, requests)}
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--movies', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=20, help='best of this many runs per codec')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    results = run(args.actors, args.movies, args.repeat, args.concurrency, args.requests)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print('{:>24} {:>8} {:>5} {:>8} {:>10} {:>6} {:>8} {:>7}'.format(
+        'path', 'encoding', 'level', 'bytes', 'compressed', 'ratio', 'ms', 'MB/s'))
+    for result in results['codecs']:
+        print('{:>24} {:>8} {:>5} {:>8} {:>10} {:>6.1f} {:>8.3f} {:>7.1f}'.format(
+            result['path'], result['encoding'], result['level'], result['bytes'],
+            result['compressed_bytes'], result['ratio'], result['ms'], result['mb_per_s']))
+    print()
+    print('{:>9} {:>8} {:>10} {:>8} {:>8} {:>7}'.format('mode', 'bytes', 'requests/s', 'p50 ms', 'p99 ms', 'errors'))
+    for result in results['server']:
+        print('{:>9} {:>8} {:>10.1f} {:>8.2f} {:>8.2f} {:>7}'.format(
+            result['mode'], result['bytes'], result['requests_per_s'],
+            result['p50_ms'], result['p99_ms'], result['errors']))
+
+
+if __name__ == '__main__':
+    main()
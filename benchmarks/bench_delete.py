@@ -0,0 +1,75 @@
+import argparse
+import json
+import shutil
+import time
+
+from models import Actor, db
+from benchmarks.common import local_token, make_app, make_tmpdir, seed, summarize, temp_database
+
+
+'''
+DELETE /actors/<id> latency as the table grows.
+
+The route reports the remaining row count with SELECT count(id), so its
+latency should stay flat across table sizes. The legacy column times the
+len(Actor.query.all()) the route used to run, for comparison.
+
+    python -m benchmarks.bench_delete --sizes 1000 10000 100000
+'''
+
+
+def run(sizes, deletes):
+    tmpdir = make_tmpdir()
+    token = local_token(tmpdir)
+    headers = {'Authorization': 'Bearer {}'.format(token)}
+    results = []
+
+    try:
+        for size in sizes:
+            database_file = temp_database(tmpdir)
+            app = make_app(database_file)
+            seed(database_file, actors=size)
+            client = app.test_client()
+
+            samples = []
+            for actor_id in range(1, deletes + 1):
+                start = time.perf_counter()
+                res = client.delete('/actors/{}'.format(actor_id), headers=headers)
+                samples.append(time.perf_counter() - start)
+                assert res.status_code == 200, res.data
+
+            with app.app_context():
+                start = time.perf_counter()
+                len(Actor.query.all())
+                legacy = time.perf_counter() - start
+                db.session.remove()
+
+            result = {'table_size': size, 'delete': summarize(samples), 'legacy_count_ms': legacy * 1000}
+            results.append(result)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--deletes', type=int, default=200)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.deletes)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print('{:>10} {:>10} {:>10} {:>10} {:>16}'.format('rows', 'mean ms', 'p95 ms', 'p99 ms', 'legacy count ms'))
+    for result in results:
+        delete = result['delete']
+        print('{:>10} {:>10.2f} {:>10.2f} {:>10.2f} {:>16.2f}'.format(
+            result['table_size'], delete['mean_ms'], delete['p95_ms'], delete['p99_ms'], result['legacy_count_ms']))
+
+
+if __name__ == '__main__':
+    main()
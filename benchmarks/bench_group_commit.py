@@ -0,0 +1,85 @@
+import argparse
+import json
+import os
+import shutil
+
+from auth.testing import generate_key, mint_token, write_jwks
+from benchmarks.common import ALL_PERMISSIONS, make_app, make_tmpdir, temp_database
+from benchmarks.load import drive, serve, server_env
+
+
+'''
+POST /actors throughput with a commit per row against group commit.
+
+One gunicorn worker with --threads, so several requests are in flight in the
+process at once (with one thread per worker there is never a second row to
+group with), serves a stream of POST /actors from each --concurrency level
+of client threads, once as it does by default and once with GROUP_COMMIT
+on. The default engine profile syncs the disk on every commit; with
+--profile production (WAL, synchronous=NORMAL) commits are cheaper and
+grouping them gains less.
+
+    python -m benchmarks.bench_group_commit --concurrency 1 8 32 --requests 2000
+'''
+
+MODES = {
+    'per_row': {},
+    'group': {'GROUP_COMMIT': 'true'}
+}
+
+
+def next_request(rng):
+    body = {'name': 'Actor {}'.format(rng.randint(0, 10 ** 6)), 'age': rng.randint(20, 69), 'gender': 'female'}
+    return 'POST', '/actors', json.dumps(body)
+
+
+def run(modes, concurrency_levels, requests, threads, profile, max_delay):
+    tmpdir = make_tmpdir()
+    key = generate_key()
+    token = mint_token(key, ALL_PERMISSIONS)
+    jwks_url = write_jwks(os.path.join(tmpdir, 'jwks.json'), key)
+    headers = {'Authorization': 'Bearer {}'.format(token), 'Content-Type': 'application/json'}
+    results = []
+
+    try:
+        for mode in modes:
+            for concurrency in concurrency_levels:
+                database_file = temp_database(tmpdir)
+                make_app(database_file)
+                env = server_env(database_file, jwks_url, DATABASE_PROFILE=profile,
+                                 GROUP_COMMIT_MAX_DELAY=str(max_delay), **MODES[mode])
+                with serve('sync', env, extra_args=['--threads', str(threads)]) as port:
+                    result = drive(port, concurrency, requests, next_request, headers)
+                results.append(dict(result, mode=mode, concurrency=concurrency))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--modes', nargs='+', choices=sorted(MODES), default=['per_row', 'group'])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=32, help='gunicorn threads in the worker')
+    parser.add_argument('--profile', choices=['default', 'production'], default='default')
+    parser.add_argument('--max-delay', type=float, default=0.002, help='GROUP_COMMIT_MAX_DELAY in seconds')
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    results = run(args.modes, args.concurrency, args.requests, args.threads, args.profile, args.max_delay)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print('{:>8} {:>11} {:>10} {:>10} {:>10} {:>10} {:>7}'.format(
+        'mode', 'concurrency', 'inserts/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+    for result in results:
+        print('{:>8} {:>11} {:>10.1f} {:>10.2f} {:>10.2f} {:>10.2f} {:>7}'.format(
+            result['mode'], result['concurrency'], result['requests_per_s'],
+            result['p50_ms'], result['p95_ms'], result['p99_ms'], result['errors']))
+
+
+if __name__ == '__main__':
+    main()
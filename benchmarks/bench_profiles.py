@@ -0,0 +1,98 @@
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+
+from auth.testing import generate_key, mint_token, write_jwks
+from gunicorn_conf import make_settings, profile_settings
+from benchmarks.bench_routes import make_routes
+from benchmarks.common import ALL_PERMISSIONS, make_app, make_tmpdir, seed, temp_database
+from benchmarks.load import drive, serve, server_env
+
+
+'''
+The gunicorn_conf.py profiles against each other on the existing routes.
+
+Each profile serves a freshly seeded database with the settings it ships
+with (worker count from the cores of this machine, unless --workers is set)
+and every --routes entry is driven at every --concurrency level, as
+bench_routes does. A profile whose worker class is not installed (gevent
+without `pip install gevent`) is reported and skipped.
+
+    python -m benchmarks.bench_profiles --concurrency 1 8 32 --requests 500
+'''
+
+PROFILES = list(profile_settings(1, 1, 1))
+
+ROUTES = ['GET /actors', 'GET /actors/<id>', 'GET /search', 'POST /actors', 'PATCH /actors/<id>']
+
+WORKER_MODULES = {'gevent': 'gevent', 'async': 'uvicorn'}
+
+
+def available(profile):
+    module = WORKER_MODULES.get(profile)
+    return module is None or importlib.util.find_spec(module) is not None
+
+
+def run(profiles, concurrency_levels, requests, routes, size, workers):
+    tmpdir = make_tmpdir()
+    key = generate_key()
+    headers = {'Authorization': 'Bearer {}'.format(mint_token(key, ALL_PERMISSIONS)),
+               'Content-Type': 'application/json'}
+    jwks_url = write_jwks(os.path.join(tmpdir, 'jwks.json'), key)
+    results = []
+    skipped = []
+
+    try:
+        for profile in profiles:
+            if not available(profile):
+                skipped.append(profile)
+                continue
+            settings = make_settings({'GUNICORN_PROFILE': profile})
+            database_file = temp_database(tmpdir)
+            make_app(database_file)
+            seed(database_file, actors=size, movies=size)
+            next_requests = make_routes(size)
+
+            with serve('config', server_env(database_file, jwks_url, GUNICORN_PROFILE=profile), workers) as port:
+                for concurrency in concurrency_levels:
+                    for seed_value, route in enumerate(routes):
+                        result = drive(port, concurrency, requests, next_requests[route][1], headers, seed=seed_value)
+                        results.append(dict(result, profile=profile, route=route, concurrency=concurrency,
+                                            workers=workers or settings['workers'],
+                                            threads=settings.get('threads', 1)))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profiles', nargs='+', choices=PROFILES, default=PROFILES)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=500, help='requests per route and concurrency level')
+    parser.add_argument('--routes', nargs='+', choices=list(make_routes(2)), default=ROUTES, metavar='ROUTE')
+    parser.add_argument('--size', type=int, default=10000, help='actors and movies in the database')
+    parser.add_argument('--workers', type=int, help='override the worker count of every profile')
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    results, skipped = run(args.profiles, args.concurrency, args.requests, args.routes, args.size, args.workers)
+    if args.json:
+        print(json.dumps({'results': results, 'skipped': skipped}, indent=2))
+        return
+
+    print('{:>8} {:>18} {:>8} {:>5} {:>9} {:>9} {:>9} {:>7}'.format(
+        'profile', 'route', 'workers', 'conc', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    for result in results:
+        print('{:>8} {:>18} {:>8} {:>5} {:>9.1f} {:>9.2f} {:>9.2f} {:>7}'.format(
+            result['profile'], result['route'], '{}x{}'.format(result['workers'], result['threads']),
+            result['concurrency'], result['requests_per_s'], result['p50_ms'], result['p99_ms'], result['errors']))
+    for profile in skipped:
+        print('{}: skipped, its worker class is not installed'.format(profile))
+
+
+if __name__ == '__main__':
+    main()
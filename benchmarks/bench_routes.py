@@ -0,0 +1,188 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+
+from auth.testing import generate_key, mint_token, write_jwks
+from serialization import BACKEND
+from benchmarks.common import ALL_PERMISSIONS, make_app, make_tmpdir, seed, temp_database
+from benchmarks.load import SERVERS, drive, serve, server_env
+
+
+'''
+Load test of every route, for catching throughput regressions.
+
+For each dataset size a fresh database is seeded with that many actors and
+movies and the app is started in a real server (gunicorn by default, uvicorn
+with --mode async) that verifies tokens against a locally published JWKS, so
+no Auth0 tokens or network are needed. Each route is then driven at every
+concurrency level and reported with p50/p95/p99 latency and requests/sec.
+
+Reads and updates pick ids in the lower half of the table and deletes walk
+down from the top, so no request hits a row another one removed. Exports
+send a fiftieth and bulk inserts a tenth of --requests, since each one moves
+far more rows.
+
+    python -m benchmarks.bench_routes --sizes 1000 100000 --concurrency 1 8 --output results.json
+    python -m benchmarks.bench_routes --compare results.json
+
+--compare exits with status 1 when a route's p95 rose or its requests/sec
+fell by more than --tolerance against the saved run.
+'''
+
+BULK_SIZE = 100
+
+
+def actor_body(rng):
+    return {'name': 'Actor {}'.format(rng.randint(0, 10 ** 6)), 'age': rng.randint(18, 90),
+            'gender': rng.choice(['female', 'male'])}
+
+
+def movie_body(rng):
+    return {'title': 'Movie {}'.format(rng.randint(0, 10 ** 6)), 'release_date': rng.randint(1900, 2030)}
+
+
+def make_routes(size):
+    '''name -> (share of --requests, next_request(rng))'''
+    reads = max(1, size // 2)
+    deleted = {'actors': itertools.count(), 'movies': itertools.count()}
+
+    def pick(rng):
+        return rng.randint(1, reads)
+
+    def delete(table):
+        # itertools.count is safe to share between the client threads
+        return lambda rng: ('DELETE', '/{}/{}'.format(table, size - next(deleted[table])), None)
+
+    return {
+        'GET /actors': (1, lambda rng: ('GET', '/actors?limit=50&min_age={}'.format(rng.randint(20, 69)), None)),
+        'GET /actors/<id>': (1, lambda rng: ('GET', '/actors/{}'.format(pick(rng)), None)),
+        'GET /actors/export': (0.02, lambda rng: ('GET', '/actors/export', None)),
+        'POST /actors': (1, lambda rng: ('POST', '/actors', json.dumps(actor_body(rng)))),
+        'POST /actors/bulk': (0.1, lambda rng: ('POST', '/actors/bulk', json.dumps(
+            {'actors': [actor_body(rng) for i in range(BULK_SIZE)]}))),
+        'PATCH /actors/<id>': (1, lambda rng: ('PATCH', '/actors/{}'.format(pick(rng)), json.dumps({'name': 'Renamed'}))),
+        'DELETE /actors/<id>': (1, delete('actors')),
+        'GET /movies': (1, lambda rng: ('GET', '/movies?limit=50&min_release_date={}'.format(rng.randint(1950, 2019)), None)),
+        'GET /movies/<id>': (1, lambda rng: ('GET', '/movies/{}'.format(pick(rng)), None)),
+        'GET /movies/export': (0.02, lambda rng: ('GET', '/movies/export', None)),
+        'POST /movies': (1, lambda rng: ('POST', '/movies', json.dumps(movie_body(rng)))),
+        'POST /movies/bulk': (0.1, lambda rng: ('POST', '/movies/bulk', json.dumps(
+            {'movies': [movie_body(rng) for i in range(BULK_SIZE)]}))),
+        'PATCH /movies/<id>': (1, lambda rng: ('PATCH', '/movies/{}'.format(pick(rng)), json.dumps({'title': 'Renamed'}))),
+        'DELETE /movies/<id>': (1, delete('movies')),
+        # seeded names are "Actor <n>" and "Movie <n>", so a number is a selective query
+        'GET /search': (1, lambda rng: ('GET', '/search?q={}&limit=20'.format(rng.randint(0, size - 1)), None)),
+    }
+
+
+ROUTES = list(make_routes(2))
+
+
+def run(sizes, concurrency_levels, requests, routes=ROUTES, mode='sync', workers=1):
+    tmpdir = make_tmpdir()
+    key = generate_key()
+    headers = {'Authorization': 'Bearer {}'.format(mint_token(key, ALL_PERMISSIONS)),
+               'Content-Type': 'application/json'}
+    jwks_url = write_jwks(os.path.join(tmpdir, 'jwks.json'), key)
+    results = []
+
+    try:
+        for size in sizes:
+            deletes = requests * len(concurrency_levels)
+            if any(route.startswith('DELETE') for route in routes) and deletes > size - size // 2:
+                raise ValueError('{} rows are too few to delete {} of them'.format(size, deletes))
+
+            database_file = temp_database(tmpdir)
+            make_app(database_file)
+            seed(database_file, actors=size, movies=size)
+            available = make_routes(size)
+
+            with serve(mode, server_env(database_file, jwks_url), workers) as port:
+                for concurrency in concurrency_levels:
+                    for seed_value, route in enumerate(routes):
+                        share, next_request = available[route]
+                        count = max(concurrency, int(requests * share))
+                        result = drive(port, concurrency, count, next_request, headers, seed=seed_value)
+                        results.append(dict(result, route=route, size=size, concurrency=concurrency))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''Returns a line for every result that regressed against the baseline.'''
+    previous = {(r['route'], r['size'], r['concurrency']): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get((result['route'], result['size'], result['concurrency']))
+        if before is None:
+            continue
+        if result['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append('{route} size={size} concurrency={concurrency}: p95 {0:.2f} -> {1:.2f} ms'.format(
+                before['p95_ms'], result['p95_ms'], **result))
+        if result['requests_per_s'] < before['requests_per_s'] * (1 - tolerance):
+            regressions.append('{route} size={size} concurrency={concurrency}: {0:.1f} -> {1:.1f} req/s'.format(
+                before['requests_per_s'], result['requests_per_s'], **result))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--requests', type=int, default=200, help='requests per route and concurrency level')
+    parser.add_argument('--routes', nargs='+', choices=ROUTES, default=ROUTES, metavar='ROUTE')
+    parser.add_argument('--mode', choices=sorted(SERVERS), default='sync')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    parser.add_argument('--output', help='also write the machine-readable results to this file')
+    parser.add_argument('--compare', help='results file of an earlier run to check against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    try:
+        results = run(args.sizes, args.concurrency, args.requests, args.routes, args.mode, args.workers)
+    except ValueError as e:
+        parser.error(str(e))
+
+    report = {
+        'meta': {
+            'mode': args.mode,
+            'workers': args.workers,
+            'requests': args.requests,
+            'serializer': BACKEND,
+            'python': platform.python_version(),
+            'platform': platform.platform()
+        },
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print('{:<22} {:>7} {:>5} {:>9} {:>9} {:>9} {:>9} {:>7}'.format(
+            'route', 'rows', 'conc', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+        for result in results:
+            print('{:<22} {:>7} {:>5} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>7}'.format(
+                result['route'], result['size'], result['concurrency'], result['requests_per_s'],
+                result['p50_ms'], result['p95_ms'], result['p99_ms'], result['errors']))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print('REGRESSION ' + line, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import argparse
+import json
+import shutil
+import time
+
+from flask import jsonify
+
+from models import Actor, db
+from serialization import BACKENDS, column_names, records
+from benchmarks.common import make_app, make_tmpdir, seed, temp_database
+
+
+'''
+Rows per second through the list serialization pipeline, from the query to
+the encoded body.
+
+    orm     - Actor.query.all(), a dict built per instance, then jsonify
+              (what get_actors used to do)
+    <name>  - column tuples from Actor.columns(), encoded with that backend
+              of serialization.py (orjson when installed, and stdlib)
+
+Each pipeline runs --repeat times per table size and the best run counts.
+
+    python -m benchmarks.bench_serialize --sizes 10000 100000
+'''
+
+
+def orm_pipeline():
+    actors = Actor.query.order_by(Actor.id).all()
+    data = [{'id': actor.id, 'name': actor.name, 'age': actor.age, 'gender': actor.gender} for actor in actors]
+    return jsonify({'success': True, 'actors': data}).get_data()
+
+
+def column_pipeline(dumps):
+    def pipeline():
+        columns = Actor.columns()
+        rows = db.session.query(*columns).order_by(Actor.id).all()
+        return dumps({'success': True, 'actors': records(column_names(columns), rows)})
+    return pipeline
+
+
+def best_time(pipeline, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        pipeline()
+        elapsed = time.perf_counter() - start
+        # start every run from an empty session, like a new request would
+        db.session.remove()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(sizes, repeat):
+    tmpdir = make_tmpdir()
+    pipelines = [('orm', orm_pipeline)] + [(name, column_pipeline(dumps)) for name, dumps in sorted(BACKENDS.items())]
+    results = []
+
+    try:
+        for size in sizes:
+            database_file = temp_database(tmpdir)
+            app = make_app(database_file)
+            seed(database_file, actors=size)
+
+            with app.app_context():
+                for name, pipeline in pipelines:
+                    elapsed = best_time(pipeline, repeat)
+                    results.append({'rows': size, 'pipeline': name, 'seconds': elapsed, 'rows_per_s': size / elapsed})
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print('{:>8} {:>10} {:>10} {:>12}'.format('rows', 'pipeline', 'ms', 'rows/s'))
+    for result in results:
+        print('{:>8} {:>10} {:>10.1f} {:>12.0f}'.format(
+            result['rows'], result['pipeline'], result['seconds'] * 1000, result['rows_per_s']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+from auth.testing import generate_key, mint_token, write_jwks
+from benchmarks.common import ALL_PERMISSIONS, make_app, make_tmpdir, seed, temp_database
+from benchmarks.load import ROOT, SERVERS, free_port, send, server_env
+
+
+'''
+How long the app takes to come up.
+
+Each run starts a fresh interpreter that imports app, builds the app with
+create_app() and answers its first and second GET /actors, once as the app
+boots now and once also running db.create_all() as every boot used to. Then
+real servers from spawn to the first 200 response: gunicorn with and without
+--preload at each --workers count, and uvicorn. All of them share one
+migrated, seeded database (DATABASE_URL) and a locally published key
+(JWKS_URL).
+
+    python -m benchmarks.bench_startup --runs 5 --workers 1 4
+'''
+
+# run in a fresh interpreter, so the import is timed from scratch
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+if sys.argv[2] == 'create_all':
+    from models import db
+    with application.app_context():
+        db.create_all()
+built = time.perf_counter()
+client = application.test_client()
+headers = {'Authorization': 'Bearer ' + sys.argv[1]}
+assert client.get('/actors', headers=headers).status_code == 200
+first = time.perf_counter()
+assert client.get('/actors', headers=headers).status_code == 200
+second = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'build_ms': (built - imported) * 1000,
+    'first_request_ms': (first - built) * 1000,
+    'next_request_ms': (second - first) * 1000
+}))
+'''
+
+BOOTS = ('migrations', 'create_all')
+PHASES = ('import_ms', 'build_ms', 'first_request_ms', 'next_request_ms')
+
+
+def boot_in_process(env, token, boot):
+    out = subprocess.run([sys.executable, '-c', CHILD, token, boot], cwd=ROOT, env=env,
+                         check=True, capture_output=True, text=True).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+def boot_server(command, port, env, headers, timeout=60):
+    # spawn to the first 200, polling more often than load.wait_until_up
+    start = time.perf_counter()
+    server = subprocess.Popen(command, cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                status, _ = send(port, 'GET', '/actors', headers=headers)
+                if status == 200:
+                    return (time.perf_counter() - start) * 1000
+            except OSError:
+                pass
+            time.sleep(0.01)
+        raise RuntimeError('{} did not answer within {}s'.format(command[2], timeout))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def servers(workers_counts):
+    for workers in workers_counts:
+        yield 'gunicorn', workers, False
+        yield 'gunicorn', workers, True
+        yield 'uvicorn', workers, False
+
+
+def run(runs, workers_counts, actors):
+    tmpdir = make_tmpdir()
+    key = generate_key()
+    token = mint_token(key, ALL_PERMISSIONS)
+    jwks_url = write_jwks(os.path.join(tmpdir, 'jwks.json'), key)
+    headers = {'Authorization': 'Bearer {}'.format(token)}
+    results = {'in_process': [], 'servers': []}
+
+    try:
+        database_file = temp_database(tmpdir)
+        make_app(database_file)
+        seed(database_file, actors=actors)
+        env = server_env(database_file, jwks_url)
+
+        for boot in BOOTS:
+            samples = [boot_in_process(env, token, boot) for _ in range(runs)]
+            results['in_process'].append(dict(
+                {phase: statistics.median(sample[phase] for sample in samples) for phase in PHASES},
+                boot=boot))
+
+        for server, workers, preload in servers(workers_counts):
+            samples = []
+            for _ in range(runs):
+                port = free_port()
+                command = SERVERS['sync' if server == 'gunicorn' else 'async'](port, workers)
+                samples.append(boot_server(command + (['--preload'] if preload else []), port, env, headers))
+            results['servers'].append({'server': server, 'workers': workers, 'preload': preload,
+                                       'first_response_ms': statistics.median(samples)})
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5, help='median of this many boots')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--actors', type=int, default=1000, help='rows in the table')
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    results = run(args.runs, args.workers, args.actors)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print('{:>11} {:>10} {:>9} {:>17} {:>16}'.format(
+        'boot', 'import ms', 'build ms', 'first request ms', 'next request ms'))
+    for result in results['in_process']:
+        print('{:>11} {:>10.1f} {:>9.1f} {:>17.1f} {:>16.1f}'.format(
+            result['boot'], result['import_ms'], result['build_ms'],
+            result['first_request_ms'], result['next_request_ms']))
+    print()
+    print('{:>9} {:>8} {:>8} {:>18}'.format('server', 'workers', 'preload', 'first response ms'))
+    for result in results['servers']:
+        print('{:>9} {:>8} {:>8} {:>18.1f}'.format(
+            result['server'], result['workers'], 'yes' if result['preload'] else 'no',
+            result['first_response_ms']))
+
+
+if __name__ == '__main__':
+    main()
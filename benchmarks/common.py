@@ -0,0 +1,79 @@
+import os
+import sqlite3
+import statistics
+import tempfile
+
+from app import create_app
+from models import setup_db, upgrade_db
+from auth import auth
+from auth.jwks import JWKSStore
+from auth.testing import generate_key, mint_token, write_jwks
+
+
+'''
+Shared setup for the benchmarks: a throwaway SQLite database, an app bound to
+it and tokens signed by a locally generated key, so nothing talks to Auth0.
+'''
+
+ALL_PERMISSIONS = [
+    'get:actors', 'post:actors', 'patch:actors', 'delete:actors',
+    'get:movies', 'post:movies', 'patch:movies', 'delete:movies'
+]
+
+
+def local_token(tmpdir, permissions=ALL_PERMISSIONS):
+    key = generate_key()
+    url = write_jwks(os.path.join(tmpdir, 'jwks.json'), key)
+    auth.jwks_store = JWKSStore(url, background_refresh=False)
+    return mint_token(key, permissions)
+
+
+def make_app(database_file):
+    # a new database gets its schema from the migrations, as on a deploy
+    app = create_app()
+    setup_db(app, 'sqlite:///' + database_file)
+    upgrade_db(app)
+    return app
+
+
+def temp_database(tmpdir, name='bench.db'):
+    path = os.path.join(tmpdir, name)
+    if os.path.exists(path):
+        os.remove(path)
+    return path
+
+
+def seed(database_file, actors=0, movies=0):
+    con = sqlite3.connect(database_file)
+    with con:
+        con.executemany(
+            "INSERT INTO actors (name, age, gender) VALUES (?,?,?)",
+            (('Actor {}'.format(i), 20 + i % 50, 'female' if i % 2 else 'male') for i in range(actors)))
+        con.executemany(
+            "INSERT INTO movies (title, release_date) VALUES (?,?)",
+            (('Movie {}'.format(i), 1950 + i % 70) for i in range(movies)))
+        for table in ('actors', 'movies'):
+            con.execute("UPDATE table_stats SET row_count = (SELECT count(*) FROM {0}), version = version + 1 "
+                        "WHERE table_name = '{0}'".format(table))
+    con.close()
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    # samples are in seconds, the summary is in milliseconds
+    return {
+        'count': len(samples),
+        'mean_ms': statistics.mean(samples) * 1000,
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p95_ms': percentile(samples, 95) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000
+    }
+
+
+def make_tmpdir():
+    return tempfile.mkdtemp(prefix='film-bench-')
@@ -0,0 +1,122 @@
+import http.client
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from benchmarks.common import summarize
+
+
+'''
+HTTP load generation for the benchmarks: start the app in a real server
+process, then send requests to it from a pool of client threads.
+
+    with serve('sync', env) as port:
+        result = drive(port, concurrency=8, requests=1000, next_request=...)
+
+next_request(rng) returns (method, path, body) for one request; each client
+thread gets its own seeded random.Random so runs are repeatable.
+'''
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    'sync': lambda port, workers: [
+        sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', '127.0.0.1:{}'.format(port), 'app:APP'],
+    'async': lambda port, workers: [
+        sys.executable, '-m', 'uvicorn', '--workers', str(workers), '--port', str(port),
+        '--log-level', 'warning', 'asgi:APP'],
+    # gunicorn_conf.py picks the app, worker class and worker count
+    'config': lambda port, workers: [
+        sys.executable, '-m', 'gunicorn', '-c', 'gunicorn_conf.py', '-b', '127.0.0.1:{}'.format(port)] + (
+        ['-w', str(workers)] if workers else [])
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            con = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            con.request('GET', '/')
+            con.getresponse().read()
+            con.close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server on port {} did not start'.format(port))
+
+
+def server_env(database_file, jwks_url, **extra):
+    # DATABASE_URL and JWKS_URL are read by models.py and auth/auth.py at import
+    return dict(os.environ, DATABASE_URL='sqlite:///' + database_file, JWKS_URL=jwks_url, **extra)
+
+
+@contextmanager
+def serve(mode, env, workers=1, extra_args=()):
+    port = free_port()
+    server = subprocess.Popen(SERVERS[mode](port, workers) + list(extra_args), cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(port)
+        yield port
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def send(port, method, path, body=None, headers=None):
+    # one connection per request, the way gunicorn's sync worker serves them
+    con = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        con.request(method, path, body=body, headers=headers or {})
+        res = con.getresponse()
+        return res.status, res.read()
+    finally:
+        con.close()
+
+
+def drive(port, concurrency, requests, next_request, headers=None, seed=0):
+    samples = []
+    statuses = {}
+    lock = threading.Lock()
+    per_thread = max(1, requests // concurrency)
+
+    def client(n):
+        rng = random.Random(seed * 1000 + n)
+        mine = []
+        codes = {}
+        for i in range(per_thread):
+            method, path, body = next_request(rng)
+            start = time.perf_counter()
+            status, data = send(port, method, path, body, headers)
+            mine.append(time.perf_counter() - start)
+            codes[status] = codes.get(status, 0) + 1
+        with lock:
+            samples.extend(mine)
+            for status, count in codes.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    result = summarize(samples)
+    result['requests_per_s'] = len(samples) / elapsed
+    result['errors'] = sum(count for status, count in statuses.items() if status >= 400)
+    result['statuses'] = {str(status): count for status, count in sorted(statuses.items())}
+    return result
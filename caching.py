@@ -0,0 +1,240 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, current_app, has_app_context, request, make_response
+
+from models import table_versions, write_listeners
+from settings import SharedSQLite
+
+
+'''
+Conditional GETs
+A read route decorated with @conditional('actors') gets an ETag built from
+the version of the tables it reads (see TableStats in models.py) and the
+request path. When the client already holds that ETag the route answers
+304 Not Modified without querying or serializing any rows.
+
+The versions are read before the route runs, so a write landing in between
+can only make the ETag older than the body, which costs the client one extra
+full response on its next poll but never hides a change.
+
+Response cache
+When the app has a ResponseCache, the body of a 200 response is stored under
+its ETag. The next request for the same path gets it back without touching
+the route, as long as none of the tables it reads have changed. Since the
+versions are part of the key, a stale body can never be served, even by a
+worker that missed an invalidation; invalidation just frees the entries of a
+table as soon as a write to it commits.
+'''
+
+
+class LRUBackend:
+    '''In-process backend, one per worker.'''
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[1]
+            return None
+
+    def set(self, key, tables, value):
+        with self._lock:
+            self._entries[key] = (tables, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, table):
+        with self._lock:
+            keys = [key for key, (tables, value) in self._entries.items() if table in tables]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    '''
+    Backend in a local SQLite file, shared by every worker on the host.
+
+    Eviction is approximately LRU: a hit writes its entry's last use back
+    only when the stored one is over touch_interval seconds old, so a hot
+    entry costs one write per interval rather than one per request, and
+    the hits of every worker do not queue on the file's write lock.
+    '''
+
+    def __init__(self, path, maxsize=1024, timeout=5, touch_interval=60):
+        self.file = SharedSQLite(path, timeout)
+        self.maxsize = maxsize
+        self.touch_interval = touch_interval
+        self.evictions = 0
+        with self.file.connection() as con:
+            con.execute('CREATE TABLE IF NOT EXISTS response_cache ('
+                        'key TEXT PRIMARY KEY, tables TEXT NOT NULL, status INTEGER, '
+                        'mimetype TEXT, body BLOB, used REAL)')
+            con.execute('CREATE INDEX IF NOT EXISTS ix_response_cache_used ON response_cache (used)')
+
+    def get(self, key):
+        con = self.file.connection()
+        row = con.execute('SELECT status, mimetype, body, used FROM response_cache WHERE key = ?',
+                          (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[3] >= self.touch_interval:
+            with con:
+                con.execute('UPDATE response_cache SET used = ? WHERE key = ?', (now, key))
+        return row[0], row[1], bytes(row[2])
+
+    def set(self, key, tables, value):
+        status, mimetype, body = value
+        con = self.file.connection()
+        with con:
+            con.execute('INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?, ?)',
+                        (key, ',{},'.format(','.join(tables)), status, mimetype, body, time.time()))
+            excess = con.execute('SELECT count(*) FROM response_cache').fetchone()[0] - self.maxsize
+            if excess > 0:
+                con.execute('DELETE FROM response_cache WHERE key IN '
+                            '(SELECT key FROM response_cache ORDER BY used LIMIT ?)', (excess,))
+                self.evictions += excess
+
+    def invalidate(self, table):
+        con = self.file.connection()
+        with con:
+            return con.execute('DELETE FROM response_cache WHERE tables LIKE ?',
+                               ('%,{},%'.format(table),)).rowcount
+
+    def __len__(self):
+        return self.file.connection().execute('SELECT count(*) FROM response_cache').fetchone()[0]
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.extensions['response_cache'] = self
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, tables, response):
+        self.backend.set(key, tables, (response.status_code, response.mimetype, response.get_data()))
+
+    def invalidate(self, table):
+        removed = self.backend.invalidate(table)
+        with self._lock:
+            self.invalidations += removed
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__,
+            'size': len(self.backend),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'evictions': self.backend.evictions,
+            'invalidations': self.invalidations
+        }
+
+
+def make_response_cache(config):
+    '''
+    RESPONSE_CACHE: 'memory' (default), 'sqlite' or None to disable
+    RESPONSE_CACHE_SIZE: number of responses to keep
+    RESPONSE_CACHE_PATH: file for the 'sqlite' backend
+    RESPONSE_CACHE_TOUCH_INTERVAL: seconds between the 'sqlite' backend's
+        updates of an entry's last use on a hit (default 60)
+    '''
+    kind = config.get('RESPONSE_CACHE', 'memory')
+    size = config.get('RESPONSE_CACHE_SIZE', 256)
+    if not kind:
+        return None
+    if kind == 'memory':
+        return ResponseCache(LRUBackend(size))
+    if kind == 'sqlite':
+        return ResponseCache(SQLiteBackend(config.get('RESPONSE_CACHE_PATH', 'response_cache.db'), size,
+                                           touch_interval=config.get('RESPONSE_CACHE_TOUCH_INTERVAL', 60)))
+    raise ValueError('Unknown RESPONSE_CACHE backend {!r}'.format(kind))
+
+
+def invalidate_response_cache(table):
+    if has_app_context():
+        cache = current_app.extensions.get('response_cache')
+        if cache is not None:
+            cache.invalidate(table)
+
+
+write_listeners.append(invalidate_response_cache)
+
+
+def make_etag(path, tables, versions):
+    if None in versions:
+        return None
+    tag = ';'.join('{}.{}'.format(table, version) for table, version in zip(tables, versions))
+    return hashlib.sha1('{}|{}'.format(path, tag).encode('utf-8')).hexdigest()
+
+
+def version_etag(tables):
+    return make_etag(request.full_path, tables, table_versions(*tables))
+
+
+def conditional(*tables, includes=None):
+    '''
+    tables: what the route reads
+    includes: {value of ?include=: more tables the route then reads}
+    '''
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            read = tables + (includes or {}).get(request.args.get('include'), ())
+            etag = version_etag(read)
+            cache = current_app.extensions.get('response_cache') if etag is not None else None
+
+            if etag is not None and request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+            elif cache is not None:
+                cached = cache.get(etag)
+                if cached is not None:
+                    status, mimetype, body = cached
+                    response = Response(body, status=status, mimetype=mimetype)
+                    response.headers['X-Cache'] = 'HIT'
+                else:
+                    response = make_response(f(*args, **kwargs))
+                    if response.status_code == 200 and not response.is_streamed:
+                        cache.set(etag, read, response)
+                    response.headers['X-Cache'] = 'MISS'
+            else:
+                response = make_response(f(*args, **kwargs))
+
+            if etag is not None and response.status_code in (200, 304):
+                response.set_etag(etag)
+                response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return conditional_decorator
@@ -0,0 +1,105 @@
+import gzip
+import threading
+
+from flask import request
+
+from caching import LRUBackend
+from settings import flag, setting
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+'''
+Compression
+A response of COMPRESSION_MIN_SIZE bytes or more goes out gzip or brotli
+encoded when the client accepts it (brotli only when the brotli package is
+installed, and preferred when the client takes both equally). Streamed
+responses, like the NDJSON exports, are left alone.
+
+A response with an ETag (the @conditional routes, see caching.py) is the same
+bytes until its tables change, so its compressed body is kept in an LRU keyed
+by the ETag and the encoding: an unchanged list is compressed once, not on
+every request, and a hit in the response cache skips both the query and the
+compression. The ETag of a compressed response is sent weak, as the bytes
+differ from the identity response; If-None-Match compares ETags weakly, so
+either one still gets a 304.
+'''
+
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'text/plain')
+
+
+def _gzip(body, level):
+    # mtime=0 so the same body always compresses to the same bytes
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+def _brotli(body, level):
+    return brotli.compress(body, quality=level)
+
+
+# in order of preference
+ENCODERS = {'gzip': _gzip}
+if brotli is not None:
+    ENCODERS = {'br': _brotli, 'gzip': _gzip}
+
+
+class Compression:
+    def __init__(self, min_size=1024, levels=None, cache_size=256):
+        self.min_size = min_size
+        self.levels = dict({'br': 5, 'gzip': 6}, **(levels or {}))
+        self.cache = LRUBackend(cache_size) if cache_size else None
+        self.compressed = 0
+        self.cache_hits = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.extensions['compression'] = self
+        app.after_request(self.compress)
+
+    def compress(self, response):
+        if response.mimetype not in COMPRESSIBLE or response.is_streamed or response.direct_passthrough:
+            return response
+        response.vary.add('Accept-Encoding')
+        if response.status_code != 200 or 'Content-Encoding' in response.headers:
+            return response
+        encoding = request.accept_encodings.best_match(list(ENCODERS))
+        if encoding is None or len(response.get_data()) < self.min_size:
+            return response
+
+        etag, weak = response.get_etag()
+        key = '{}|{}'.format(etag, encoding) if etag is not None and self.cache is not None else None
+        body = self.cache.get(key) if key is not None else None
+        if body is None:
+            body = ENCODERS[encoding](response.get_data(), self.levels[encoding])
+            if key is not None:
+                self.cache.set(key, (), body)
+            with self._lock:
+                self.compressed += 1
+        else:
+            with self._lock:
+                self.cache_hits += 1
+
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        if etag is not None:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+def make_compression(config):
+    '''
+    COMPRESSION: set to False to send every response uncompressed
+    COMPRESSION_MIN_SIZE: smallest body in bytes worth compressing
+    COMPRESSION_LEVELS: {'gzip': 1-9, 'br': 0-11} over the defaults 6 and 5
+    COMPRESSION_CACHE_SIZE: compressed bodies kept per worker, 0 to
+                            compress every response anew
+    Each falls back to the environment variable of the same name, apart from
+    COMPRESSION_LEVELS.
+    '''
+    if not flag(setting(config, 'COMPRESSION', True)):
+        return None
+    return Compression(int(setting(config, 'COMPRESSION_MIN_SIZE', 1024)), config.get('COMPRESSION_LEVELS'),
+                       int(setting(config, 'COMPRESSION_CACHE_SIZE', 256)))
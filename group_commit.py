@@ -0,0 +1,168 @@
+import os
+import queue
+import threading
+import time
+
+from models import db, insert_rows
+from settings import flag, setting
+
+
+'''
+Group commit
+Every POST /actors and POST /movies normally commits its own row, so inserts
+per second are capped by how fast the disk syncs a commit. With GROUP_COMMIT
+on, the routes hand their row to a WriteQueue instead, and one writer thread
+per process commits the queued rows together: it takes up to
+GROUP_COMMIT_MAX_ROWS of them, waiting at most GROUP_COMMIT_MAX_DELAY
+seconds after the first for more to arrive, inserts them with insert_rows()
+and commits once. Each request waits until the transaction holding its row
+has committed, then gets the row's id, so a response still means the row
+is on disk.
+
+If a batch fails, its rows are retried in a transaction each, so a bad row
+fails only its own request. A request that has waited GROUP_COMMIT_TIMEOUT
+seconds withdraws its row if the writer has not taken it yet, and fails; once
+the writer has it, the request waits for the commit instead. Either way a
+failed request means its row was not written, so retrying it cannot make a
+duplicate.
+'''
+
+
+class PendingRow:
+    def __init__(self, model, values):
+        self.model = model
+        self.values = values
+        self.id = None
+        self.error = None
+        self.done = threading.Event()
+        # set under WriteQueue._lock: taken by the writer, or withdrawn
+        self.claimed = False
+        self.cancelled = False
+
+
+class WriteQueue:
+    def __init__(self, max_rows=100, max_delay=0.005, timeout=10.0):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.app = None
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._writer = None
+        self._writer_pid = None
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['write_queue'] = self
+
+    def insert(self, model, values):
+        # blocks until the row is committed and returns its id
+        pending = PendingRow(model, values)
+        self.start()
+        self._queue.put(pending)
+        if not pending.done.wait(self.timeout):
+            with self._lock:
+                pending.cancelled = not pending.claimed
+            if pending.cancelled:
+                raise TimeoutError('row was not committed within {} seconds'.format(self.timeout))
+            # the writer is committing it, so only its outcome is a safe answer
+            pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.id
+
+    def start(self):
+        # threads do not survive a fork, so a gunicorn worker forked from a
+        # preloaded master starts its own writer here
+        if self._writer is not None and self._writer.is_alive() and self._writer_pid == os.getpid():
+            return
+        with self._lock:
+            if self._writer is not None and self._writer.is_alive() and self._writer_pid == os.getpid():
+                return
+            self._writer = threading.Thread(target=self._run, name='group-commit', daemon=True)
+            self._writer_pid = os.getpid()
+            self._writer.start()
+
+    def stop(self):
+        # commits what is queued, then ends the writer
+        if self._writer is not None and self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout=self.timeout)
+        self._writer = None
+
+    def _run(self):
+        with self.app.app_context():
+            running = True
+            while running:
+                batch, running = self._next_batch()
+                if batch:
+                    self.commit(batch)
+                db.session.remove()
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return [], False
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_rows:
+            try:
+                pending = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if pending is None:
+                return batch, False
+            batch.append(pending)
+        return batch, True
+
+    def claim(self, batch):
+        # the rows of the batch whose requests are still waiting
+        with self._lock:
+            batch = [pending for pending in batch if not pending.cancelled]
+            for pending in batch:
+                pending.claimed = True
+        return batch
+
+    def commit(self, batch):
+        batch = self.claim(batch)
+        if not batch:
+            return
+        try:
+            self.write(batch)
+        except Exception as e:
+            print(e)
+            db.session.rollback()
+            for pending in batch:
+                try:
+                    self.write([pending])
+                except Exception as e:
+                    db.session.rollback()
+                    pending.id, pending.error = None, e
+        for pending in batch:
+            pending.done.set()
+
+    def write(self, batch):
+        # one transaction for the batch, one insert_rows() per table in it
+        tables = {}
+        for pending in batch:
+            tables.setdefault(pending.model, []).append(pending)
+        for model, rows in tables.items():
+            ids = insert_rows(model, [pending.values for pending in rows])
+            for pending, row_id in zip(rows, ids):
+                pending.id = row_id
+        db.session.commit()
+
+
+def make_write_queue(config):
+    '''
+    GROUP_COMMIT: set to True to commit POSTed rows in groups, see above
+    GROUP_COMMIT_MAX_ROWS: most rows in one transaction
+    GROUP_COMMIT_MAX_DELAY: seconds the writer waits for more rows after the first
+    GROUP_COMMIT_TIMEOUT: seconds a request waits for its commit before failing
+    Each falls back to the environment variable of the same name.
+    '''
+    if not flag(setting(config, 'GROUP_COMMIT', False)):
+        return None
+    return WriteQueue(int(setting(config, 'GROUP_COMMIT_MAX_ROWS', 100)),
+                      float(setting(config, 'GROUP_COMMIT_MAX_DELAY', 0.005)),
+                      float(setting(config, 'GROUP_COMMIT_TIMEOUT', 10.0)))
@@ -0,0 +1,135 @@
+import multiprocessing
+import os
+import tempfile
+
+from metrics import clear_snapshots, fold_snapshot
+
+
+'''
+Gunicorn settings
+Serve with `gunicorn -c gunicorn_conf.py` and pick a profile with
+GUNICORN_PROFILE:
+
+- sync: one request per worker process at a time, 2 x cores + 1 workers. For
+  CPU-bound work (token signatures, JSON encoding, SQLite on a local disk),
+  where a request rarely waits on anything. Sync workers close every
+  connection after its response, so there is no keep-alive.
+- gthread (default): cores + 1 workers of GUNICORN_THREADS threads. A thread
+  waiting on Auth0 (a JWKS refresh) or on the database holds no process
+  back, and the threads of a worker share its group commit writer and its
+  MAX_CONCURRENT_REQUESTS cap.
+- gevent: cores + 1 workers with up to GUNICORN_WORKER_CONNECTIONS greenlets
+  each. Needs `pip install gevent`; sqlite3 does not yield to the hub, so it
+  pays off only with a network database.
+- async: the Quart app (asgi:APP) under one uvicorn worker per core.
+
+Every profile preloads the app in the master, so a worker is forked with it
+already imported (see bench_startup), and replaces a worker after
+max_requests requests, give or take max_requests_jitter so they do not all
+restart at once, which caps slow memory growth in a long-lived worker. A
+worker that gets SIGTERM has graceful_timeout seconds to finish its requests,
+less than the 30 seconds Heroku allows before SIGKILL, and flushes its
+metrics and group commit queue on the way out; the master then folds its
+metrics snapshot into the totals of the exited workers (see metrics.py).
+Unless METRICS_DIR is set, the workers share their metrics through a
+directory named after the port in the temporary directory, which the master
+empties when it starts.
+
+WEB_CONCURRENCY, GUNICORN_THREADS and PORT override the worker count, the
+threads and the port.
+'''
+
+DEFAULT_PROFILE = 'gthread'
+
+
+def profile_settings(cores, threads, worker_connections):
+    return {
+        'sync': {
+            'wsgi_app': 'app:APP',
+            'worker_class': 'sync',
+            'workers': 2 * cores + 1
+        },
+        'gthread': {
+            'wsgi_app': 'app:APP',
+            'worker_class': 'gthread',
+            'workers': cores + 1,
+            'threads': threads,
+            'keepalive': 5
+        },
+        'gevent': {
+            'wsgi_app': 'app:APP',
+            'worker_class': 'gevent',
+            'workers': cores + 1,
+            'worker_connections': worker_connections,
+            'keepalive': 5
+        },
+        'async': {
+            'wsgi_app': 'asgi:APP',
+            'worker_class': 'uvicorn.workers.UvicornWorker',
+            'workers': cores,
+            'keepalive': 5
+        }
+    }
+
+
+def make_settings(environ=os.environ, cores=None):
+    '''
+    The settings of the GUNICORN_PROFILE in environ, as gunicorn names them.
+    '''
+    cores = cores or multiprocessing.cpu_count()
+    name = environ.get('GUNICORN_PROFILE', DEFAULT_PROFILE)
+    profiles = profile_settings(cores, int(environ.get('GUNICORN_THREADS', 8)),
+                                int(environ.get('GUNICORN_WORKER_CONNECTIONS', 1000)))
+    if name not in profiles:
+        raise ValueError('Unknown GUNICORN_PROFILE {!r}, expected one of {}'.format(name, ', '.join(profiles)))
+
+    settings = {
+        'bind': '0.0.0.0:{}'.format(environ.get('PORT', 8000)),
+        'preload_app': True,
+        'max_requests': 1000,
+        'max_requests_jitter': 100,
+        'timeout': 30,
+        'graceful_timeout': 25
+    }
+    settings.update(profiles[name])
+    if environ.get('WEB_CONCURRENCY'):
+        settings['workers'] = int(environ['WEB_CONCURRENCY'])
+    if not environ.get('METRICS_DIR'):
+        # set in the master before the app is loaded, so /metrics covers every worker
+        directory = os.path.join(tempfile.gettempdir(), 'film-metrics-{}'.format(environ.get('PORT', 8000)))
+        settings['raw_env'] = ['METRICS_DIR={}'.format(directory)]
+    return settings
+
+
+def metrics_directory(server):
+    app = getattr(server.app, 'callable', None)
+    metrics = getattr(app, 'extensions', {}).get('metrics')
+    return metrics.directory if metrics is not None else os.environ.get('METRICS_DIR')
+
+
+def on_starting(server):
+    # the snapshots of the last run would be added to this one's
+    directory = metrics_directory(server)
+    if directory:
+        clear_snapshots(directory)
+
+
+def worker_exit(server, worker):
+    # whatever the worker still holds would be lost with the process; the
+    # master also calls this for a worker it reaped, which has no app
+    extensions = getattr(getattr(worker, 'wsgi', None), 'extensions', {})
+    if extensions.get('write_queue') is not None:
+        extensions['write_queue'].stop()
+    if extensions.get('metrics') is not None:
+        extensions['metrics'].flush(force=True)
+
+
+def child_exit(server, worker):
+    # in the master, once the worker is gone and its last snapshot written
+    directory = metrics_directory(server)
+    if directory:
+        fold_snapshot(directory, worker.pid)
+
+
+# gunicorn reads the settings from this module's globals
+globals().update(make_settings())
@@ -0,0 +1,329 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from settings import flag, setting
+
+
+'''
+Metrics
+Every request is timed from before_request to after_request and the time is
+split into phases:
+    auth      - reading the header and verifying the token (requires_auth)
+    db        - executing SQL, measured by the engine's cursor events
+    serialize - encoding the response body (json_response in app.py)
+    other     - whatever is left: routing, hooks, building the data
+The request count, latency histograms, phase histograms and the number of
+queries per request are exposed in the Prometheus text format at /metrics,
+to tokens with the get:metrics permission, or to anyone when METRICS_PUBLIC
+is set (for a scraper on a private network).
+
+Each gunicorn worker only sees its own requests, so when METRICS_DIR is set
+every worker writes a snapshot of its metrics to <METRICS_DIR>/<pid>.json at
+most every METRICS_FLUSH_INTERVAL seconds and /metrics adds up all the
+snapshots in the directory. When a worker exits, the gunicorn master adds its
+snapshot to <METRICS_DIR>/exited.json and deletes it (fold_snapshot, called
+from child_exit in gunicorn_conf.py). So the totals never go backwards, the
+directory holds one file per live worker however often max_requests replaces
+them, and a worker that is given a dead worker's pid starts a file of its
+own. gunicorn_conf.py sets a default METRICS_DIR and empties it when the
+server starts (clear_snapshots, called from on_starting). Without
+METRICS_DIR only the answering process is counted.
+
+Streamed responses (the exports) are timed up to the point where the body
+starts streaming.
+'''
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+PHASES = ('auth', 'db', 'serialize')
+
+HELP = {
+    'film_requests_total': ('counter', 'Requests by route, method and status code.'),
+    'film_request_duration_seconds': ('histogram', 'Time from before_request to after_request.'),
+    'film_request_phase_seconds': ('histogram', 'Time per request spent in auth, db, serialize and other.'),
+    'film_request_queries': ('histogram', 'SQL statements executed per request.')
+}
+
+
+def add_time(phase, seconds):
+    phases = g.setdefault('metrics_phases', {})
+    phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def timed(phase):
+    '''Adds the time spent in the block to the current request's phase.'''
+    if not has_request_context():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(phase, time.perf_counter() - start)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.metrics_start = time.perf_counter()
+
+
+# called with (statement, parameters, seconds, executemany) after every
+# statement, see profiler.py
+query_listeners = []
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, 'metrics_start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    if has_request_context():
+        add_time('db', elapsed)
+        g.metrics_queries = g.get('metrics_queries', 0) + 1
+    for listener in query_listeners:
+        listener(statement, parameters, elapsed, executemany)
+
+
+def _key(name, labels):
+    return json.dumps([name, sorted(labels.items())])
+
+
+def _merge(total, snapshot):
+    for key, value in snapshot['counters'].items():
+        total['counters'][key] = total['counters'].get(key, 0) + value
+    for key, histogram in snapshot['histograms'].items():
+        merged = total['histograms'].get(key)
+        if merged is None:
+            total['histograms'][key] = {'bounds': histogram['bounds'], 'buckets': list(histogram['buckets']),
+                                        'sum': histogram['sum'], 'count': histogram['count']}
+            continue
+        merged['buckets'] = [a + b for a, b in zip(merged['buckets'], histogram['buckets'])]
+        merged['sum'] += histogram['sum']
+        merged['count'] += histogram['count']
+    return total
+
+
+def _write(path, snapshot):
+    # readers see the old file or the new one, never half of one
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, path)
+
+
+EXITED = 'exited.json'
+
+
+def fold_snapshot(directory, pid):
+    '''
+    Adds the snapshot of worker pid, which has exited, to the totals in
+    exited.json and deletes it. Only the gunicorn master calls this, so there
+    is never a second fold running at the same time.
+    '''
+    path = os.path.join(directory, '{}.json'.format(pid))
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        # the worker never flushed
+        return
+    exited = os.path.join(directory, EXITED)
+    try:
+        with open(exited) as f:
+            total = json.load(f)
+    except FileNotFoundError:
+        total = {'counters': {}, 'histograms': {}}
+    _write(exited, _merge(total, snapshot))
+    os.remove(path)
+
+
+def clear_snapshots(directory):
+    '''Deletes the snapshots of an earlier run, before any worker starts.'''
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name.endswith('.json') or name.endswith('.json.tmp'):
+            os.remove(os.path.join(directory, name))
+
+
+def _labels(labels, **extra):
+    items = list(labels) + sorted(extra.items())
+    if not items:
+        return ''
+    escaped = ('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for k, v in items)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(snapshot):
+    '''Prometheus text exposition format, version 0.0.4'''
+    series = {}
+    for key, value in snapshot['counters'].items():
+        name, labels = json.loads(key)
+        series.setdefault(name, []).append((labels, value))
+    for key, histogram in snapshot['histograms'].items():
+        name, labels = json.loads(key)
+        series.setdefault(name, []).append((labels, histogram))
+
+    lines = []
+    for name in sorted(series):
+        kind, description = HELP[name]
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, value in sorted(series[name], key=lambda item: item[0]):
+            if kind == 'counter':
+                lines.append('{}{} {}'.format(name, _labels(labels), _number(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(list(value['bounds']) + [float('inf')], value['buckets']):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, _labels(labels, le=_number(bound)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels), _number(value['sum'])))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), value['count']))
+    return '\n'.join(lines) + '\n'
+
+
+class Metrics:
+    def __init__(self, directory=None, flush_interval=1.0, public=False):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.public = public
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._counters = {}
+        self._histograms = {}
+        self._flushed = 0.0
+        self._dirty = False
+
+    def init_app(self, app):
+        app.extensions['metrics'] = self
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+    def inc(self, name, labels, value=1):
+        key = _key(name, labels)
+        with self._lock:
+            self._check_pid()
+            self._counters[key] = self._counters.get(key, 0) + value
+            self._dirty = True
+
+    def observe(self, name, labels, value, bounds=LATENCY_BUCKETS):
+        key = _key(name, labels)
+        with self._lock:
+            self._check_pid()
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    'bounds': list(bounds), 'buckets': [0] * (len(bounds) + 1), 'sum': 0.0, 'count': 0}
+            index = len(bounds)
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    index = i
+                    break
+            histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+            self._dirty = True
+
+    def _check_pid(self):
+        # a worker forked from a process that already counted starts over
+        if self._pid != os.getpid():
+            self._reset()
+
+    def snapshot(self):
+        with self._lock:
+            self._check_pid()
+            return _merge({'counters': {}, 'histograms': {}},
+                          {'counters': self._counters, 'histograms': self._histograms})
+
+    def _path(self, pid):
+        return os.path.join(self.directory, '{}.json'.format(pid))
+
+    def flush(self, force=False):
+        if self.directory is None:
+            return
+        now = time.monotonic()
+        if not force and (not self._dirty or now - self._flushed < self.flush_interval):
+            return
+        _write(self._path(os.getpid()), self.snapshot())
+        self._flushed = now
+        self._dirty = False
+
+    def collect(self):
+        '''This process's metrics plus the last snapshot of every other worker.'''
+        total = self.snapshot()
+        if self.directory is None:
+            return total
+        own = '{}.json'.format(os.getpid())
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json') or name == own:
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    _merge(total, json.load(f))
+            except (OSError, ValueError) as e:
+                print(e)
+        return total
+
+    def start_request(self):
+        g.metrics_start = time.perf_counter()
+
+    def finish_request(self, response):
+        start = g.get('metrics_start')
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        # the rule rather than the path, so ids don't become label values
+        labels = {'method': request.method, 'route': request.url_rule.rule if request.url_rule else 'unmatched'}
+
+        self.inc('film_requests_total', dict(labels, status=str(response.status_code)))
+        self.observe('film_request_duration_seconds', labels, elapsed)
+        phases = g.get('metrics_phases', {})
+        for phase in PHASES:
+            self.observe('film_request_phase_seconds', dict(labels, phase=phase), phases.get(phase, 0.0))
+        self.observe('film_request_phase_seconds', dict(labels, phase='other'),
+                     max(0.0, elapsed - sum(phases.values())))
+        self.observe('film_request_queries', labels, g.get('metrics_queries', 0), QUERY_BUCKETS)
+
+        self.flush()
+        return response
+
+    def endpoint(self):
+        return Response(render(self.collect()), mimetype='text/plain; version=0.0.4')
+
+
+def make_metrics(config):
+    '''
+    METRICS: set to False to turn off the hooks and /metrics
+    METRICS_DIR: directory shared by the workers, see above
+    METRICS_FLUSH_INTERVAL: seconds between a worker's snapshots
+    METRICS_PUBLIC: serve /metrics without a token
+    '''
+    if not config.get('METRICS', True):
+        return None
+    directory = setting(config, 'METRICS_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return Metrics(directory, config.get('METRICS_FLUSH_INTERVAL', 1.0),
+                   flag(setting(config, 'METRICS_PUBLIC', False)))
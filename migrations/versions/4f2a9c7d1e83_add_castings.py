@@ -0,0 +1,46 @@
+"""add castings
+
+The actor-movie association behind /movies/<id>/actors, /actors/<id>/movies
+and ?include=cast, plus its table_stats row.
+
+Revision ID: 4f2a9c7d1e83
+Revises: 91e6150d8827
+Create Date: 2026-10-18 11:02:17.530914
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f2a9c7d1e83'
+down_revision = '91e6150d8827'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # a database built with db.create_all() already has it
+    if 'castings' not in sa.inspect(op.get_bind()).get_table_names():
+        op.create_table(
+            'castings',
+            sa.Column('movie_id', sa.Integer(), nullable=False),
+            sa.Column('actor_id', sa.Integer(), nullable=False),
+            sa.Column('role', sa.String(length=80), nullable=True),
+            sa.ForeignKeyConstraint(['actor_id'], ['actors.id'], ondelete='CASCADE'),
+            sa.ForeignKeyConstraint(['movie_id'], ['movies.id'], ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+        )
+        op.create_index(op.f('ix_castings_actor_id'), 'castings', ['actor_id'], unique=False)
+
+    op.execute(
+        "INSERT INTO table_stats (table_name, row_count, version) "
+        "SELECT 'castings', (SELECT count(*) FROM castings), 0 "
+        "WHERE NOT EXISTS (SELECT 1 FROM table_stats WHERE table_name = 'castings')"
+    )
+
+
+def downgrade():
+    op.execute("DELETE FROM table_stats WHERE table_name = 'castings'")
+    op.drop_index(op.f('ix_castings_actor_id'), table_name='castings')
+    op.drop_table('castings')
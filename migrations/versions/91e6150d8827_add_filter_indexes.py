@@ -0,0 +1,39 @@
+"""add filter indexes
+
+Indexes behind the filter and sort parameters of GET /actors and GET /movies.
+
+Revision ID: 91e6150d8827
+Revises: c83f4d857449
+Create Date: 2026-10-18 09:18:51.403517
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '91e6150d8827'
+down_revision = 'c83f4d857449'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_actors_name', 'actors', 'name'),
+    ('ix_actors_age', 'actors', 'age'),
+    ('ix_actors_gender', 'actors', 'gender'),
+    ('ix_movies_release_date', 'movies', 'release_date'),
+]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    for name, table, column in INDEXES:
+        # a database built with db.create_all() already has it
+        if name not in [index['name'] for index in inspector.get_indexes(table)]:
+            op.create_index(op.f(name), table, [column], unique=False)
+
+
+def downgrade():
+    for name, table, column in reversed(INDEXES):
+        op.drop_index(op.f(name), table_name=table)
@@ -0,0 +1,56 @@
+"""add search indexes
+
+FTS5 indexes over actors.name and movies.title behind GET /search, and the
+triggers that keep them up to date.
+
+Revision ID: b7e3d91c5a20
+Revises: 4f2a9c7d1e83
+Create Date: 2026-10-18 13:40:05.118262
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e3d91c5a20'
+down_revision = '4f2a9c7d1e83'
+branch_labels = None
+depends_on = None
+
+
+SEARCH_INDEXES = [
+    ('actors', 'name'),
+    ('movies', 'title'),
+]
+
+
+def index_ddl(table, column):
+    fts = table + '_fts'
+    remove = "INSERT INTO {0}({0}, rowid, {1}) VALUES ('delete', old.id, old.{1});".format(fts, column)
+    add = 'INSERT INTO {0}(rowid, {1}) VALUES (new.id, new.{1});'.format(fts, column)
+    return [
+        "CREATE VIRTUAL TABLE {} USING fts5({}, content='{}', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2', prefix='3')".format(fts, column, table),
+        'CREATE TRIGGER {0}_insert AFTER INSERT ON {1} BEGIN {2} END'.format(fts, table, add),
+        'CREATE TRIGGER {0}_delete AFTER DELETE ON {1} BEGIN {2} END'.format(fts, table, remove),
+        'CREATE TRIGGER {0}_update AFTER UPDATE OF {1} ON {2} BEGIN {3} {4} END'.format(
+            fts, column, table, remove, add),
+        "INSERT INTO {0}({0}) VALUES ('rebuild')".format(fts),
+    ]
+
+
+def upgrade():
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    for table, column in SEARCH_INDEXES:
+        # a database built with db.create_all() already has them
+        if table + '_fts' not in tables:
+            for statement in index_ddl(table, column):
+                op.execute(statement)
+
+
+def downgrade():
+    for table, column in reversed(SEARCH_INDEXES):
+        for trigger in ('insert', 'delete', 'update'):
+            op.execute('DROP TRIGGER IF EXISTS {}_fts_{}'.format(table, trigger))
+        op.execute('DROP TABLE IF EXISTS {}_fts'.format(table))
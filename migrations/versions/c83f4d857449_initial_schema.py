@@ -0,0 +1,68 @@
+"""initial schema
+
+Creates the tables that create_all() used to build at boot. Databases that
+already have them (like the film.db shipped with the repo) keep their data,
+only the missing tables are created.
+
+Revision ID: c83f4d857449
+Revises: 
+Create Date: 2026-10-18 09:18:49.383710
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c83f4d857449'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    tables = sa.inspect(op.get_bind()).get_table_names()
+
+    if 'actors' not in tables:
+        op.create_table(
+            'actors',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(length=80), nullable=False),
+            sa.Column('age', sa.Integer(), nullable=True),
+            sa.Column('gender', sa.String(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+    if 'movies' not in tables:
+        op.create_table(
+            'movies',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('title', sa.String(length=80), nullable=False),
+            sa.Column('release_date', sa.Integer(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+    if 'table_stats' not in tables:
+        op.create_table(
+            'table_stats',
+            sa.Column('table_name', sa.String(), nullable=False),
+            sa.Column('row_count', sa.Integer(), nullable=False),
+            sa.Column('version', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint('table_name')
+        )
+    elif 'version' not in [c['name'] for c in sa.inspect(op.get_bind()).get_columns('table_stats')]:
+        with op.batch_alter_table('table_stats') as batch_op:
+            batch_op.add_column(sa.Column('version', sa.Integer(), nullable=False, server_default='0'))
+
+    for table in ('actors', 'movies'):
+        op.execute(
+            "INSERT INTO table_stats (table_name, row_count, version) "
+            "SELECT '{0}', (SELECT count(*) FROM {0}), 0 "
+            "WHERE NOT EXISTS (SELECT 1 FROM table_stats WHERE table_name = '{0}')".format(table)
+        )
+
+
+def downgrade():
+    op.drop_table('table_stats')
+    op.drop_table('movies')
+    op.drop_table('actors')
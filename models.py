@@ -1,30 +1,425 @@
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Column, String, Integer, create_engine, exc, orm
+from sqlalchemy.pool import QueuePool
+from flask import abort, current_app, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from flask_migrate import Migrate, upgrade
+import itertools
 import json
+import os
 import sqlite3 as sql
+import time
 
+from settings import setting
 
-db = SQLAlchemy()
+
+'''
+Engine profiles
+setup_db picks a profile from its `profile` argument, the DATABASE_PROFILE
+config value or the DATABASE_PROFILE environment variable, in that order.
+
+    default     - what SQLAlchemy does out of the box
+    production  - for several gunicorn workers sharing one SQLite file:
+                  WAL so readers never wait for the writer, a busy timeout
+                  so writers queue instead of failing with "database is
+                  locked", a connection pool, and write requests that take
+                  the write lock up front with BEGIN IMMEDIATE
+
+SQLALCHEMY_ENGINE_OPTIONS and SQLITE_PRAGMAS in the app config override
+individual settings of the profile.
+'''
+
+ENGINE_PROFILES = {
+    'default': {
+        'pragmas': {},
+        'engine_options': {}
+    },
+    'production': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': 5000,
+            'mmap_size': 256 * 1024 * 1024,
+            'cache_size': -64 * 1024
+        },
+        'engine_options': {
+            'poolclass': QueuePool,
+            'pool_size': 5,
+            'max_overflow': 10,
+            'pool_timeout': 10,
+            'pool_pre_ping': True,
+            'pool_recycle': 3600,
+            'connect_args': {'timeout': 5, 'check_same_thread': False},
+            'sqlite_begin_immediate_for_writes': True
+        }
+    }
+}
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class ProfiledSQLAlchemy(SQLAlchemy):
+    '''Applies the engine options, SQLite pragmas and begin mode of the profile.'''
+
+    def apply_pool_defaults(self, app, options):
+        options = super().apply_pool_defaults(app, options)
+        settings = ENGINE_PROFILES[app.config.get('DATABASE_PROFILE', 'default')]
+        options.update(settings['engine_options'])
+        options['sqlite_pragmas'] = dict(settings['pragmas'], **app.config.get('SQLITE_PRAGMAS', {}))
+        return options
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop('sqlite_pragmas', None) or {}
+        immediate = engine_opts.pop('sqlite_begin_immediate_for_writes', False)
+        engine = super().create_engine(sa_url, engine_opts)
+
+        @db.event.listens_for(engine, 'connect')
+        def remember_pid(dbapi_connection, connection_record):
+            connection_record.info['pid'] = os.getpid()
+
+        @db.event.listens_for(engine, 'checkout')
+        def check_pid(dbapi_connection, connection_record, connection_proxy):
+            # a gunicorn worker forked from a preloaded master must not use the
+            # master's connections. Drop them without closing, closing from the
+            # child acts on file handles and sockets the master still uses,
+            # and let the pool open a new one
+            if connection_record.info['pid'] != os.getpid():
+                connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+                raise exc.DisconnectionError('connection was opened in process {}, not {}'.format(
+                    connection_record.info['pid'], os.getpid()))
+
+        if engine.dialect.name != 'sqlite':
+            return engine
+
+        @db.event.listens_for(engine, 'connect')
+        def on_connect(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute('PRAGMA {} = {}'.format(name, value))
+            cursor.close()
+            if immediate:
+                # let SQLAlchemy emit BEGIN instead of the sqlite3 module
+                dbapi_connection.isolation_level = None
+
+        if immediate:
+            @db.event.listens_for(engine, 'begin')
+            def on_begin(connection):
+                writing = has_request_context() and request.method not in READ_METHODS
+                connection.exec_driver_sql('BEGIN IMMEDIATE' if writing else 'BEGIN')
+
+        return engine
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class RoutingSession(SignallingSession):
+    '''Reads from a replica during read requests, see Read replicas below.'''
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        replicas = self.app.extensions.get('replicas')
+        if replicas is not None and self.reading(clause):
+            if 'replica' not in self.info:
+                self.info['replica'] = replicas.connect()
+            if self.info['replica'] is not None:
+                return self.info['replica']
+        return super().get_bind(mapper, clause)
+
+    def reading(self, clause):
+        return has_request_context() and request.method in READ_METHODS and not reads_primary() \
+            and not getattr(clause, 'is_dml', False) \
+            and not (self._flushing or self.new or self.dirty or self.deleted)
+
+    def close(self):
+        super().close()
+        replica = self.info.pop('replica', None)
+        if replica is not None:
+            replica.close()
+
+
+db = ProfiledSQLAlchemy()
+migrate = Migrate()
 
 # database_path = "postgres://{}/{}".format(database_uri, database_name)
-database_path = "sqlite:///film.db"
+database_path = os.environ.get("DATABASE_URL", "sqlite:///film.db")
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
 
+def setup_db(app, database_path=database_path, profile=None, replicas=None):
+    profile = profile or app.config.get('DATABASE_PROFILE') or os.environ.get('DATABASE_PROFILE', 'default')
+    if profile not in ENGINE_PROFILES:
+        raise ValueError('Unknown DATABASE_PROFILE {!r}'.format(profile))
 
-def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    setup_replicas(app, replicas)
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["DATABASE_PROFILE"] = profile
     db.app = app
     db.init_app(app)
-    db.create_all()
+    migrate.init_app(app, db, directory=MIGRATIONS_DIR, render_as_batch=True)
+
+
+'''
+Schema
+setup_db() only binds the app to its database, it does not touch it, so
+building the app (in every gunicorn worker, or once in a preloaded master)
+runs no DDL and opens no connection. The schema belongs to the migrations:
+`flask db upgrade` once per deploy, or upgrade_db() for the throwaway
+databases of the tests and benchmarks.
+'''
+
+
+def upgrade_db(app):
+    with app.app_context():
+        upgrade()
+
+
+'''
+Read replicas
+setup_db's `replicas` argument, the DATABASE_REPLICAS config value or the
+comma separated DATABASE_REPLICA_URLS environment variable list databases
+that hold a copy of the primary. During GET, HEAD and OPTIONS requests the
+session reads from them, one after the other; writes, anything read after a
+flush, and every request from a client that wrote in the last
+DATABASE_REPLICA_LAG seconds (default 2, tracked by the read_primary_until
+cookie so clients read their own writes) use the primary.
+
+Replica connections are query_only and look for table_stats when they open,
+so a replica that is down, missing or not migrated fails before it answers
+anything. It is then left alone for DATABASE_REPLICA_RETRY seconds (default
+30), and reads go to the next one, or to the primary once none is left;
+with DATABASE_REPLICA_FALLBACK = 'error' they get a 503 instead.
+'''
+
+REPLICA_FALLBACKS = ('primary', 'error')
+PRIMARY_COOKIE = 'read_primary_until'
+
+
+class Replicas:
+    def __init__(self, app, bind_keys, fallback='primary', retry=30.0, lag=2.0):
+        self.app = app
+        self.bind_keys = bind_keys
+        self.fallback = fallback
+        self.retry = retry
+        self.lag = lag
+        self._engines = {}
+        self._down = {}
+        self._next = itertools.count()
+
+    def engine(self, bind_key):
+        engine = self._engines.get(bind_key)
+        if engine is None:
+            engine = db.get_engine(self.app, bind_key)
+            db.event.listen(engine, 'connect', check_replica)
+            self._engines[bind_key] = engine
+        return engine
+
+    def connect(self):
+        # a connection to the next replica that is up, None to read from the primary
+        for _ in self.bind_keys:
+            bind_key = self.bind_keys[next(self._next) % len(self.bind_keys)]
+            if self._down.get(bind_key, 0) > time.monotonic():
+                continue
+            try:
+                return self.engine(bind_key).connect()
+            except Exception as e:
+                self.app.logger.warning('Replica %s is unavailable, skipping it for %s seconds: %s',
+                                        bind_key, self.retry, e)
+                self._down[bind_key] = time.monotonic() + self.retry
+        if self.fallback == 'error':
+            abort(503)
+        return None
+
+
+def check_replica(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('SELECT 1 FROM table_stats LIMIT 1')
+    if isinstance(dbapi_connection, sql.Connection):
+        cursor.execute('PRAGMA query_only = 1')
+    cursor.close()
+
+
+def setup_replicas(app, replicas=None):
+    if replicas is None:
+        replicas = app.config.get('DATABASE_REPLICAS') or \
+            [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+    fallback = setting(app.config, 'DATABASE_REPLICA_FALLBACK', 'primary')
+    if fallback not in REPLICA_FALLBACKS:
+        raise ValueError('Unknown DATABASE_REPLICA_FALLBACK {!r}'.format(fallback))
+
+    binds = {key: url for key, url in (app.config.get('SQLALCHEMY_BINDS') or {}).items()
+             if not key.startswith('replica_')}
+    binds.update(('replica_{}'.format(i), url) for i, url in enumerate(replicas))
+    app.config['SQLALCHEMY_BINDS'] = binds
+
+    if 'replicas' not in app.extensions:
+        app.after_request(remember_write)
+    app.extensions['replicas'] = Replicas(
+        app, ['replica_{}'.format(i) for i in range(len(replicas))], fallback,
+        float(setting(app.config, 'DATABASE_REPLICA_RETRY', 30)),
+        float(setting(app.config, 'DATABASE_REPLICA_LAG', 2))
+    ) if replicas else None
+
+
+def remember_write(response):
+    # the client reads from the primary until the replicas have its write
+    replicas = current_app.extensions['replicas']
+    if replicas is not None and request.method not in READ_METHODS and response.status_code < 400:
+        response.set_cookie(PRIMARY_COOKIE, str(time.time() + replicas.lag),
+                            max_age=int(replicas.lag) + 1, httponly=True, samesite='Lax')
+    return response
+
+
+def reads_primary():
+    try:
+        return float(request.cookies.get(PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+'''
+TableStats
+One row per table holding its row count and a version number. insert(),
+update() and delete() call record_write() in the same transaction as the
+write, so counting a table is a primary key lookup instead of a scan, and
+the version changes whenever the table does (in every worker process, since
+it lives in the database).
+'''
+
+
+class TableStats(db.Model):
+    __tablename__ = 'table_stats'
+
+    table_name = db.Column(db.String, primary_key=True)
+    row_count = db.Column(db.Integer, nullable=False, default=0)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+def record_write_statement(table_name, row_delta=0):
+    return (
+        TableStats.__table__.update()
+        .where(TableStats.table_name == table_name)
+        .values(row_count=TableStats.row_count + row_delta,
+                version=TableStats.version + 1)
+    )
+
+
+def record_write(table_name, row_delta=0):
+    db.session.execute(record_write_statement(table_name, row_delta))
+    db.session.info.setdefault('written_tables', set()).add(table_name)
+
+
+# called with a table name after every commit that wrote to that table
+write_listeners = []
+
+
+@db.event.listens_for(SignallingSession, 'after_commit')
+def notify_write_listeners(session):
+    for table_name in session.info.pop('written_tables', ()):
+        for listener in write_listeners:
+            listener(table_name)
+
+
+@db.event.listens_for(SignallingSession, 'after_rollback')
+def forget_written_tables(session):
+    session.info.pop('written_tables', None)
+
+
+def table_versions(*table_names):
+    rows = db.session.query(TableStats.table_name, TableStats.version).filter(
+        TableStats.table_name.in_(table_names)).all()
+    # None for a table that is not tracked, its version cannot be trusted
+    versions = dict(rows)
+    return [versions.get(name) for name in table_names]
+
+
+def row_count(model):
+    count = db.session.query(TableStats.row_count).filter(
+        TableStats.table_name == model.__tablename__).scalar()
+    if count is None:
+        # not tracked yet, fall back to counting the rows
+        count = db.session.query(db.func.count()).select_from(model).scalar()
+    return count
+
+
+BULK_BATCH_SIZE = 500
+
+
+def insert_rows(model, rows):
+    '''
+    Inserts a list of column dicts in the current transaction and returns the
+    new ids in the same order.
+    On SQLite that is one executemany per batch. The first batch takes the
+    write lock, which the transaction keeps until the commit, and SQLite hands
+    out rowids sequentially to the connection holding it, so the new ids are
+    the final max(id) counted backwards. No other database promises that, so
+    there each row is inserted on its own and its key read back.
+    '''
+    table = model.__table__
+    connection = db.session.connection(clause=table.insert())
+    if connection.dialect.name != 'sqlite':
+        ids = [db.session.execute(table.insert(), row).inserted_primary_key[0] for row in rows]
+        record_write(table.name, len(rows))
+        return ids
+
+    dbapi_connection = connection.connection.dbapi_connection
+    if dbapi_connection.isolation_level is None and not dbapi_connection.in_transaction:
+        # every batch would commit on its own and let other writers in between
+        raise RuntimeError('insert_rows on SQLite needs a transaction, the sqlite3 connection is in autocommit mode')
+    for start in range(0, len(rows), BULK_BATCH_SIZE):
+        db.session.execute(table.insert(), rows[start:start + BULK_BATCH_SIZE])
+    last_id = db.session.query(db.func.max(table.c.id)).scalar()
+    record_write(table.name, len(rows))
+    return list(range(last_id - len(rows) + 1, last_id + 1))
+
+
+def update_rows(model, clause, values):
+    '''
+    Sets values on every row matching clause with one UPDATE, in the current
+    transaction, and returns the number of rows it matched.
+    '''
+    updated = db.session.execute(model.__table__.update().where(clause).values(**values)).rowcount
+    if updated:
+        record_write(model.__tablename__)
+    return updated
+
+
+def delete_rows(model, clause, cast_column):
+    '''
+    Deletes every row matching clause, and their castings, with one DELETE
+    each, in the current transaction, and returns the number of rows deleted.
+    cast_column is the column of castings that points at model.
+    '''
+    delete_castings(cast_column.in_(db.select(model.id).where(clause)))
+    deleted = db.session.execute(model.__table__.delete().where(clause)).rowcount
+    if deleted:
+        record_write(model.__tablename__, -deleted)
+    return deleted
+
+
+def delete_castings_statement(clause):
+    return Casting.__table__.delete().where(clause)
+
+
+def delete_castings(clause):
+    # done explicitly rather than by ON DELETE CASCADE, which SQLite only
+    # honours with PRAGMA foreign_keys, so that table_stats stays right
+    removed = db.session.execute(delete_castings_statement(clause)).rowcount
+    if removed:
+        record_write(Casting.__tablename__, -removed)
+    return removed
 
 
 class Actor(db.Model):
     __tablename__ = 'actors'
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(80), nullable=False)
-    age = db.Column(db.Integer)
-    gender = db.Column(db.String)
+    name = db.Column(db.String(80), nullable=False, index=True)
+    age = db.Column(db.Integer, index=True)
+    gender = db.Column(db.String, index=True)
+
+    castings = db.relationship('Casting', back_populates='actor', order_by='Casting.movie_id',
+                               passive_deletes='all')
 
     def __init__(self, name, age, gender):
         self.name = name
@@ -36,14 +431,45 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
+        record_write(self.__tablename__, 1)
         db.session.commit()
 
     def update(self):
+        record_write(self.__tablename__)
         db.session.commit()
 
     def delete(self):
+        delete_castings(Casting.actor_id == self.id)
         db.session.delete(self)
+        record_write(self.__tablename__, -1)
+        db.session.commit()
+
+    @classmethod
+    def count(cls):
+        return row_count(cls)
+
+    @classmethod
+    def insert_many(cls, rows):
+        ids = insert_rows(cls, rows)
+        db.session.commit()
+        return ids
+
+    @classmethod
+    def update_many(cls, clause, values):
+        updated = update_rows(cls, clause, values)
         db.session.commit()
+        return updated
+
+    @classmethod
+    def delete_many(cls, clause):
+        deleted = delete_rows(cls, clause, Casting.actor_id)
+        db.session.commit()
+        return deleted
+
+    @classmethod
+    def columns(cls):
+        # what the API returns for an actor, in order; see serialization.py
+        return (cls.id, cls.name, cls.age, cls.gender)
 
     def format(self):
         return {
@@ -59,7 +485,10 @@ class Movie(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(80), nullable=False)
-    release_date = db.Column(db.Integer)
+    release_date = db.Column(db.Integer, index=True)
+
+    castings = db.relationship('Casting', back_populates='movie', order_by='Casting.actor_id',
+                               passive_deletes='all')
 
     def __init__(self, title, release_date):
         self.title = title
@@ -70,14 +499,44 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
+        record_write(self.__tablename__, 1)
         db.session.commit()
 
     def update(self):
+        record_write(self.__tablename__)
         db.session.commit()
 
     def delete(self):
+        delete_castings(Casting.movie_id == self.id)
         db.session.delete(self)
+        record_write(self.__tablename__, -1)
+        db.session.commit()
+
+    @classmethod
+    def count(cls):
+        return row_count(cls)
+
+    @classmethod
+    def insert_many(cls, rows):
+        ids = insert_rows(cls, rows)
         db.session.commit()
+        return ids
+
+    @classmethod
+    def update_many(cls, clause, values):
+        updated = update_rows(cls, clause, values)
+        db.session.commit()
+        return updated
+
+    @classmethod
+    def delete_many(cls, clause):
+        deleted = delete_rows(cls, clause, Casting.movie_id)
+        db.session.commit()
+        return deleted
+
+    @classmethod
+    def columns(cls):
+        return (cls.id, cls.title, cls.release_date)
 
     def format(self):
         return {
@@ -87,6 +546,50 @@ class Movie(db.Model):
         }
 
 
+'''
+Casting
+Which actors play in which movie, and as whom. An actor plays at most one
+role per movie. Rows go when their actor or movie is deleted (see
+delete_castings).
+'''
+
+
+class Casting(db.Model):
+    __tablename__ = 'castings'
+
+    movie_id = db.Column(db.Integer, db.ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True)
+    actor_id = db.Column(db.Integer, db.ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True, index=True)
+    role = db.Column(db.String(80))
+
+    actor = db.relationship('Actor', back_populates='castings')
+    movie = db.relationship('Movie', back_populates='castings')
+
+    def __init__(self, movie_id, actor_id, role=None):
+        self.movie_id = movie_id
+        self.actor_id = actor_id
+        self.role = role
+
+    def __repr__(self):
+        return f'movie_id: {self.movie_id}, actor_id: {self.actor_id}, role: {self.role}'
+
+    def insert(self):
+        db.session.add(self)
+        record_write(self.__tablename__, 1)
+        db.session.commit()
+
+
+'''
+Full-text search
+actors.name and movies.title are mirrored into external content FTS5 tables
+(actors_fts, movies_fts), which hold the index but not a second copy of the
+text. Triggers keep them in step with every insert, update and delete, so
+writes from the models, insert_rows, the async app and plain SQL are all
+indexed. Three-character prefixes get their own index entries, so the
+shortest prefix search GET /search runs does not have to scan the terms.
+The tables and triggers are created by the b7e3d91c5a20 migration.
+'''
+
+
 # to create dummy data for Sqlite database via Python interpreter
 
 def add_actor_data(name, age, gender):  
@@ -97,6 +600,7 @@ def add_actor_data(name, age, gender):
         c = con.cursor() 
         # Adding data
         c.execute("INSERT INTO actors (name, age, gender) VALUES (?,?,?)",(name, age, gender))
+        c.execute("UPDATE table_stats SET row_count = row_count + 1, version = version + 1 WHERE table_name = 'actors'")
         # Applying changes
         con.commit() 
     except Exception as e:  
@@ -111,9 +615,20 @@ def add_movie_data(title, release_date):
         c = con.cursor() 
         # Adding data
         c.execute("INSERT INTO movies (title, release_date) VALUES (?,?)", (title, release_date))
+        c.execute("UPDATE table_stats SET row_count = row_count + 1, version = version + 1 WHERE table_name = 'movies'")
         # Applying changes
         con.commit() 
     except Exception as e:
         print("An error has occured", e)
 
 
+def sync_replica(primary_file='film.db', replica_file='film_replica.db'):
+    # copies the primary into a local replica with SQLite's online backup API,
+    # to try DATABASE_REPLICAS out without a replicating database server
+    source = sql.connect(primary_file)
+    target = sql.connect(replica_file)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
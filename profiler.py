@@ -0,0 +1,121 @@
+import logging
+from collections import Counter
+
+from flask import current_app, g, has_app_context, has_request_context, request
+
+from metrics import query_listeners
+
+
+'''
+Query profiler
+Watches every SQL statement the app runs (through the cursor events in
+metrics.py) and logs to the 'profiler' logger:
+
+    - statements slower than QUERY_SLOW_MS, with their parameters and route
+    - the same statement run QUERY_REPEAT_THRESHOLD or more times in one
+      request, which is what an N+1 loop looks like
+    - requests that ran more statements than the budget of their route,
+      declared with @query_budget(n) right below @app.route
+
+executemany batches (bulk inserts) count as one statement each and are not
+treated as repeats. With QUERY_BUDGET_STRICT set, as the tests do, repeats
+and blown budgets raise QueryBudgetExceeded instead of just being logged.
+'''
+
+logger = logging.getLogger('profiler')
+
+# parameters of a slow statement are logged up to this many characters
+MAX_PARAMETERS_LENGTH = 500
+
+# BEGIN depends on the engine profile (see models.py), so budgets leave it out
+TRANSACTION_STATEMENTS = ('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE')
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def query_budget(limit):
+    '''Most SQL statements one request to the decorated view may run.'''
+    def query_budget_decorator(f):
+        f.query_budget = limit
+        return f
+    return query_budget_decorator
+
+
+def current_route():
+    if not has_request_context():
+        return None
+    return '{} {}'.format(request.method, request.url_rule.rule if request.url_rule else request.path)
+
+
+class QueryProfiler:
+    def __init__(self, slow_query_ms=100, repeat_threshold=5, strict=False):
+        self.slow_query_ms = slow_query_ms
+        self.repeat_threshold = repeat_threshold
+        self.strict = strict
+
+    def init_app(self, app):
+        app.extensions['query_profiler'] = self
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+    def start_request(self):
+        g.profiler_statements = Counter()
+        g.profiler_total = 0
+
+    def on_query(self, statement, parameters, seconds, executemany):
+        if seconds * 1000 >= self.slow_query_ms:
+            logger.warning('slow query (%.1f ms) in %s: %s parameters=%s', seconds * 1000,
+                           current_route() or '-', statement, repr(parameters)[:MAX_PARAMETERS_LENGTH])
+
+        statements = g.get('profiler_statements') if has_request_context() else None
+        if statements is None or statement.startswith(TRANSACTION_STATEMENTS):
+            return
+        g.profiler_total += 1
+        if not executemany:
+            statements[statement] += 1
+
+    def finish_request(self, response):
+        statements = g.get('profiler_statements')
+        if statements is None:
+            return response
+        route = current_route()
+
+        for statement, count in statements.items():
+            if count >= self.repeat_threshold:
+                self.report('%s ran the same statement %d times, possible N+1: %s', route, count, statement)
+
+        view = current_app.view_functions.get(request.endpoint)
+        budget = getattr(view, 'query_budget', None)
+        if budget is not None and g.profiler_total > budget:
+            self.report('%s ran %d statements, over its budget of %d', route, g.profiler_total, budget)
+        return response
+
+    def report(self, message, *args):
+        if self.strict:
+            raise QueryBudgetExceeded(message % args)
+        logger.warning(message, *args)
+
+
+def profile_query(statement, parameters, seconds, executemany):
+    if has_app_context():
+        profiler = current_app.extensions.get('query_profiler')
+        if profiler is not None:
+            profiler.on_query(statement, parameters, seconds, executemany)
+
+
+query_listeners.append(profile_query)
+
+
+def make_query_profiler(config):
+    '''
+    QUERY_PROFILER: set to False to turn the profiler off
+    QUERY_SLOW_MS: statements taking at least this long are logged
+    QUERY_REPEAT_THRESHOLD: repeats of one statement in a request that count as N+1
+    QUERY_BUDGET_STRICT: raise instead of logging, for the tests
+    '''
+    if not config.get('QUERY_PROFILER', True):
+        return None
+    return QueryProfiler(config.get('QUERY_SLOW_MS', 100), config.get('QUERY_REPEAT_THRESHOLD', 5),
+                         config.get('QUERY_BUDGET_STRICT', False))
@@ -0,0 +1,159 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import abort, current_app, has_app_context
+
+from settings import SharedSQLite, setting
+
+
+'''
+Rate limiting and load shedding
+requires_auth admits a request only after two checks, both before the view
+and so before any database work:
+
+- a concurrency cap. A worker process runs at most MAX_CONCURRENT_REQUESTS
+  authenticated requests at once; the next one gets a 503 with Retry-After
+  right away instead of queueing behind them, so under overload latency stays
+  bounded and the excess is turned away cheaply. The count is kept in the
+  worker, whatever the bucket store, so N workers run up to N times the cap
+  between them: set it from what one worker's threads can serve. A count in
+  a shared file would lose a slot for good to every worker killed mid-request.
+- a token bucket per token subject (`sub`) and route permission. A bucket
+  holds up to RATE_LIMIT_BURST tokens, refills at RATE_LIMIT tokens per
+  second and every request takes one; an empty bucket means a 429 with
+  Retry-After set to when the next token arrives. RATE_LIMITS overrides both
+  numbers per permission, e.g. {'post:actors': (1, 5)}.
+
+The buckets live in the worker ('memory') or in a SQLite file every worker on
+the host opens ('sqlite'), so that a client gets the same limit whichever
+worker answers.
+'''
+
+
+class MemoryBuckets:
+    '''In-process buckets, one set per worker.'''
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now=None):
+        # 0 if a token was taken, otherwise seconds until there is one
+        now = time.time() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + max(0, now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            self._buckets[key] = (tokens - 1 if not wait else tokens, now)
+            # forgetting a bucket only ever lets its client through
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class SQLiteBuckets:
+    '''Buckets in a local SQLite file, shared by every worker on the host.'''
+
+    def __init__(self, path, timeout=5):
+        self.file = SharedSQLite(path, timeout, isolation_level=None)
+        with self.file.connection() as con:
+            con.execute('CREATE TABLE IF NOT EXISTS rate_limit_buckets ('
+                        'key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+
+    def take(self, key, rate, burst, now=None):
+        now = time.time() if now is None else now
+        con = self.file.connection()
+        # the write lock up front, so two workers cannot both take the last token
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            row = con.execute('SELECT tokens, updated FROM rate_limit_buckets WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row is not None else (burst, now)
+            tokens = min(burst, tokens + max(0, now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            con.execute('INSERT OR REPLACE INTO rate_limit_buckets VALUES (?, ?, ?)',
+                        (key, tokens - 1 if not wait else tokens, now))
+            con.execute('COMMIT')
+        except Exception:
+            con.execute('ROLLBACK')
+            raise
+        return wait
+
+
+class RateLimiter:
+    def __init__(self, buckets, rate=10.0, burst=20, limits=None, max_concurrent=None):
+        self.buckets = buckets
+        self.rate = rate
+        self.burst = burst
+        self.limits = limits or {}
+        self.max_concurrent = max_concurrent
+        self.in_flight = 0
+        self.limited = 0
+        self.shed = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.extensions['rate_limiter'] = self
+
+    @contextmanager
+    def admit(self):
+        # a slot under the concurrency cap for the length of the request
+        with self._lock:
+            if self.max_concurrent and self.in_flight >= self.max_concurrent:
+                self.shed += 1
+                abort(503, retry_after=1)
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def check(self, permission, payload):
+        permission = ','.join(permission) if isinstance(permission, tuple) else permission
+        rate, burst = self.limits.get(permission, (self.rate, self.burst))
+        if not rate:
+            return
+        wait = self.buckets.take('{}|{}'.format(payload.get('sub', ''), permission), rate, burst)
+        if wait:
+            with self._lock:
+                self.limited += 1
+            abort(429, retry_after=max(1, math.ceil(wait)))
+
+
+def current_rate_limiter():
+    if has_app_context():
+        return current_app.extensions.get('rate_limiter')
+    return None
+
+
+def make_rate_limiter(config):
+    '''
+    RATE_LIMIT: requests per second per subject and permission, 0 for no limit
+    RATE_LIMIT_BURST: requests a client may make at once (default 2 x RATE_LIMIT)
+    RATE_LIMITS: {permission: (rate, burst)} overrides
+    RATE_LIMIT_STORE: 'memory' (default) or 'sqlite'
+    RATE_LIMIT_PATH: file for the 'sqlite' store
+    MAX_CONCURRENT_REQUESTS: authenticated requests each worker runs at once,
+                             0 for no cap; not shared between workers
+    Each falls back to the environment variable of the same name, apart from
+    RATE_LIMITS; with none of the limits set there is no RateLimiter.
+    '''
+    rate = float(setting(config, 'RATE_LIMIT', 0) or 0)
+    limits = config.get('RATE_LIMITS') or {}
+    max_concurrent = int(setting(config, 'MAX_CONCURRENT_REQUESTS', 0) or 0)
+    if not (rate or limits or max_concurrent):
+        return None
+
+    store = setting(config, 'RATE_LIMIT_STORE', 'memory')
+    if store == 'memory':
+        buckets = MemoryBuckets()
+    elif store == 'sqlite':
+        buckets = SQLiteBuckets(setting(config, 'RATE_LIMIT_PATH', 'rate_limit.db'))
+    else:
+        raise ValueError('Unknown RATE_LIMIT_STORE {!r}'.format(store))
+    burst = float(setting(config, 'RATE_LIMIT_BURST', 0) or max(1, 2 * rate))
+    return RateLimiter(buckets, rate, burst, limits, max_concurrent)
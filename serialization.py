@@ -0,0 +1,52 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+'''
+Serialization
+Responses are built from plain column tuples (Model.columns() in models.py)
+rather than ORM instances, so a page of rows skips identity map bookkeeping
+and attribute instrumentation, and are encoded straight to bytes with orjson
+when it is installed. Without it the stdlib encoder is used with the same
+compact output.
+
+Flask's jsonify sorts keys and goes through str; neither is needed here.
+'''
+
+
+def _orjson_dumps(data):
+    return orjson.dumps(data)
+
+
+def _stdlib_dumps(data):
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+BACKENDS = {'stdlib': _stdlib_dumps}
+if orjson is not None:
+    BACKENDS['orjson'] = _orjson_dumps
+
+BACKEND = 'orjson' if orjson is not None else 'stdlib'
+dumps = BACKENDS[BACKEND]
+
+
+def column_names(columns):
+    return [column.key for column in columns]
+
+
+def records(names, rows):
+    # column tuples -> list of dicts keyed by column name
+    return [dict(zip(names, row)) for row in rows]
+
+
+def record(names, row):
+    return dict(zip(names, row))
+
+
+def ndjson(names, rows, dumps=dumps):
+    # one JSON object per line, as bytes
+    return b''.join(dumps(dict(zip(names, row))) + b'\n' for row in rows)
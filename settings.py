@@ -0,0 +1,48 @@
+import os
+import sqlite3
+import threading
+
+
+'''
+Settings
+The optional parts of the app (caching, metrics, rate limits, group commit,
+compression, replicas, auth) are set in the app config, and each of their
+settings falls back to the environment variable of the same name, so that a
+gunicorn deploy can be configured from the environment alone.
+'''
+
+
+def setting(config, name, default=None):
+    return config.get(name, os.environ.get(name, default))
+
+
+def flag(value):
+    # True, or a string such as 'true' or '1' from the environment
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+class SharedSQLite:
+    '''
+    A local SQLite file that every worker on the host opens, for the state
+    they share (response cache, rate limit buckets). WAL, so readers do not
+    wait on a writer, and one connection per thread, opened anew in a process
+    forked from the one that opened it.
+    '''
+
+    def __init__(self, path, timeout=5, isolation_level=''):
+        self.path = path
+        self.timeout = timeout
+        self.isolation_level = isolation_level
+        self._local = threading.local()
+
+    def connection(self):
+        con = getattr(self._local, 'con', None)
+        if con is None or self._local.pid != os.getpid():
+            con = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=self.isolation_level)
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=NORMAL')
+            self._local.con = con
+            self._local.pid = os.getpid()
+        return con
@@ -0,0 +1,348 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from flask import Flask, jsonify
+
+from auth import auth
+from auth.auth import AuthError, make_auth_settings, requires_auth, verify_decode_jwt
+from auth.jwks import JWKSStore
+from auth.testing import generate_key, mint_token, write_jwks
+from auth.token_cache import TokenCache
+
+
+class JWKSStoreTestCase(unittest.TestCase):
+    """This class represents the JWKS key store test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.key = generate_key('key-1')
+        cls.rotated_key = generate_key('key-2')
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.jwks_path = os.path.join(self.tmpdir, 'jwks.json')
+        self.jwks_url = write_jwks(self.jwks_path, self.key)
+        self.store = JWKSStore(self.jwks_url, background_refresh=False)
+
+    def tearDown(self):
+        self.store.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def count_fetches(self, store):
+        store.fetches = 0
+        fetch = store.fetch
+
+        def counting_fetch():
+            store.fetches += 1
+            return fetch()
+        store.fetch = counting_fetch
+
+    ### SUCCESS
+    def test_loads_keys_once_indexed_by_kid(self):
+        self.count_fetches(self.store)
+
+        key = self.store.get_key('key-1')
+        self.store.get_key('key-1')
+
+        self.assertEqual(key['n'], self.key['jwk']['n'])
+        self.assertEqual(key['kid'], 'key-1')
+        self.assertEqual(self.store.kids, {'key-1'})
+        self.assertEqual(self.store.fetches, 1)
+
+    def test_verification_keys_are_built_once(self):
+        key = self.store.get_verification_key('key-1')
+
+        self.assertIs(self.store.get_verification_key('key-1'), key)
+        self.assertEqual(key.to_dict()['n'], self.key['jwk']['n'])
+
+    def test_unknown_kid_refetches(self):
+        self.store.min_refetch_interval = 0
+        self.store.get_key('key-1')
+
+        write_jwks(self.jwks_path, self.key, self.rotated_key)
+
+        self.assertIsNotNone(self.store.get_key('key-2'))
+
+    def test_background_refresh(self):
+        store = JWKSStore(self.jwks_url, ttl=0.05)
+        self.assertIsNotNone(store.get_key('key-1'))
+
+        write_jwks(self.jwks_path, self.rotated_key)
+        deadline = time.monotonic() + 5
+        while 'key-2' not in store.kids and time.monotonic() < deadline:
+            time.sleep(0.01)
+        store.stop()
+
+        self.assertEqual(store.kids, {'key-2'})
+
+    ### FAILURE
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        self.count_fetches(self.store)
+        self.store.get_key('key-1')
+
+        for i in range(5):
+            self.assertIsNone(self.store.get_key('unknown'))
+
+        self.assertEqual(self.store.fetches, 1)
+
+    def test_keeps_last_known_good_keys(self):
+        self.store.get_key('key-1')
+        os.remove(self.jwks_path)
+
+        self.assertFalse(self.store.refresh())
+        self.assertIsNotNone(self.store.get_key('key-1'))
+
+
+class VerifyDecodeJWTTestCase(unittest.TestCase):
+    """This class represents the offline token verification test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.key = generate_key()
+        cls.tmpdir = tempfile.mkdtemp()
+        url = write_jwks(os.path.join(cls.tmpdir, 'jwks.json'), cls.key)
+        cls.live_store = auth.jwks_store
+        auth.jwks_store = JWKSStore(url, background_refresh=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        auth.jwks_store = cls.live_store
+        shutil.rmtree(cls.tmpdir)
+
+    ### SUCCESS
+    def test_verify_local_token(self):
+        token = mint_token(self.key, ['get:actors'])
+        payload = verify_decode_jwt(token)
+
+        self.assertEqual(payload['permissions'], ['get:actors'])
+
+    ### FAILURE
+    def test_expired_token(self):
+        token = mint_token(self.key, ['get:actors'], expires_in=-60)
+
+        with self.assertRaises(AuthError) as ctx:
+            verify_decode_jwt(token)
+        self.assertEqual(ctx.exception.error['code'], 'token_expired')
+
+    def test_unknown_key(self):
+        token = mint_token(dict(self.key, kid='not-published'), ['get:actors'])
+
+        with self.assertRaises(AuthError) as ctx:
+            verify_decode_jwt(token)
+        self.assertEqual(ctx.exception.status_code, 400)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = TokenCache(maxsize=3, clock=lambda: self.now)
+
+    ### SUCCESS
+    def test_hit_and_miss_counters(self):
+        self.assertIsNone(self.cache.get('token'))
+        self.cache.put('token', {'sub': 'a', 'exp': 2000})
+
+        self.assertEqual(self.cache.get('token')['sub'], 'a')
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_bounded_lru(self):
+        for i in range(4):
+            self.cache.put('token-{}'.format(i), {'exp': 2000})
+
+        self.assertEqual(self.cache.stats()['size'], 3)
+        self.assertIsNone(self.cache.get('token-0'))
+        self.assertIsNotNone(self.cache.get('token-3'))
+
+    def test_full_cache_evicts_least_recently_used(self):
+        for i in range(3):
+            self.cache.put('token-{}'.format(i), {'exp': 2000})
+        self.cache.get('token-0')
+
+        self.cache.put('token-3', {'exp': 2000})
+
+        self.assertIsNone(self.cache.get('token-1'))
+        self.assertIsNotNone(self.cache.get('token-0'))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_thread_safety(self):
+        cache = TokenCache(maxsize=50)
+        exp = time.time() + 60
+
+        def worker(n):
+            for i in range(500):
+                token = 'token-{}'.format((n * i) % 80)
+                if cache.get(token) is None:
+                    cache.put(token, {'exp': exp})
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        stats = cache.stats()
+        self.assertLessEqual(stats['size'], 50)
+        self.assertEqual(stats['hits'] + stats['misses'], 8 * 500)
+
+    ### FAILURE
+    def test_never_returns_expired_payload(self):
+        self.cache.put('token', {'exp': 1010})
+        self.now = 1010
+
+        self.assertIsNone(self.cache.get('token'))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_does_not_store_expired_or_exp_less_payloads(self):
+        self.cache.put('expired', {'exp': 900})
+        self.cache.put('no-exp', {'sub': 'a'})
+
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+
+class RequiresAuthTestCase(unittest.TestCase):
+    """This class represents the requires_auth decorator test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.key = generate_key()
+        cls.tmpdir = tempfile.mkdtemp()
+        url = write_jwks(os.path.join(cls.tmpdir, 'jwks.json'), cls.key)
+        cls.live_store = auth.jwks_store
+        auth.jwks_store = JWKSStore(url, background_refresh=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        auth.jwks_store = cls.live_store
+        shutil.rmtree(cls.tmpdir)
+
+    def setUp(self):
+        self.app = Flask(__name__)
+
+        @self.app.route('/actors')
+        @requires_auth('get:actors')
+        def get_actors(payload):
+            return jsonify({'sub': payload['sub']})
+
+        self.client = self.app.test_client
+        auth.token_cache.clear()
+
+    def test_repeated_token_is_verified_once(self):
+        token = mint_token(self.key, ['get:actors'])
+        calls = []
+
+        def counting_verify(token, *args):
+            calls.append(token)
+            return verify_decode_jwt(token, *args)
+
+        auth.verify_decode_jwt = counting_verify
+        try:
+            for i in range(3):
+                res = self.client().get('/actors', headers={"Authorization": "Bearer {}".format(token)})
+                self.assertEqual(res.status_code, 200)
+        finally:
+            auth.verify_decode_jwt = verify_decode_jwt
+
+        self.assertEqual(len(calls), 1)
+
+
+class AuthSettingsTestCase(unittest.TestCase):
+    """This class represents the per-app auth settings test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.key = generate_key()
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.jwks_path = os.path.join(self.tmpdir, 'jwks.json')
+        write_jwks(self.jwks_path, self.key)
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def make_app(self, **config):
+        app = Flask(__name__)
+        settings = make_auth_settings(config)
+        settings.init_app(app)
+        self.stores.append(settings.jwks_store)
+
+        @app.route('/actors')
+        @requires_auth('get:actors')
+        def get_actors(payload):
+            return jsonify({'sub': payload['sub']})
+
+        @app.errorhandler(AuthError)
+        def auth_error(error):
+            return jsonify(error.error), error.status_code
+        return app
+
+    def get(self, app, token):
+        return app.test_client().get('/actors', headers={"Authorization": "Bearer {}".format(token)})
+
+    ### SUCCESS
+    def test_jwks_file_is_loaded_at_startup(self):
+        app = self.make_app(JWKS_FILE=self.jwks_path)
+        os.remove(self.jwks_path)
+
+        self.assertEqual(self.get(app, mint_token(self.key, ['get:actors'])).status_code, 200)
+        self.assertIsNot(app.extensions['auth'].jwks_store, auth.jwks_store)
+
+    def test_pem_file(self):
+        pem_path = os.path.join(self.tmpdir, 'key.pem')
+        with open(pem_path, 'w') as f:
+            f.write(self.key['public_pem'])
+        other_kid = mint_token(dict(self.key, kid='rotated'), ['get:actors'])
+
+        self.assertEqual(self.get(self.make_app(JWKS_FILE=pem_path), other_kid).status_code, 200)
+        app = self.make_app(JWKS_FILE=pem_path, JWKS_KID=self.key['kid'])
+        self.assertEqual(self.get(app, mint_token(self.key, ['get:actors'])).status_code, 200)
+        self.assertEqual(self.get(app, other_kid).status_code, 400)
+
+    def test_issuer_and_audience_per_app(self):
+        film = self.make_app(JWKS_FILE=self.jwks_path)
+        other = self.make_app(JWKS_FILE=self.jwks_path, AUTH0_DOMAIN='tenant.example.com', API_AUDIENCE='other')
+        film_token = mint_token(self.key, ['get:actors'])
+        other_token = mint_token(self.key, ['get:actors'], iss='https://tenant.example.com/', aud='other')
+
+        self.assertEqual(self.get(film, film_token).status_code, 200)
+        # verified and cached by the first app, still refused by the second
+        self.assertEqual(self.get(other, film_token).status_code, 401)
+        self.assertEqual(self.get(other, other_token).status_code, 200)
+        self.assertEqual(self.get(film, other_token).status_code, 401)
+
+    def test_preloaded_url_with_refresher_never_fetches_on_request(self):
+        app = self.make_app(JWKS_URL='file://' + self.jwks_path, JWKS_PRELOAD='true', JWKS_REFRESH='true')
+        store = app.extensions['auth'].jwks_store
+        fetches = []
+        fetch = store.fetch
+        store.fetch = lambda: fetches.append(1) or fetch()
+
+        self.assertEqual(self.get(app, mint_token(self.key, ['get:actors'])).status_code, 200)
+        self.assertEqual(self.get(app, mint_token(dict(self.key, kid='rotated'), ['get:actors'])).status_code, 400)
+        self.assertEqual(fetches, [])
+
+    def test_apps_without_settings_share_the_defaults(self):
+        settings = make_auth_settings({})
+
+        self.assertIs(settings.jwks_store, auth.jwks_store)
+        self.assertIs(settings.token_cache, auth.token_cache)
+
+    ### FAILURE
+    def test_missing_jwks_file_fails_at_startup(self):
+        with self.assertRaises(RuntimeError):
+            make_auth_settings({'JWKS_FILE': os.path.join(self.tmpdir, 'missing.json')})
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
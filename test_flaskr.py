@@ -1,22 +1,57 @@
+import asyncio
+import gzip
+import importlib.util
 import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
-
-from app import create_app
-from models import setup_db, Actor, Movie
+from unittest import mock
+from sqlalchemy import event
+
+from app import create_app, encode_cursor, MAX_PAGE_SIZE, MAX_BULK_ROWS
+try:
+    # Quart and aiosqlite come with requirements-async.txt, not requirements.txt
+    from asgi import create_asgi_app
+except ImportError:
+    create_asgi_app = None
+from sqlalchemy.exc import OperationalError
+
+from models import setup_db, upgrade_db, sync_replica, insert_rows, Actor, Movie, Casting, TableStats, db, record_write
+from serialization import BACKENDS, dumps as dumps_json
+from metrics import Metrics, fold_snapshot
+from group_commit import PendingRow
+from ratelimit import MemoryBuckets
+from caching import SQLiteBackend
+from compression import ENCODERS
+import gunicorn_conf
+from gunicorn.config import Config
+from profiler import QueryBudgetExceeded, query_budget
 from auth_details import executive, direct, assist
+from auth import auth
+from auth.jwks import JWKSStore
+from auth.testing import generate_key, mint_token, write_jwks
 # from auth.auth import AuthError, requires_auth
 
 
 class FilmTestCase(unittest.TestCase):
     """This class represents the film test case"""
 
+    database_path = "sqlite:///film_test.db"
+
+    @classmethod
+    def setUpClass(cls):
+        app = create_app()
+        setup_db(app, cls.database_path)
+        upgrade_db(app)
+
     def setUp(self):
         """Define test variables and initialize app."""
         self.app = create_app()
         self.client = self.app.test_client
-        self.database_path = "sqlite:///film_test.db"
         setup_db(self.app, self.database_path)
 
         self.new_actor = {
@@ -47,13 +82,6 @@ class FilmTestCase(unittest.TestCase):
         self.casting_director = direct
         self.executive_producer = executive
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
-
     def tearDown(self):
         """Executed after reach test"""
         pass
@@ -293,6 +321,1850 @@ class FilmTestCase(unittest.TestCase):
         self.assertEqual(data['message'], "You don't have the permission to access the requested resource.")
 
 
+ASSISTANT_PERMISSIONS = ['get:actors', 'get:movies']
+DIRECTOR_PERMISSIONS = ASSISTANT_PERMISSIONS + [
+    'post:actors', 'delete:actors', 'patch:actors', 'post:movies', 'patch:movies']
+PRODUCER_PERMISSIONS = DIRECTOR_PERMISSIONS + ['delete:movies']
+
+
+class LocalAuthTestCase(unittest.TestCase):
+    """Runs the app against a temporary database with tokens signed by a
+    locally generated key, so no Auth0 tokens or network access are needed"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.key = generate_key()
+        url = write_jwks(os.path.join(cls.tmpdir, 'jwks.json'), cls.key)
+        cls.live_store = auth.jwks_store
+        auth.jwks_store = JWKSStore(url, background_refresh=False)
+
+        cls.casting_assistant = mint_token(cls.key, ASSISTANT_PERMISSIONS)
+        cls.casting_director = mint_token(cls.key, DIRECTOR_PERMISSIONS)
+        cls.executive_producer = mint_token(cls.key, PRODUCER_PERMISSIONS)
+
+        # the schema is migrated once per class, each test only empties the tables
+        cls.database_path = "sqlite:///" + os.path.join(cls.tmpdir, 'film.db')
+        app = create_app()
+        setup_db(app, cls.database_path)
+        upgrade_db(app)
+
+    @classmethod
+    def tearDownClass(cls):
+        auth.jwks_store = cls.live_store
+        shutil.rmtree(cls.tmpdir)
+
+    config = None
+
+    def setUp(self):
+        # every request made by these tests has to stay within its query budget
+        self.app = create_app(dict(self.config or {}, TESTING=True, QUERY_BUDGET_STRICT=True))
+        self.client = self.app.test_client
+        setup_db(self.app, self.database_path)
+
+        with self.app.app_context():
+            for table in reversed(db.metadata.sorted_tables):
+                if table is not TableStats.__table__:
+                    db.session.execute(table.delete())
+            db.session.execute(TableStats.__table__.update().values(row_count=0, version=0))
+            db.session.commit()
+
+    def headers(self, token):
+        return {"Authorization": "Bearer {}".format(token)}
+
+    def add_actors(self, count):
+        with self.app.app_context():
+            db.session.add_all([Actor(name='Actor {}'.format(i), age=20 + i % 50, gender='female' if i % 2 else 'male')
+                                for i in range(count)])
+            record_write('actors', count)
+            db.session.commit()
+
+    def add_movies(self, count):
+        with self.app.app_context():
+            db.session.add_all([Movie(title='Movie {}'.format(i), release_date=1950 + i % 70)
+                                for i in range(count)])
+            record_write('movies', count)
+            db.session.commit()
+
+    def add_castings(self, pairs):
+        with self.app.app_context():
+            db.session.add_all([Casting(movie_id, actor_id, 'Role {}'.format(actor_id))
+                                for movie_id, actor_id in pairs])
+            record_write('castings', len(pairs))
+            db.session.commit()
+
+
+class PaginationTestCase(LocalAuthTestCase):
+    """This class represents the keyset pagination test case"""
+
+    ### SUCCESS
+    def test_pages_through_actors(self):
+        self.add_actors(25)
+
+        seen = []
+        cursor = None
+        while True:
+            query = '?limit=10' + ('&after={}'.format(cursor) if cursor else '')
+            res = self.client().get('/actors' + query, headers=self.headers(self.casting_assistant))
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            seen.extend(actor['id'] for actor in data['actors'])
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(seen, sorted(set(seen)))
+
+    def test_last_page_has_no_cursor(self):
+        self.add_movies(3)
+
+        res = self.client().get('/movies?limit=3', headers=self.headers(self.casting_assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(len(data['movies']), 3)
+        self.assertIsNone(data['next_cursor'])
+
+    def test_page_size_is_capped(self):
+        self.add_movies(MAX_PAGE_SIZE + 5)
+
+        res = self.client().get('/movies?limit=100000', headers=self.headers(self.casting_assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(len(data['movies']), MAX_PAGE_SIZE)
+        self.assertIsNotNone(data['next_cursor'])
+
+    ### FAILURE
+    def test_400_for_bad_cursor(self):
+        res = self.client().get('/actors?after=not-a-cursor', headers=self.headers(self.casting_assistant))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['message'], 'bad request')
+
+    def test_400_for_cursor_beyond_integer_range(self):
+        for values in ([2 ** 63], [-2 ** 63 - 1], [2 ** 70]):
+            res = self.client().get('/actors?after={}'.format(encode_cursor(values)),
+                                    headers=self.headers(self.casting_assistant))
+
+            self.assertEqual(res.status_code, 400, values)
+
+    def test_400_for_bad_limit(self):
+        res = self.client().get('/actors?limit=0', headers=self.headers(self.casting_assistant))
+
+        self.assertEqual(res.status_code, 400)
+
+
+class RowCountTestCase(LocalAuthTestCase):
+    """This class represents the maintained row count test case"""
+
+    def test_delete_reports_remaining_actors(self):
+        self.add_actors(5)
+
+        res = self.client().delete('/actors/2', headers=self.headers(self.casting_director))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_actors'], 4)
+
+    def test_delete_reports_remaining_movies(self):
+        self.add_movies(3)
+        res = self.client().post('/movies', headers=self.headers(self.casting_director), json={'title': 'Heat', 'release_date': 1995})
+        created = json.loads(res.data)['created']
+
+        res = self.client().delete('/movies/{}'.format(created), headers=self.headers(self.executive_producer))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_movies'], 3)
+        with self.app.app_context():
+            self.assertEqual(Movie.count(), Movie.query.count())
+
+
+class BulkCreateTestCase(LocalAuthTestCase):
+    """This class represents the bulk create test case"""
+
+    ### SUCCESS
+    def test_bulk_create_actors(self):
+        actors = [{'name': 'Actor {}'.format(i), 'age': 30, 'gender': 'female'} for i in range(1200)]
+
+        res = self.client().post('/actors/bulk', headers=self.headers(self.casting_director), json={'actors': actors})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['created']), 1200)
+        with self.app.app_context():
+            self.assertEqual(Actor.count(), 1200)
+            for actor_id in (data['created'][0], data['created'][-1]):
+                actor = Actor.query.get(actor_id)
+                self.assertEqual(actor.name, actors[data['created'].index(actor_id)]['name'])
+
+    def test_partial_bulk_create_reports_failed_rows(self):
+        movies = [{'title': 'Heat', 'release_date': 1995}, {'release_date': 2000}, {'title': 'Alien', 'release_date': 'soon'}]
+
+        res = self.client().post('/movies/bulk', headers=self.headers(self.casting_director), json={'movies': movies, 'mode': 'partial'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['created']), 1)
+        self.assertEqual([row['index'] for row in data['failed']], [1, 2])
+        self.assertIn('title', data['failed'][0]['errors'])
+        self.assertIn('release_date', data['failed'][1]['errors'])
+
+    def test_ids_read_back_beyond_sqlite(self):
+        self.add_actors(2)
+        rows = [{'name': name, 'age': 30, 'gender': 'female'} for name in ('A', 'B', 'C')]
+
+        with self.app.app_context():
+            with mock.patch.object(db.get_engine().dialect, 'name', 'postgresql'):
+                ids = insert_rows(Actor, rows)
+            db.session.commit()
+
+            self.assertEqual(ids, [3, 4, 5])
+            self.assertEqual([db.session.get(Actor, actor_id).name for actor_id in ids], ['A', 'B', 'C'])
+            self.assertEqual(Actor.count(), 5)
+
+    ### FAILURE
+    def test_atomic_bulk_create_inserts_nothing_on_error(self):
+        actors = [{'name': 'Brad Pitt', 'age': 47}, {'name': '', 'age': 'old'}]
+
+        res = self.client().post('/actors/bulk', headers=self.headers(self.casting_director), json={'actors': actors})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['failed'][0]['index'], 1)
+        with self.app.app_context():
+            self.assertEqual(Actor.query.count(), 0)
+
+    def test_refuses_to_guess_ids_outside_a_transaction(self):
+        with self.app.app_context():
+            dbapi_connection = db.session.connection().connection.dbapi_connection
+            dbapi_connection.isolation_level = None
+            try:
+                with self.assertRaises(RuntimeError):
+                    insert_rows(Actor, [{'name': 'A', 'age': 30, 'gender': 'female'}])
+            finally:
+                db.session.rollback()
+                dbapi_connection.isolation_level = ''
+
+            self.assertEqual(Actor.query.count(), 0)
+
+    def test_400_if_too_many_rows(self):
+        actors = [{'name': 'Actor'}] * (MAX_BULK_ROWS + 1)
+
+        res = self.client().post('/actors/bulk', headers=self.headers(self.casting_director), json={'actors': actors})
+
+        self.assertEqual(res.status_code, 400)
+
+    ### RBAC (Casting Assistant) should fail
+    def test_user_not_allowed_bulk_create(self):
+        res = self.client().post('/movies/bulk', headers=self.headers(self.casting_assistant), json={'movies': [{'title': 'Heat'}]})
+
+        self.assertEqual(res.status_code, 403)
+
+
+class ExportTestCase(LocalAuthTestCase):
+    """This class represents the NDJSON export test case"""
+
+    ### SUCCESS
+    def test_export_actors(self):
+        self.add_actors(2500)
+
+        res = self.client().get('/actors/export', headers=self.headers(self.casting_assistant))
+        rows = [json.loads(line) for line in res.data.decode('utf-8').splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(rows), 2500)
+        self.assertEqual(set(rows[0]), {'id', 'name', 'age', 'gender'})
+        self.assertEqual([row['id'] for row in rows], sorted(row['id'] for row in rows))
+
+    def test_export_empty_movies(self):
+        res = self.client().get('/movies/export', headers=self.headers(self.casting_assistant))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data, b'')
+
+    ### FAILURE
+    def test_unauthorised_export(self):
+        res = self.client().get('/movies/export')
+
+        self.assertEqual(res.status_code, 401)
+
+
+class ETagTestCase(LocalAuthTestCase):
+    """This class represents the ETag / If-None-Match test case"""
+
+    def get(self, path, etag=None):
+        headers = self.headers(self.casting_director)
+        if etag:
+            headers['If-None-Match'] = etag
+        return self.client().get(path, headers=headers)
+
+    ### SUCCESS
+    def test_304_when_unchanged(self):
+        self.add_actors(3)
+        res = self.get('/actors')
+        etag = res.headers['ETag']
+
+        res = self.get('/actors', etag)
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+
+    def test_etag_changes_on_insert_update_and_delete(self):
+        self.add_movies(2)
+        etags = [self.get('/movies').headers['ETag']]
+
+        res = self.client().post('/movies', headers=self.headers(self.casting_director), json={'title': 'Heat', 'release_date': 1995})
+        movie_id = json.loads(res.data)['created']
+        etags.append(self.get('/movies').headers['ETag'])
+        self.client().patch('/movies/{}'.format(movie_id), headers=self.headers(self.casting_director), json={'title': 'Heat (1995)'})
+        etags.append(self.get('/movies').headers['ETag'])
+        self.client().delete('/movies/{}'.format(movie_id), headers=self.headers(self.executive_producer))
+        etags.append(self.get('/movies').headers['ETag'])
+
+        self.assertEqual(len(set(etags)), 4)
+        res = self.get('/movies', etags[0])
+        self.assertEqual(res.status_code, 200)
+
+    def test_detail_endpoint(self):
+        self.add_actors(1)
+        res = self.get('/actors/1')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor']['name'], 'Actor 0')
+        self.assertEqual(self.get('/actors/1', res.headers['ETag']).status_code, 304)
+
+    def test_etag_depends_on_query(self):
+        self.add_actors(3)
+
+        self.assertNotEqual(self.get('/actors?limit=1').headers['ETag'], self.get('/actors?limit=2').headers['ETag'])
+
+    ### FAILURE
+    def test_404_detail(self):
+        res = self.get('/movies/1000')
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_404_for_ids_beyond_integer_range(self):
+        for method in ('GET', 'PATCH', 'DELETE'):
+            for path in ('/actors/99999999999999999999999', '/movies/{}'.format(2 ** 63)):
+                res = self.client().open(path, method=method, json={},
+                                         headers=self.headers(self.executive_producer))
+
+                self.assertEqual(res.status_code, 404, (method, path))
+
+    def test_etag_still_requires_auth(self):
+        self.add_actors(1)
+        etag = self.get('/actors').headers['ETag']
+
+        res = self.client().get('/actors', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 401)
+
+
+class ResponseCacheTestCase(LocalAuthTestCase):
+    """This class represents the read-through response cache test case"""
+
+    def get(self, client, path='/actors'):
+        return client.get(path, headers=self.headers(self.casting_assistant))
+
+    ### SUCCESS
+    def test_second_read_is_a_hit(self):
+        self.add_actors(3)
+        client = self.client()
+
+        first = self.get(client)
+        second = self.get(client)
+
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(first.data, second.data)
+        stats = self.app.extensions['response_cache'].stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 1, 1))
+
+    def test_write_invalidates_only_its_table(self):
+        self.add_actors(1)
+        self.add_movies(1)
+        client = self.client()
+        self.get(client, '/actors')
+        self.get(client, '/movies')
+
+        client.post('/actors', headers=self.headers(self.casting_director), json={'name': 'Brad Pitt', 'age': 47})
+        cache = self.app.extensions['response_cache']
+
+        self.assertEqual(cache.stats()['invalidations'], 1)
+        self.assertEqual(self.get(client, '/movies').headers['X-Cache'], 'HIT')
+        res = self.get(client, '/actors')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(len(json.loads(res.data)['actors']), 2)
+
+    def test_lru_evictions(self):
+        self.app.extensions['response_cache'].backend.maxsize = 2
+        self.add_actors(5)
+        client = self.client()
+
+        for limit in range(1, 5):
+            self.get(client, '/actors?limit={}'.format(limit))
+
+        stats = self.app.extensions['response_cache'].stats()
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['evictions'], 2)
+
+    def test_sqlite_backend_is_shared_between_apps(self):
+        config = {'RESPONSE_CACHE': 'sqlite', 'RESPONSE_CACHE_PATH': os.path.join(self.tmpdir, 'cache.db')}
+        apps = []
+        for i in range(2):
+            app = create_app(config)
+            setup_db(app, self.database_path)
+            apps.append(app)
+        self.add_movies(2)
+
+        self.assertEqual(self.get(apps[0].test_client(), '/movies').headers['X-Cache'], 'MISS')
+        self.assertEqual(self.get(apps[1].test_client(), '/movies').headers['X-Cache'], 'HIT')
+
+        apps[0].test_client().delete('/movies/1', headers=self.headers(self.executive_producer))
+
+        self.assertEqual(len(apps[1].extensions['response_cache'].backend), 0)
+        res = self.get(apps[1].test_client(), '/movies')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(len(json.loads(res.data)['movies']), 1)
+
+    def test_sqlite_backend_touches_hits_once_per_interval(self):
+        backend = SQLiteBackend(os.path.join(self.tmpdir, 'touch.db'), touch_interval=60)
+        backend.set('key', ('actors',), (200, 'application/json', b'{}'))
+
+        def used():
+            return backend.file.connection().execute('SELECT used FROM response_cache').fetchone()[0]
+
+        stored = used()
+        self.assertEqual(backend.get('key'), (200, 'application/json', b'{}'))
+        self.assertEqual(used(), stored)
+
+        backend.touch_interval = 0
+        backend.get('key')
+        self.assertGreater(used(), stored)
+
+    ### FAILURE
+    def test_cache_does_not_bypass_auth(self):
+        self.add_actors(1)
+        self.get(self.client())
+
+        res = self.client().get('/actors')
+
+        self.assertEqual(res.status_code, 401)
+
+
+class FilterSortTestCase(LocalAuthTestCase):
+    """This class represents the filter and sort test case"""
+
+    def get_all(self, path):
+        results = []
+        cursor = None
+        while True:
+            separator = '&' if '?' in path else '?'
+            url = path + ('{}limit=7&after={}'.format(separator, cursor) if cursor else '{}limit=7'.format(separator))
+            res = self.client().get(url, headers=self.headers(self.casting_assistant))
+            self.assertEqual(res.status_code, 200)
+            data = json.loads(res.data)
+            results.extend(data.get('actors', data.get('movies')))
+            cursor = data['next_cursor']
+            if cursor is None:
+                return results
+
+    def explain(self, path):
+        # the query plan of the SELECT the route ran
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('SELECT actors.id') or statement.startswith('SELECT movies.id'):
+                statements.append((statement, parameters))
+
+        engine = db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', capture)
+        try:
+            res = self.client().get(path, headers=self.headers(self.casting_assistant))
+            self.assertEqual(res.status_code, 200)
+        finally:
+            event.remove(engine, 'before_cursor_execute', capture)
+
+        statement, parameters = statements[-1]
+        con = sqlite3.connect(engine.url.database)
+        plan = con.execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+        con.close()
+        return ' '.join(row[-1] for row in plan)
+
+    ### SUCCESS
+    def test_filter_actors(self):
+        self.add_actors(60)
+
+        actors = self.get_all('/actors?gender=female&min_age=30&max_age=40')
+
+        self.assertTrue(actors)
+        self.assertTrue(all(a['gender'] == 'female' and 30 <= a['age'] <= 40 for a in actors))
+        self.assertEqual(len(actors), len([i for i in range(60) if i % 2 and 30 <= 20 + i % 50 <= 40]))
+
+    def test_name_prefix(self):
+        self.add_actors(30)
+
+        actors = self.get_all('/actors?name_prefix=Actor 1')
+
+        self.assertEqual(sorted(a['name'] for a in actors), sorted('Actor {}'.format(i) for i in range(30) if str(i).startswith('1')))
+
+    def test_sort_pages_in_order(self):
+        self.add_actors(40)
+        with self.app.app_context():
+            Actor(name='Ageless', age=None, gender=None).insert()
+
+        for sort in ('age', '-age', 'name', '-id'):
+            actors = self.get_all('/actors?sort={}'.format(sort))
+            self.assertEqual(len(actors), 41)
+            self.assertEqual(len({a['id'] for a in actors}), 41)
+            key = sort.lstrip('-')
+            values = [(a[key] if a[key] is not None else -1, a['id']) for a in actors]
+            self.assertEqual(values, sorted(values, reverse=sort.startswith('-')))
+
+    def test_filter_movies_by_release_date(self):
+        self.add_movies(70)
+
+        movies = self.get_all('/movies?min_release_date=1990&max_release_date=1999&sort=-release_date')
+
+        self.assertEqual(len(movies), 10)
+        self.assertEqual([m['release_date'] for m in movies], list(range(1999, 1989, -1)))
+
+    def test_filters_use_indexes(self):
+        self.add_actors(10)
+        self.add_movies(10)
+
+        self.assertIn('ix_actors_age', self.explain('/actors?min_age=30&max_age=40&sort=age'))
+        self.assertIn('ix_actors_gender', self.explain('/actors?gender=female'))
+        self.assertIn('ix_actors_name', self.explain('/actors?name_prefix=Act&sort=name'))
+        self.assertIn('ix_movies_release_date', self.explain('/movies?min_release_date=1990&max_release_date=1999'))
+
+    ### FAILURE
+    def test_400_for_unknown_sort(self):
+        res = self.client().get('/movies?sort=title', headers=self.headers(self.casting_assistant))
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_400_for_bad_filter(self):
+        for path in ('/actors?min_age=old', '/actors?min_age=99999999999999999999999',
+                     '/actors?max_age=-99999999999999999999999', '/movies?min_release_date={}'.format(2 ** 63),
+                     '/movies?max_release_date=99999999999999999999999'):
+            res = self.client().get(path, headers=self.headers(self.casting_assistant))
+
+            self.assertEqual(res.status_code, 400, path)
+
+    def test_400_for_cursor_from_another_sort(self):
+        self.add_actors(3)
+        res = self.client().get('/actors?limit=1', headers=self.headers(self.casting_assistant))
+        cursor = json.loads(res.data)['next_cursor']
+
+        res = self.client().get('/actors?sort=age&after={}'.format(cursor), headers=self.headers(self.casting_assistant))
+
+        self.assertEqual(res.status_code, 400)
+
+
+class EngineProfileTestCase(LocalAuthTestCase):
+    """This class represents the production SQLite engine profile test case"""
+
+    config = {'DATABASE_PROFILE': 'production'}
+
+    def run_threads(self, target, count):
+        errors = []
+
+        def run(n):
+            try:
+                target(n)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(30)
+        self.assertEqual(errors, [])
+
+    def test_pragmas_and_pool(self):
+        with self.app.app_context():
+            connection = db.session.connection()
+            pragma = lambda name: connection.exec_driver_sql('PRAGMA {}'.format(name)).scalar()
+
+            self.assertEqual(pragma('journal_mode'), 'wal')
+            self.assertEqual(pragma('synchronous'), 1)
+            self.assertEqual(pragma('busy_timeout'), 5000)
+            self.assertEqual(pragma('cache_size'), -64 * 1024)
+            self.assertEqual(type(db.get_engine().pool).__name__, 'QueuePool')
+
+    def test_readers_are_not_blocked_by_a_writer(self):
+        self.add_actors(50)
+        writer = sqlite3.connect(self.database_path[len('sqlite:///'):], isolation_level=None)
+        writer.execute('BEGIN IMMEDIATE')
+        writer.execute("INSERT INTO actors (name, age, gender) VALUES ('Pending', 30, 'male')")
+        statuses = []
+
+        def read(n):
+            res = self.client().get('/actors?limit={}'.format(n + 1), headers=self.headers(self.casting_assistant))
+            statuses.append((res.status_code, len(json.loads(res.data)['actors'])))
+
+        try:
+            self.run_threads(read, 8)
+            self.assertTrue(writer.in_transaction)
+        finally:
+            writer.execute('COMMIT')
+            writer.close()
+
+        self.assertEqual(sorted(statuses), [(200, n + 1) for n in range(8)])
+
+    def test_parallel_writers_do_not_fail(self):
+        self.add_actors(40)
+        statuses = []
+
+        def write(n):
+            client = self.client()
+            headers = self.headers(self.executive_producer)
+            for i in range(5):
+                res = client.post('/actors', headers=headers, json={'name': 'Writer {}'.format(n), 'age': 30})
+                statuses.append(res.status_code)
+                res = client.patch('/actors/{}'.format(9 + n * 4 + i % 4), headers=headers, json={'name': 'Renamed'})
+                statuses.append(res.status_code)
+            res = client.delete('/actors/{}'.format(n + 1), headers=headers)
+            statuses.append(res.status_code)
+
+        self.run_threads(write, 8)
+
+        self.assertEqual(set(statuses), {200})
+        with self.app.app_context():
+            self.assertEqual(Actor.count(), 40 + 8 * 5 - 8)
+            self.assertEqual(Actor.query.count(), Actor.count())
+
+
+class CastingTestCase(LocalAuthTestCase):
+    """This class represents the actor-movie casting test case"""
+
+    def get(self, path, token=None, etag=None):
+        headers = self.headers(token or self.casting_assistant)
+        if etag:
+            headers['If-None-Match'] = etag
+        return self.client().get(path, headers=headers)
+
+    ### SUCCESS
+    def test_movie_actors_and_actor_movies(self):
+        self.add_actors(3)
+        self.add_movies(2)
+        self.add_castings([(1, 3), (1, 1), (2, 1)])
+
+        data = json.loads(self.get('/movies/1/actors').data)
+        self.assertEqual([(a['id'], a['role']) for a in data['actors']], [(1, 'Role 1'), (3, 'Role 3')])
+
+        data = json.loads(self.get('/actors/1/movies').data)
+        self.assertEqual([m['id'] for m in data['movies']], [1, 2])
+
+        res = self.get('/actors/2/movies')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['movies'], [])
+
+    def test_include_cast_on_list_pages(self):
+        # strict query budgets make every page below fail if it costs more
+        # queries than a page without castings
+        self.add_actors(40)
+        self.add_movies(40)
+        self.add_castings([(movie_id, actor_id) for movie_id in range(1, 41) for actor_id in range(1, 6)])
+
+        data = json.loads(self.get('/movies?include=cast&limit=30').data)
+        self.assertEqual(len(data['movies']), 30)
+        self.assertTrue(all(len(movie['actors']) == 5 for movie in data['movies']))
+        self.assertEqual(data['movies'][0]['actors'][0], {'id': 1, 'name': 'Actor 0', 'age': 20,
+                                                         'gender': 'male', 'role': 'Role 1'})
+
+        data = json.loads(self.get('/actors?include=cast&limit=10').data)
+        self.assertEqual([len(actor['movies']) for actor in data['actors']], [40] * 5 + [0] * 5)
+        self.assertNotIn('movies', json.loads(self.get('/actors?limit=10').data)['actors'][0])
+
+    def test_cast_and_uncast_actor(self):
+        self.add_actors(2)
+        self.add_movies(1)
+
+        res = self.client().post('/movies/1/actors', headers=self.headers(self.casting_director),
+                                 json={'actor_id': 2, 'role': 'Lead'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(self.get('/movies/1/actors').data)['actors'][0]['role'], 'Lead')
+
+        res = self.client().delete('/movies/1/actors/2', headers=self.headers(self.casting_director))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(self.get('/movies/1/actors').data)['actors'], [])
+        with self.app.app_context():
+            self.assertEqual(db.session.get(TableStats, 'castings').row_count, 0)
+
+    def test_etag_changes_when_cast_changes(self):
+        self.add_actors(1)
+        self.add_movies(1)
+        etags = [self.get('/movies?include=cast').headers['ETag'], self.get('/actors/1/movies').headers['ETag']]
+        self.assertEqual(self.get('/movies?include=cast', etag=etags[0]).status_code, 304)
+
+        self.client().post('/movies/1/actors', headers=self.headers(self.casting_director), json={'actor_id': 1})
+
+        self.assertEqual(self.get('/movies?include=cast', etag=etags[0]).status_code, 200)
+        self.assertEqual(self.get('/actors/1/movies', etag=etags[1]).status_code, 200)
+
+    def test_deleting_actor_or_movie_removes_castings(self):
+        self.add_actors(2)
+        self.add_movies(2)
+        self.add_castings([(1, 1), (1, 2), (2, 1)])
+
+        self.assertEqual(self.client().delete('/actors/1', headers=self.headers(self.casting_director)).status_code, 200)
+        self.assertEqual(self.client().delete('/movies/1', headers=self.headers(self.executive_producer)).status_code, 200)
+
+        with self.app.app_context():
+            self.assertEqual(Casting.query.count(), 0)
+            self.assertEqual(db.session.get(TableStats, 'castings').row_count, 0)
+
+    ### FAILURE
+    def test_404_for_missing_movie_or_actor(self):
+        self.add_actors(1)
+        self.add_movies(1)
+
+        self.assertEqual(self.get('/movies/9/actors').status_code, 404)
+        self.assertEqual(self.get('/actors/9/movies').status_code, 404)
+        for movie_id, actor_id in ((9, 1), (1, 9)):
+            res = self.client().post('/movies/{}/actors'.format(movie_id), headers=self.headers(self.casting_director),
+                                     json={'actor_id': actor_id})
+            self.assertEqual(res.status_code, 404)
+        self.assertEqual(self.client().delete('/movies/1/actors/1', headers=self.headers(self.casting_director)).status_code, 404)
+
+    def test_422_for_bad_or_duplicate_casting(self):
+        self.add_actors(1)
+        self.add_movies(1)
+        self.add_castings([(1, 1)])
+
+        res = self.client().post('/movies/1/actors', headers=self.headers(self.casting_director),
+                                 json={'actor_id': 'one', 'role': 7})
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(set(json.loads(res.data)['errors']), {'actor_id', 'role'})
+
+        res = self.client().post('/movies/1/actors', headers=self.headers(self.casting_director), json={'actor_id': 1})
+        self.assertEqual(res.status_code, 422)
+
+    def test_400_for_unknown_include(self):
+        self.assertEqual(self.get('/actors?include=everything').status_code, 400)
+
+    def test_assistant_cannot_change_cast(self):
+        self.add_actors(1)
+        self.add_movies(1)
+
+        res = self.client().post('/movies/1/actors', headers=self.headers(self.casting_assistant), json={'actor_id': 1})
+        self.assertEqual(res.status_code, 403)
+        res = self.client().delete('/movies/1/actors/1', headers=self.headers(self.casting_assistant))
+        self.assertEqual(res.status_code, 403)
+
+
+class SearchTestCase(LocalAuthTestCase):
+    """This class represents the full-text search test case"""
+
+    def search(self, query, token=None):
+        res = self.client().get('/search?' + query, headers=self.headers(token or self.casting_assistant))
+        return res, json.loads(res.data)
+
+    def add_titles(self, titles):
+        with self.app.app_context():
+            db.session.add_all([Movie(title=title, release_date=2000) for title in titles])
+            record_write('movies', len(titles))
+            db.session.commit()
+
+    ### SUCCESS
+    def test_finds_actors_and_movies_by_words_and_prefixes(self):
+        self.add_actors(3)
+        self.add_titles(['Actor 1: The Movie', 'Inception'])
+
+        res, data = self.search('q=actor 1')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual({(r['type'], r['id']) for r in data['results']}, {('actors', 2), ('movies', 1)})
+        self.assertEqual(data['results'][0]['type'], 'actors')
+        self.assertEqual(data['results'][0]['name'], 'Actor 1')
+        self.assertEqual([r['title'] for r in self.search('q=incep')[1]['results']], ['Inception'])
+        self.assertEqual(self.search('q=in')[1]['results'], [])
+
+    def test_ranked_by_bm25(self):
+        self.add_titles(['Night Day Night', 'Day of the Dead', 'Night of the Living Dead', 'Night'])
+
+        titles = [r['title'] for r in self.search('q=night&type=movies')[1]['results']]
+
+        self.assertEqual(titles, ['Night Day Night', 'Night', 'Night of the Living Dead'])
+
+    def test_ignores_case_diacritics_and_query_syntax(self):
+        self.add_titles(['Amélie', 'Léon: The Professional'])
+
+        self.assertEqual(len(self.search('q=AMELIE')[1]['results']), 1)
+        res, data = self.search('q=' + '"leon" OR -NEAR(*')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'], [])
+        self.assertEqual(len(self.search('q=leon: "the"')[1]['results']), 1)
+
+    def test_pages_through_results(self):
+        self.add_actors(30)
+        self.add_titles(['Actor {}'.format(i) for i in range(5)])
+
+        seen = []
+        query = 'q=actor&limit=7'
+        while True:
+            res, data = self.search(query)
+            self.assertEqual(res.status_code, 200)
+            seen += [(r['type'], r['id']) for r in data['results']]
+            if data['next_cursor'] is None:
+                break
+            query = 'q=actor&limit=7&after=' + data['next_cursor']
+
+        self.assertEqual(len(seen), 35)
+        self.assertEqual(len(set(seen)), 35)
+
+    def test_ranks_every_match(self):
+        # the best match comes after more matches than an id bound would rank
+        self.add_titles(['Night {}'.format(i) for i in range(10050)] + ['Night'])
+        self.add_actors(30)
+
+        results = self.search('q=night&limit=1')[1]['results']
+
+        self.assertEqual((results[0]['type'], results[0]['id']), ('movies', 10051))
+
+    def test_index_follows_writes(self):
+        director = self.headers(self.casting_director)
+        self.add_actors(1)
+        created = json.loads(self.client().post('/actors', headers=director,
+                                                json={'name': 'Meryl Streep', 'age': 72, 'gender': 'female'}).data)['created']
+        self.client().post('/movies/bulk', headers=director,
+                           json={'movies': [{'title': 'Mamma Mia', 'release_date': 2008}]})
+        self.assertEqual(len(self.search('q=streep')[1]['results']), 1)
+        self.assertEqual(len(self.search('q=mamma')[1]['results']), 1)
+
+        self.client().patch('/actors/{}'.format(created), headers=director, json={'name': 'Sigourney Weaver'})
+        self.assertEqual(self.search('q=streep')[1]['results'], [])
+        self.assertEqual(self.search('q=weaver')[1]['results'][0]['id'], created)
+
+        self.client().delete('/actors/{}'.format(created), headers=director)
+        self.assertEqual(self.search('q=weaver')[1]['results'], [])
+
+    def test_etag(self):
+        self.add_titles(['Heat'])
+        res = self.client().get('/search?q=heat', headers=self.headers(self.casting_assistant))
+
+        headers = dict(self.headers(self.casting_assistant), **{'If-None-Match': res.headers['ETag']})
+        self.assertEqual(self.client().get('/search?q=heat', headers=headers).status_code, 304)
+        self.add_titles(['Heat 2'])
+        self.assertEqual(self.client().get('/search?q=heat', headers=headers).status_code, 200)
+
+    ### FAILURE
+    def test_400_for_bad_queries(self):
+        self.add_titles(['Heat'])
+
+        for query in ('', 'q=', 'q=%22%20*', 'q=heat&type=directors', 'q=heat&after=abc',
+                      'q=heat&type=actors&after=' + encode_cursor([-1.0, 'movies', 1]),
+                      'q=heat&after=' + encode_cursor([0, 'actors', 2 ** 70])):
+            self.assertEqual(self.search(query)[0].status_code, 400, query)
+
+    def test_needs_both_read_permissions(self):
+        token = mint_token(self.key, ['get:actors'])
+
+        res, data = self.search('q=heat', token)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertFalse(data['success'])
+
+
+class BulkChangeTestCase(LocalAuthTestCase):
+    """This class represents the bulk PATCH and DELETE test case"""
+
+    def send(self, method, path, body, token=None):
+        res = self.client().open(path, method=method, json=body, headers=self.headers(token or self.casting_director))
+        return res, json.loads(res.data)
+
+    ### SUCCESS
+    def test_patch_by_ids(self):
+        self.add_actors(5)
+
+        res, data = self.send('PATCH', '/actors/bulk', {'ids': [2, 4, 9], 'changes': {'gender': 'other'}})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], 2)
+        with self.app.app_context():
+            self.assertEqual([a.id for a in Actor.query.filter(Actor.gender == 'other').order_by(Actor.id)], [2, 4])
+
+    def test_patch_by_filter_in_one_statement(self):
+        self.add_movies(10)
+        statements = []
+        with self.app.app_context():
+            engine = db.get_engine()
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE movies'):
+                statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', capture)
+        try:
+            res, data = self.send('PATCH', '/movies/bulk', {'filter': {'min_release_date': 1955},
+                                                            'changes': {'title': 'Remastered', 'release_date': '2020'}})
+        finally:
+            event.remove(engine, 'before_cursor_execute', capture)
+
+        self.assertEqual(data['updated'], 5)
+        self.assertEqual(len(statements), 1)
+        with self.app.app_context():
+            self.assertEqual(Movie.query.filter(Movie.release_date == 2020, Movie.title == 'Remastered').count(), 5)
+        self.assertEqual(len(self.client().get('/search?q=remastered', headers=self.headers(self.casting_assistant))
+                             .get_json()['results']), 5)
+
+    def test_delete_by_ids_and_filter(self):
+        self.add_actors(10)
+        self.add_movies(1)
+        self.add_castings([(1, 1), (1, 2), (1, 9)])
+
+        res, data = self.send('DELETE', '/actors/bulk', {'ids': [1, 2, 3]})
+        self.assertEqual((data['deleted'], data['total_actors']), (3, 7))
+
+        res, data = self.send('DELETE', '/actors/bulk', {'filter': {'gender': 'male', 'min_age': 25}})
+        self.assertEqual((data['deleted'], data['total_actors']), (2, 5))
+
+        with self.app.app_context():
+            self.assertEqual(Actor.query.count(), 5)
+            self.assertEqual(Casting.query.count(), 0)
+            self.assertEqual(db.session.get(TableStats, 'castings').row_count, 0)
+
+    def test_no_match_changes_nothing(self):
+        self.add_movies(2)
+        with self.app.app_context():
+            version = db.session.get(TableStats, 'movies').version
+
+        res, data = self.send('DELETE', '/movies/bulk', {'ids': [7, 8]}, self.executive_producer)
+
+        self.assertEqual((res.status_code, data['deleted'], data['total_movies']), (200, 0, 2))
+        with self.app.app_context():
+            self.assertEqual(db.session.get(TableStats, 'movies').version, version)
+
+    ### FAILURE
+    def test_422_for_invalid_changes(self):
+        self.add_actors(3)
+
+        res, data = self.send('PATCH', '/actors/bulk', {'ids': [1, 2], 'changes': {'name': '', 'age': 30}})
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['errors'], {'name': 'is required', 'age': 'cannot be changed'})
+        with self.app.app_context():
+            self.assertEqual(Actor.query.filter(Actor.name == '').count(), 0)
+
+    def test_400_for_bad_scope(self):
+        self.add_actors(3)
+
+        for body in ({'changes': {'gender': 'x'}},
+                     {'ids': [1], 'filter': {'gender': 'male'}, 'changes': {'gender': 'x'}},
+                     {'ids': [], 'changes': {'gender': 'x'}},
+                     {'ids': ['1'], 'changes': {'gender': 'x'}},
+                     {'ids': list(range(MAX_BULK_ROWS + 1)), 'changes': {'gender': 'x'}},
+                     {'filter': {}, 'changes': {'gender': 'x'}},
+                     {'filter': {'name_prefix': ''}, 'changes': {'gender': 'x'}},
+                     {'filter': {'title': 'x'}, 'changes': {'gender': 'x'}},
+                     {'filter': {'min_age': 'old'}, 'changes': {'gender': 'x'}},
+                     {'filter': {'min_age': None}, 'changes': {'gender': 'x'}}):
+            self.assertEqual(self.send('PATCH', '/actors/bulk', body)[0].status_code, 400, body)
+        with self.app.app_context():
+            self.assertEqual(Actor.query.filter(Actor.gender == 'x').count(), 0)
+
+    def test_needs_the_single_row_permissions(self):
+        self.add_movies(1)
+
+        self.assertEqual(self.send('PATCH', '/movies/bulk', {'ids': [1], 'changes': {'title': 'x'}},
+                                   self.casting_assistant)[0].status_code, 403)
+        self.assertEqual(self.send('DELETE', '/movies/bulk', {'ids': [1]})[0].status_code, 403)
+
+
+class MigrationTestCase(unittest.TestCase):
+    """This class represents the migrations test case"""
+
+    def test_upgrade_shipped_database(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'film.db')
+            shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'film.db'), path)
+            app = create_app()
+            setup_db(app, 'sqlite:///' + path)
+            upgrade_db(app)
+            with app.app_context():
+                self.assertEqual(Actor.count(), Actor.query.count())
+
+            con = sqlite3.connect(path)
+            indexes = {row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            tracked = {row[0] for row in con.execute("SELECT table_name FROM table_stats")}
+            found = con.execute("SELECT rowid FROM actors_fts WHERE actors_fts MATCH 'leonardo'").fetchall()
+            con.close()
+            self.assertTrue({'ix_actors_name', 'ix_actors_age', 'ix_actors_gender', 'ix_movies_release_date',
+                             'ix_castings_actor_id'} <= indexes)
+            self.assertEqual(tracked, {'actors', 'movies', 'castings'})
+            self.assertEqual(found, [(1,)])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_upgrade_new_database(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'new.db')
+            app = create_app()
+            setup_db(app, 'sqlite:///' + path)
+            upgrade_db(app)
+
+            con = sqlite3.connect(path)
+            tables = {row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            stats = set(con.execute("SELECT table_name, row_count FROM table_stats"))
+            con.close()
+            self.assertTrue(set(db.metadata.tables) | {'actors_fts', 'movies_fts', 'alembic_version'} <= tables)
+            self.assertEqual(stats, {('actors', 0), ('movies', 0), ('castings', 0)})
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class StartupTestCase(LocalAuthTestCase):
+    """This class represents the app startup test case"""
+
+    config = {'DATABASE_PROFILE': 'production'}
+
+    ### SUCCESS
+    def test_building_the_app_runs_no_ddl(self):
+        path = os.path.join(self.tmpdir, 'missing.db')
+        app = create_app()
+        setup_db(app, 'sqlite:///' + path)
+
+        self.assertFalse(os.path.exists(path))
+
+    def test_forked_worker_opens_its_own_connections(self):
+        self.add_actors(2)
+        with self.app.app_context():
+            engine = db.get_engine()
+            with engine.connect() as con:
+                inherited = con.connection.dbapi_connection
+
+            pid = os.fork()
+            if pid == 0:
+                code = 1
+                try:
+                    with engine.connect() as con:
+                        count = con.exec_driver_sql('SELECT count(*) FROM actors').scalar()
+                        if count == 2 and con.connection.dbapi_connection is not inherited:
+                            code = 0
+                finally:
+                    os._exit(code)
+            _, status = os.waitpid(pid, 0)
+
+            self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+            with engine.connect() as con:
+                self.assertIs(con.connection.dbapi_connection, inherited)
+
+    def test_gunicorn_profiles_are_valid_settings(self):
+        for profile in gunicorn_conf.profile_settings(1, 1, 1):
+            config = Config()
+            for name, value in gunicorn_conf.make_settings({'GUNICORN_PROFILE': profile}).items():
+                config.set(name, value)
+            for hook in ('on_starting', 'worker_exit', 'child_exit'):
+                config.set(hook, getattr(gunicorn_conf, hook))
+
+            self.assertTrue(config.preload_app)
+            self.assertGreater(config.max_requests_jitter, 0)
+            self.assertLess(config.graceful_timeout, 30)
+
+    def test_gunicorn_workers_follow_cores_and_environment(self):
+        settings = gunicorn_conf.make_settings({}, cores=4)
+        self.assertEqual((settings['worker_class'], settings['workers'], settings['threads']), ('gthread', 5, 8))
+        self.assertEqual(gunicorn_conf.make_settings({'GUNICORN_PROFILE': 'sync'}, cores=4)['workers'], 9)
+        self.assertEqual(gunicorn_conf.make_settings({'GUNICORN_PROFILE': 'async'}, cores=4)['wsgi_app'], 'asgi:APP')
+
+        settings = gunicorn_conf.make_settings({'WEB_CONCURRENCY': '2', 'GUNICORN_THREADS': '4', 'PORT': '5000'}, cores=4)
+        self.assertEqual((settings['workers'], settings['threads'], settings['bind']), (2, 4, '0.0.0.0:5000'))
+
+    def test_gunicorn_workers_share_metrics_by_default(self):
+        settings = gunicorn_conf.make_settings({'PORT': '5000'})
+        self.assertEqual(settings['raw_env'],
+                         ['METRICS_DIR={}'.format(os.path.join(tempfile.gettempdir(), 'film-metrics-5000'))])
+        self.assertNotIn('raw_env', gunicorn_conf.make_settings({'METRICS_DIR': self.tmpdir}))
+
+    def test_exiting_worker_flushes_what_it_holds(self):
+        extensions = {'write_queue': mock.Mock(), 'metrics': mock.Mock()}
+
+        gunicorn_conf.worker_exit(None, mock.Mock(wsgi=mock.Mock(extensions=extensions)))
+        # the master reaping a worker that never loaded the app
+        gunicorn_conf.worker_exit(None, object())
+
+        extensions['write_queue'].stop.assert_called_once_with()
+        extensions['metrics'].flush.assert_called_once_with(force=True)
+
+    ### FAILURE
+    def test_unknown_gunicorn_profile(self):
+        with self.assertRaises(ValueError):
+            gunicorn_conf.make_settings({'GUNICORN_PROFILE': 'threads'})
+
+
+class SerializationTestCase(LocalAuthTestCase):
+    """This class represents the response serialization test case"""
+
+    ### SUCCESS
+    def test_backends_produce_identical_bytes(self):
+        data = {'success': True, 'actors': [{'id': 1, 'name': 'Zoë Kravitz', 'age': None, 'gender': 'female'}]}
+        encoded = [dumps(data) for dumps in BACKENDS.values()]
+
+        self.assertEqual(len(set(encoded)), 1)
+        self.assertEqual(json.loads(encoded[0]), data)
+
+    def test_list_and_detail_bodies(self):
+        self.add_actors(3)
+        self.add_movies(2)
+
+        res = self.client().get('/actors', headers=self.headers(self.casting_assistant))
+        self.assertEqual(res.mimetype, 'application/json')
+        self.assertEqual(json.loads(res.data)['actors'][1], {'id': 2, 'name': 'Actor 1', 'age': 21, 'gender': 'female'})
+
+        res = self.client().get('/movies/2', headers=self.headers(self.casting_assistant))
+        self.assertEqual(json.loads(res.data)['movie'], {'id': 2, 'title': 'Movie 1', 'release_date': 1951})
+
+    def test_list_does_not_load_orm_instances(self):
+        self.add_actors(5)
+        loaded = []
+
+        def on_load(target, context):
+            loaded.append(target)
+
+        event.listen(Actor, 'load', on_load)
+        try:
+            res = self.client().get('/actors', headers=self.headers(self.casting_assistant))
+        finally:
+            event.remove(Actor, 'load', on_load)
+
+        self.assertEqual(len(json.loads(res.data)['actors']), 5)
+        self.assertEqual(loaded, [])
+
+
+    def test_error_bodies_go_through_the_pipeline(self):
+        with mock.patch('app.dumps', wraps=dumps_json) as encode:
+            for path, token in (('/actors/1000', self.casting_assistant), ('/actors?limit=0', self.casting_assistant),
+                                ('/actors', None)):
+                res = self.client().get(path, headers=self.headers(token) if token else {})
+
+                self.assertEqual(res.mimetype, 'application/json')
+                self.assertEqual(res.status_code, {'/actors/1000': 404, '/actors?limit=0': 400}.get(path, 401))
+                self.assertIsInstance(json.loads(res.data), dict)
+
+        self.assertEqual(encode.call_count, 3)
+
+class MetricsTestCase(LocalAuthTestCase):
+    """This class represents the /metrics instrumentation test case"""
+
+    def setUp(self):
+        self.metrics_dir = tempfile.mkdtemp(dir=self.tmpdir)
+        self.config = {'METRICS_DIR': self.metrics_dir, 'METRICS_FLUSH_INTERVAL': 0}
+        super().setUp()
+
+    def metrics(self):
+        res = self.client().get('/metrics', headers=self.headers(mint_token(self.key, ['get:metrics'])))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/plain')
+        return dict(line.rsplit(' ', 1) for line in res.data.decode('utf-8').splitlines() if not line.startswith('#'))
+
+    ### SUCCESS
+    def test_requests_by_route_and_status(self):
+        self.add_actors(3)
+        for i in range(2):
+            self.client().get('/actors', headers=self.headers(self.casting_assistant))
+        self.client().get('/actors/1', headers=self.headers(self.casting_assistant))
+        self.client().delete('/actors/1', headers=self.headers(self.casting_assistant))
+
+        metrics = self.metrics()
+
+        self.assertEqual(metrics['film_requests_total{method="GET",route="/actors",status="200"}'], '2')
+        self.assertEqual(metrics['film_requests_total{method="GET",route="/actors/<int:actor_id>",status="200"}'], '1')
+        self.assertEqual(metrics['film_requests_total{method="DELETE",route="/actors/<int:actor_id>",status="403"}'], '1')
+        self.assertEqual(metrics['film_request_duration_seconds_count{method="GET",route="/actors"}'], '2')
+        self.assertEqual(metrics['film_request_duration_seconds_bucket{method="GET",route="/actors",le="+Inf"}'], '2')
+
+    def test_phase_split_and_query_counts(self):
+        self.add_actors(3)
+        self.client().get('/actors', headers=self.headers(self.casting_assistant))
+
+        metrics = self.metrics()
+        phase = 'film_request_phase_seconds_{}{{method="GET",phase="{}",route="/actors"}}'
+
+        for name in ('auth', 'db', 'serialize', 'other'):
+            self.assertEqual(metrics[phase.format('count', name)], '1')
+        for name in ('auth', 'db', 'serialize'):
+            self.assertGreater(float(metrics[phase.format('sum', name)]), 0)
+        # the table version for the ETag, then the page itself
+        self.assertEqual(float(metrics['film_request_queries_sum{method="GET",route="/actors"}']), 2)
+
+    def test_adds_up_snapshots_of_other_workers(self):
+        other = Metrics(self.metrics_dir)
+        other.inc('film_requests_total', {'method': 'GET', 'route': '/movies', 'status': '200'}, 5)
+        other.observe('film_request_duration_seconds', {'method': 'GET', 'route': '/movies'}, 0.02)
+        other.flush(force=True)
+        os.replace(os.path.join(self.metrics_dir, '{}.json'.format(os.getpid())),
+                   os.path.join(self.metrics_dir, 'another-worker.json'))
+
+        self.client().get('/movies', headers=self.headers(self.casting_assistant))
+        metrics = self.metrics()
+
+        self.assertEqual(metrics['film_requests_total{method="GET",route="/movies",status="200"}'], '6')
+        self.assertEqual(metrics['film_request_duration_seconds_count{method="GET",route="/movies"}'], '2')
+        self.assertGreaterEqual(
+            int(metrics['film_request_duration_seconds_bucket{method="GET",route="/movies",le="0.025"}']), 1)
+
+
+    def test_exited_workers_fold_into_one_file(self):
+        def exited_worker(pid, count):
+            worker = Metrics(self.metrics_dir)
+            worker.inc('film_requests_total', {'method': 'GET', 'route': '/movies', 'status': '200'}, count)
+            worker.flush(force=True)
+            os.replace(os.path.join(self.metrics_dir, '{}.json'.format(os.getpid())),
+                       os.path.join(self.metrics_dir, '{}.json'.format(pid)))
+
+        exited_worker(101, 2)
+        exited_worker(102, 3)
+        # as the gunicorn master does when a worker exits
+        gunicorn_conf.child_exit(mock.Mock(app=mock.Mock(callable=self.app)), mock.Mock(pid=101))
+        fold_snapshot(self.metrics_dir, 102)
+        fold_snapshot(self.metrics_dir, 103)
+        self.assertEqual(os.listdir(self.metrics_dir), ['exited.json'])
+
+        # a new worker given a reused pid adds to the totals, not replaces them
+        exited_worker(101, 1)
+        self.client().get('/movies', headers=self.headers(self.casting_assistant))
+
+        self.assertEqual(self.metrics()['film_requests_total{method="GET",route="/movies",status="200"}'], '7')
+
+
+    def test_server_start_clears_the_last_run(self):
+        old = Metrics(self.metrics_dir)
+        old.inc('film_requests_total', {'method': 'GET', 'route': '/movies', 'status': '200'}, 4)
+        old.flush(force=True)
+        os.replace(os.path.join(self.metrics_dir, '{}.json'.format(os.getpid())),
+                   os.path.join(self.metrics_dir, 'exited.json'))
+
+        gunicorn_conf.on_starting(mock.Mock(app=mock.Mock(callable=self.app)))
+
+        self.assertEqual(os.listdir(self.metrics_dir), [])
+        self.client().get('/movies', headers=self.headers(self.casting_assistant))
+        self.assertEqual(self.metrics()['film_requests_total{method="GET",route="/movies",status="200"}'], '1')
+
+    def test_public_metrics_need_no_token(self):
+        app = create_app(dict(self.config, METRICS_PUBLIC='true'))
+
+        self.assertEqual(app.test_client().get('/metrics').status_code, 200)
+
+    ### FAILURE
+    def test_metrics_need_a_token_with_permission(self):
+        self.assertEqual(self.client().get('/metrics').status_code, 401)
+        res = self.client().get('/metrics', headers=self.headers(self.executive_producer))
+        self.assertEqual(res.status_code, 403)
+
+
+class QueryProfilerTestCase(LocalAuthTestCase):
+    """This class represents the slow-query log and query budget test case"""
+
+    def add_route(self, rule, view):
+        self.app.add_url_rule(rule, view.__name__, view)
+
+    ### SUCCESS
+    def test_logs_slow_queries_with_route(self):
+        self.app.extensions['query_profiler'].slow_query_ms = 0
+
+        with self.assertLogs('profiler', 'WARNING') as logs:
+            self.client().get('/actors/1', headers=self.headers(self.casting_assistant))
+
+        self.assertIn('in GET /actors/<int:actor_id>', logs.output[-1])
+        self.assertIn('parameters=(1,)', logs.output[-1])
+
+    def test_bulk_batches_are_not_repeats(self):
+        actors = [{'name': 'Actor {}'.format(i), 'age': 30, 'gender': 'male'} for i in range(MAX_BULK_ROWS)]
+
+        res = self.client().post('/actors/bulk', json={'actors': actors}, headers=self.headers(self.casting_director))
+
+        self.assertEqual(res.status_code, 200)
+
+    def test_logs_instead_of_raising_when_not_strict(self):
+        self.app.extensions['query_profiler'].strict = False
+
+        @query_budget(0)
+        def over_budget():
+            return str(Actor.count())
+        self.add_route('/over-budget', over_budget)
+
+        with self.assertLogs('profiler', 'WARNING') as logs:
+            res = self.client().get('/over-budget')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('GET /over-budget ran 1 statements, over its budget of 0', logs.output[0])
+
+    ### FAILURE
+    def test_n_plus_one(self):
+        self.add_actors(6)
+
+        def n_plus_one():
+            return str([Actor.query.get(i).name for i in range(1, 7)])
+        self.add_route('/n-plus-one', n_plus_one)
+
+        with self.assertRaises(QueryBudgetExceeded) as ctx:
+            self.client().get('/n-plus-one')
+        self.assertIn('ran the same statement 6 times', str(ctx.exception))
+
+    def test_over_budget(self):
+        @query_budget(1)
+        def legacy_count():
+            Actor.query.all()
+            return str(len(Movie.query.all()))
+        self.add_route('/legacy-count', legacy_count)
+
+        with self.assertRaises(QueryBudgetExceeded) as ctx:
+            self.client().get('/legacy-count')
+        self.assertIn('ran 2 statements, over its budget of 1', str(ctx.exception))
+
+
+class ReplicaTestCase(LocalAuthTestCase):
+    """This class represents the read replica test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.primary_file = self.database_path[len('sqlite:///'):]
+        self.replica_files = [os.path.join(self.tmpdir, 'replica_{}.db'.format(i)) for i in range(2)]
+        for path in self.replica_files:
+            sync_replica(self.primary_file, path)
+        self.use_replicas(self.replica_files)
+
+    def use_replicas(self, paths, **config):
+        self.app.config.update(config)
+        setup_db(self.app, self.database_path, replicas=['sqlite:///' + path for path in paths])
+
+    def count_actors(self, client):
+        res = client.get('/actors', headers=self.headers(self.casting_assistant))
+        self.assertEqual(res.status_code, 200)
+        return len(json.loads(res.data)['actors'])
+
+    ### SUCCESS
+    def test_reads_go_to_replicas_in_turn(self):
+        self.add_actors(1)
+        sync_replica(self.primary_file, self.replica_files[0])
+        self.add_actors(1)
+        client = self.client()
+
+        self.assertEqual([self.count_actors(client) for _ in range(4)], [1, 0, 1, 0])
+
+    def test_writer_reads_its_writes_from_primary(self):
+        writer = self.client()
+        res = writer.post('/actors', json={'name': 'Ellen Page', 'age': 25, 'gender': 'female'},
+                          headers=self.headers(self.casting_director))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('read_primary_until=', res.headers['Set-Cookie'])
+        self.assertEqual(self.count_actors(writer), 1)
+        self.assertEqual(self.count_actors(self.client()), 0)
+
+    def test_writer_reads_replicas_again_after_lag(self):
+        self.use_replicas(self.replica_files, DATABASE_REPLICA_LAG=0)
+        writer = self.client()
+        writer.post('/actors', json={'name': 'Ellen Page', 'age': 25, 'gender': 'female'},
+                    headers=self.headers(self.casting_director))
+
+        self.assertEqual(self.count_actors(writer), 0)
+
+    def test_unavailable_replicas_fall_back_to_primary(self):
+        # one cannot be opened, the other has no schema
+        unmigrated = os.path.join(self.tmpdir, 'empty.db')
+        open(unmigrated, 'w').close()
+        self.use_replicas([os.path.join(self.tmpdir, 'missing', 'replica.db'), unmigrated])
+        self.add_actors(1)
+
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            self.assertEqual(self.count_actors(self.client()), 1)
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn('replica_0', logs.output[0])
+        down = dict(self.app.extensions['replicas']._down)
+        self.assertEqual(set(down), {'replica_0', 'replica_1'})
+
+        # skipped until DATABASE_REPLICA_RETRY has passed
+        self.assertEqual(self.count_actors(self.client()), 1)
+        self.assertEqual(self.app.extensions['replicas']._down, down)
+
+    def test_replicas_are_read_only(self):
+        with self.app.app_context():
+            engine = self.app.extensions['replicas'].engine('replica_0')
+            with engine.connect() as con:
+                self.assertRaises(OperationalError, con.exec_driver_sql, 'DELETE FROM actors')
+
+    ### FAILURE
+    def test_unavailable_replicas_can_fail_reads(self):
+        self.use_replicas([os.path.join(self.tmpdir, 'missing', 'replica.db')],
+                          DATABASE_REPLICA_FALLBACK='error')
+
+        res = self.client().get('/actors', headers=self.headers(self.casting_assistant))
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(json.loads(res.data)['message'], 'service unavailable')
+
+    def test_unknown_fallback(self):
+        with self.assertRaises(ValueError):
+            self.use_replicas(self.replica_files, DATABASE_REPLICA_FALLBACK='retry')
+
+
+class GroupCommitTestCase(LocalAuthTestCase):
+    """This class represents the group commit test case"""
+
+    config = {'GROUP_COMMIT': True, 'GROUP_COMMIT_MAX_ROWS': 10, 'GROUP_COMMIT_MAX_DELAY': 0.5}
+
+    def tearDown(self):
+        self.app.extensions['write_queue'].stop()
+
+    def post_actors(self, names):
+        responses = {}
+
+        def post(name):
+            responses[name] = self.client().post('/actors', json={'name': name, 'age': 30, 'gender': 'female'},
+                                                 headers=self.headers(self.casting_director))
+
+        threads = [threading.Thread(target=post, args=(name,)) for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return responses
+
+    ### SUCCESS
+    def test_concurrent_posts_share_commits(self):
+        write_queue = self.app.extensions['write_queue']
+        batches = []
+        write = write_queue.write
+        write_queue.write = lambda batch: batches.append(len(batch)) or write(batch)
+        names = ['Actor {}'.format(i) for i in range(10)]
+
+        responses = self.post_actors(names)
+
+        self.assertEqual(sum(batches), 10)
+        self.assertLess(len(batches), 10)
+        created = {name: json.loads(res.data)['created'] for name, res in responses.items()}
+        with self.app.app_context():
+            self.assertEqual(dict(db.session.query(Actor.name, Actor.id).all()), created)
+            self.assertEqual(Actor.count(), 10)
+
+    def test_commit_invalidates_cached_responses(self):
+        client = self.client()
+        client.get('/actors', headers=self.headers(self.casting_assistant))
+
+        self.post_actors(['Ellen Page'])
+        res = client.get('/actors', headers=self.headers(self.casting_assistant))
+
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(len(json.loads(res.data)['actors']), 1)
+
+    def test_movies_share_the_queue(self):
+        res = self.client().post('/movies', json={'title': 'Star Wars', 'release_date': 1977},
+                                 headers=self.headers(self.executive_producer))
+
+        self.assertEqual(json.loads(res.data)['created'], 1)
+
+    def test_slow_commit_still_answers_its_requests(self):
+        write_queue = self.app.extensions['write_queue']
+        write_queue.max_delay, write_queue.timeout = 0, 0.1
+        write = write_queue.write
+        write_queue.write = lambda batch: time.sleep(0.3) or write(batch)
+
+        res = self.post_actors(['Ellen Page'])['Ellen Page']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['created'], 1)
+
+    ### FAILURE
+    def test_bad_row_fails_only_its_own_request(self):
+        good = PendingRow(Actor, {'name': 'Ellen Page', 'age': 25, 'gender': 'female'})
+        bad = PendingRow(Actor, {'name': None, 'age': 25, 'gender': 'female'})
+
+        with self.app.app_context():
+            self.app.extensions['write_queue'].commit([good, bad])
+            self.assertEqual(Actor.count(), 1)
+
+        self.assertEqual((good.id, good.error), (1, None))
+        self.assertIsNone(bad.id)
+        self.assertIsNotNone(bad.error)
+
+    def test_timed_out_row_is_not_written(self):
+        write_queue = self.app.extensions['write_queue']
+        # the writer waits GROUP_COMMIT_MAX_DELAY for company, longer than this
+        write_queue.timeout = 0.1
+
+        res = self.post_actors(['Ellen Page'])['Ellen Page']
+        write_queue.stop()
+
+        self.assertEqual(res.status_code, 422)
+        with self.app.app_context():
+            self.assertEqual(Actor.query.count(), 0)
+            self.assertEqual(Actor.count(), 0)
+
+    def test_rejected_row_is_unprocessable(self):
+        res = self.client().post('/actors', json={'age': 25}, headers=self.headers(self.casting_director))
+
+        self.assertEqual(res.status_code, 422)
+
+
+class RateLimitTestCase(LocalAuthTestCase):
+    """This class represents the rate limiting and load shedding test case"""
+
+    config = {'RATE_LIMIT': 1, 'RATE_LIMIT_BURST': 2, 'MAX_CONCURRENT_REQUESTS': 1}
+
+    def get(self, client, path='/actors', token=None):
+        return client.get(path, headers=self.headers(token or self.casting_assistant))
+
+    ### SUCCESS
+    def test_buckets_refill(self):
+        buckets = MemoryBuckets()
+
+        self.assertEqual(buckets.take('key', 2, 1, now=0), 0)
+        self.assertEqual(buckets.take('key', 2, 1, now=0.25), 0.25)
+        self.assertEqual(buckets.take('key', 2, 1, now=0.5), 0)
+
+    def test_limits_are_per_subject_and_permission(self):
+        client = self.client()
+        for i in range(2):
+            self.assertEqual(self.get(client).status_code, 200)
+
+        self.assertEqual(self.get(client, '/movies').status_code, 200)
+        other = mint_token(self.key, ASSISTANT_PERMISSIONS, sub='auth0|someone-else')
+        self.assertEqual(self.get(client, token=other).status_code, 200)
+
+    def test_permission_overrides(self):
+        app = create_app({'RATE_LIMITS': {'post:actors': (1, 1)}})
+        setup_db(app, self.database_path)
+        client = app.test_client()
+        for i in range(3):
+            self.assertEqual(self.get(client).status_code, 200)
+
+        statuses = [client.post('/actors', json={'name': 'A', 'age': 30, 'gender': 'male'},
+                                headers=self.headers(self.casting_director)).status_code for i in range(2)]
+
+        self.assertEqual(statuses, [200, 429])
+
+    def test_sqlite_store_is_shared_between_apps(self):
+        config = dict(self.config, RATE_LIMIT_STORE='sqlite', RATE_LIMIT_PATH=os.path.join(self.tmpdir, 'limits.db'))
+        apps = []
+        for i in range(2):
+            app = create_app(config)
+            setup_db(app, self.database_path)
+            apps.append(app)
+
+        self.assertEqual(self.get(apps[0].test_client()).status_code, 200)
+        self.assertEqual(self.get(apps[1].test_client()).status_code, 200)
+        self.assertEqual(self.get(apps[0].test_client()).status_code, 429)
+
+    ### FAILURE
+    def test_client_over_its_limit(self):
+        client = self.client()
+        statuses = [self.get(client).status_code for i in range(2)]
+        res = self.get(client)
+
+        self.assertEqual(statuses, [200, 200])
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(res.headers['Retry-After'], '1')
+        self.assertEqual(json.loads(res.data)['message'], 'too many requests')
+
+    def test_requests_over_the_cap_are_shed(self):
+        limiter = self.app.extensions['rate_limiter']
+        with limiter.admit():
+            with mock.patch('models.Actor.columns', side_effect=AssertionError('reached the view')):
+                res = self.get(self.client())
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '1')
+        self.assertEqual((limiter.in_flight, limiter.shed), (0, 1))
+        self.assertEqual(self.get(self.client()).status_code, 200)
+
+
+class CompressionTestCase(LocalAuthTestCase):
+    """This class represents the response compression test case"""
+
+    def get(self, client, path='/actors?limit=50', encoding='gzip', **headers):
+        if encoding is not None:
+            headers['Accept-Encoding'] = encoding
+        return client.get(path, headers=dict(self.headers(self.casting_assistant), **headers))
+
+    ### SUCCESS
+    def test_gzip_when_accepted(self):
+        self.add_actors(50)
+        client = self.client()
+        plain = self.get(client, encoding=None)
+
+        res = self.get(client)
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertLess(len(res.data), len(plain.data))
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        self.assertEqual(res.headers['ETag'], 'W/' + plain.headers['ETag'])
+
+    def test_unchanged_list_is_compressed_once(self):
+        self.add_actors(50)
+        client = self.client()
+        calls = []
+        encoder = ENCODERS['gzip']
+
+        with mock.patch.dict(ENCODERS, gzip=lambda body, level: calls.append(body) or encoder(body, level)):
+            first = self.get(client)
+            second = self.get(client)
+            self.add_actors(1)
+            third = self.get(client)
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(len(json.loads(gzip.decompress(third.data))['actors']), 50)
+        self.assertNotEqual(first.headers['ETag'], third.headers['ETag'])
+
+    def test_compressed_etag_revalidates(self):
+        self.add_actors(50)
+        client = self.client()
+        etag = self.get(client).headers['ETag']
+
+        res = self.get(client, **{'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertNotIn('Content-Encoding', res.headers)
+
+    def test_small_and_unaccepted_responses_are_left_alone(self):
+        self.add_actors(50)
+        client = self.client()
+
+        for res in (self.get(client, '/actors/1'), self.get(client, encoding=None),
+                    self.get(client, encoding='gzip;q=0'), self.get(client, encoding='identity')):
+            self.assertEqual(res.status_code, 200)
+            self.assertNotIn('Content-Encoding', res.headers)
+            json.loads(res.data)
+
+    def test_exports_are_not_compressed(self):
+        self.add_actors(50)
+
+        res = self.get(self.client(), '/actors/export')
+
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(len(res.data.splitlines()), 50)
+
+    @unittest.skipUnless('br' in ENCODERS, 'brotli is not installed')
+    def test_brotli_preferred(self):
+        self.add_actors(50)
+
+        res = self.get(self.client(), encoding='gzip, deflate, br')
+
+        self.assertEqual(res.headers['Content-Encoding'], 'br')
+
+
+@unittest.skipUnless(create_asgi_app is not None and importlib.util.find_spec('aiosqlite'),
+                     'requirements-async.txt is not installed')
+class AsyncAppTestCase(LocalAuthTestCase):
+    """This class represents the async (ASGI) app test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.async_app = create_asgi_app({'SQLALCHEMY_DATABASE_URI': self.database_path})
+
+    def tearDown(self):
+        asyncio.run(self.async_app.extensions['async_engine'].dispose())
+
+    def request(self, method, path, token=None, **kwargs):
+        async def send():
+            res = await self.async_app.test_client().open(path, method=method, headers=headers, **kwargs)
+            return res, await res.get_data()
+        headers = dict(self.headers(token) if token else {}, **kwargs.pop('headers', {}))
+        return asyncio.run(send())
+
+    ### SUCCESS
+    def test_rate_limits_apply(self):
+        self.async_app = create_asgi_app({'SQLALCHEMY_DATABASE_URI': self.database_path,
+                                          'RATE_LIMIT': 1, 'RATE_LIMIT_BURST': 1})
+        statuses = [self.request('GET', '/actors', self.casting_assistant)[0] for i in range(2)]
+
+        self.assertEqual([res.status_code for res in statuses], [200, 429])
+        self.assertEqual(statuses[1].headers['Retry-After'], '1')
+
+    def test_same_responses_as_sync_app(self):
+        self.add_actors(30)
+
+        for path in ('/actors?limit=7&sort=-age', '/actors?gender=male&min_age=30', '/actors/3', '/actors/export'):
+            res, body = self.request('GET', path, self.casting_assistant)
+            expected = self.client().get(path, headers=self.headers(self.casting_assistant))
+
+            self.assertEqual(res.status_code, 200)
+            if path.endswith('export'):
+                self.assertEqual(body, expected.data)
+            else:
+                self.assertEqual(json.loads(body), json.loads(expected.data))
+
+    def test_writes_are_visible_to_sync_app(self):
+        res, body = self.request('POST', '/actors', self.casting_director,
+                                 json={'name': 'Ellen Page', 'age': 25, 'gender': 'female'})
+        actor_id = json.loads(body)['created']
+        self.request('PATCH', '/actors/{}'.format(actor_id), self.casting_director, json={'name': 'Elliot Page'})
+        self.request('POST', '/actors/bulk', self.casting_director,
+                     json={'actors': [{'name': 'A', 'age': 30, 'gender': 'male'}]})
+        res, body = self.request('DELETE', '/actors/{}'.format(actor_id), self.casting_director)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(body)['total_actors'], 1)
+        with self.app.app_context():
+            self.assertEqual(Actor.count(), 1)
+
+    def test_delete_removes_castings(self):
+        self.add_actors(2)
+        self.add_movies(1)
+        self.add_castings([(1, 1), (1, 2)])
+
+        res, body = self.request('DELETE', '/actors/1', self.casting_director)
+
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            self.assertEqual([c.actor_id for c in Casting.query.all()], [2])
+            self.assertEqual(db.session.get(TableStats, 'castings').row_count, 1)
+
+    def test_search_matches_sync_app(self):
+        self.add_actors(12)
+
+        for path in ('/search?q=actor&limit=5', '/search?q=actor%201&type=actors'):
+            res, body = self.request('GET', path, self.casting_assistant)
+            expected = self.client().get(path, headers=self.headers(self.casting_assistant))
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(json.loads(body), json.loads(expected.data))
+
+    def test_cast_matches_sync_app(self):
+        self.add_actors(4)
+        self.add_movies(3)
+        self.add_castings([(1, 1), (1, 2), (2, 2), (3, 4)])
+
+        for path in ('/actors?include=cast', '/movies?include=cast&limit=2', '/movies/1/actors', '/actors/2/movies',
+                     '/actors/3/movies'):
+            res, body = self.request('GET', path, self.casting_assistant)
+            expected = self.client().get(path, headers=self.headers(self.casting_assistant))
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(json.loads(body), json.loads(expected.data))
+            self.assertEqual(res.headers['ETag'], expected.headers['ETag'])
+
+    def test_casting_writes_are_visible_to_sync_app(self):
+        self.add_actors(2)
+        self.add_movies(1)
+
+        res, body = self.request('POST', '/movies/1/actors', self.executive_producer, json={'actor_id': 2, 'role': 'Lead'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.request('POST', '/movies/1/actors', self.executive_producer,
+                                      json={'actor_id': 2})[0].status_code, 422)
+        res = self.client().get('/movies/1/actors', headers=self.headers(self.casting_assistant))
+        self.assertEqual([(actor['id'], actor['role']) for actor in json.loads(res.data)['actors']], [(2, 'Lead')])
+
+        res, body = self.request('DELETE', '/movies/1/actors/2', self.executive_producer)
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            self.assertEqual(Casting.query.count(), 0)
+            self.assertEqual(db.session.get(TableStats, 'castings').row_count, 0)
+
+    def test_serves_every_sync_route(self):
+        def routes(app):
+            return {(rule.rule, method) for rule in app.url_map.iter_rules()
+                    for method in rule.methods - {'HEAD', 'OPTIONS'} if rule.endpoint not in ('static', 'metrics')}
+
+        self.assertEqual(routes(self.async_app), routes(self.app))
+
+    def test_bulk_changes_match_sync_app(self):
+        self.add_actors(10)
+        self.add_movies(1)
+        self.add_castings([(1, 2), (1, 3)])
+
+        res, body = self.request('PATCH', '/actors/bulk', self.casting_director,
+                                 json={'filter': {'gender': 'male', 'max_age': 25}, 'changes': {'gender': 'other'}})
+        self.assertEqual(json.loads(body), {'success': True, 'updated': 3})
+        res, body = self.request('DELETE', '/actors/bulk', self.casting_director, json={'ids': [2, 3, 99]})
+        self.assertEqual(json.loads(body), {'success': True, 'deleted': 2, 'total_actors': 8})
+
+        res = self.client().get('/actors?gender=other', headers=self.headers(self.casting_assistant))
+        self.assertEqual([actor['id'] for actor in json.loads(res.data)['actors']], [1, 5])
+        with self.app.app_context():
+            self.assertEqual(Casting.query.count(), 0)
+            self.assertEqual(db.session.get(TableStats, 'castings').row_count, 0)
+
+    def test_etag_matches_after_sync_write(self):
+        self.add_actors(3)
+        res, body = self.request('GET', '/actors', self.casting_assistant)
+        etag = res.headers['ETag']
+
+        res, body = self.request('GET', '/actors', self.casting_assistant, headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+
+        self.client().delete('/actors/1', headers=self.headers(self.casting_director))
+        res, body = self.request('GET', '/actors', self.casting_assistant, headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+
+    def test_concurrent_requests(self):
+        self.add_actors(20)
+        tokens = [mint_token(self.key, ASSISTANT_PERMISSIONS, sub='user-{}'.format(i)) for i in range(10)]
+
+        async def send_all():
+            client = self.async_app.test_client()
+            responses = await asyncio.gather(*[
+                client.get('/actors/{}'.format(i + 1), headers=self.headers(token)) for i, token in enumerate(tokens)])
+            return [res.status_code for res in responses]
+
+        self.assertEqual(asyncio.run(send_all()), [200] * 10)
+
+    ### FAILURE
+    def test_missing_auth_header(self):
+        res, body = self.request('GET', '/actors')
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(json.loads(body)['code'], 'authorization_header_missing')
+
+    def test_missing_permission(self):
+        res, body = self.request('DELETE', '/movies/1', self.casting_director)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(json.loads(body)['message'],
+                         "You don't have the permission to access the requested resource.")
+
+    def test_missing_records_keep_sync_status_codes(self):
+        self.assertEqual(self.request('GET', '/actors/99', self.casting_assistant)[0].status_code, 404)
+        self.assertEqual(self.request('DELETE', '/actors/99', self.casting_director)[0].status_code, 422)
+        self.assertEqual(self.request('PATCH', '/actors/99', self.casting_director, json={})[0].status_code, 400)
+
+    def test_bulk_errors_keep_sync_status_codes(self):
+        self.add_movies(2)
+
+        for method, body in (('PATCH', {'filter': {}, 'changes': {'title': 'X'}}),
+                             ('PATCH', {'ids': [1], 'changes': {'title': ''}}),
+                             ('PATCH', {'ids': [1], 'filter': {'min_release_date': 1950}, 'changes': {'title': 'X'}}),
+                             ('DELETE', {'filter': {'title': 'Movie 1'}}),
+                             ('DELETE', {'ids': ['1']})):
+            res, data = self.request(method, '/movies/bulk', self.executive_producer, json=body)
+            expected = self.client().open('/movies/bulk', method=method, json=body,
+                                          headers=self.headers(self.executive_producer))
+
+            self.assertGreaterEqual(res.status_code, 400)
+            self.assertEqual((res.status_code, json.loads(data)), (expected.status_code, json.loads(expected.data)))
+
+    def test_cast_errors_keep_sync_status_codes(self):
+        self.add_actors(1)
+        self.add_movies(1)
+
+        for method, path, token, body in (
+                ('GET', '/actors?include=bogus', self.casting_assistant, None),
+                ('GET', '/movies?include=actors', self.casting_assistant, None),
+                ('GET', '/movies/99/actors', self.casting_assistant, None),
+                ('GET', '/actors/99/movies', self.casting_assistant, None),
+                ('GET', '/actors/99999999999999999999999', self.casting_assistant, None),
+                ('POST', '/movies/99/actors', self.executive_producer, {'actor_id': 1}),
+                ('POST', '/movies/1/actors', self.executive_producer, {'actor_id': 'one'}),
+                ('DELETE', '/movies/1/actors/1', self.executive_producer, None)):
+            res, data = self.request(method, path, token, json=body)
+            expected = self.client().open(path, method=method, json=body, headers=self.headers(token))
+
+            self.assertGreaterEqual(res.status_code, 400)
+            self.assertEqual(res.status_code, expected.status_code, path)
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file